@@ -20,6 +20,14 @@ logger.setLevel(level)
 # 
 
 firehose_name = os.getenv("FIREHOSE_NAME",None)
+# records which can never be processed are sent here
+dead_letter_name = os.getenv("DEAD_LETTER_FIREHOSE_NAME",None)
+# process records in parallel with WORKER_MODE thread or process, WORKERS defaults to the number of CPUs
+worker_mode = os.getenv("WORKER_MODE", "serial")
+workers = int(os.getenv("WORKERS", "0")) or None
+# check the cache URLs of a batch concurrently, at most PROBE_SAMPLE per host (0 checks all)
+probe = os.getenv("PROBE_CACHE", "True").lower() in ('true', '1', 't', 'yes')
+probe_sample = int(os.getenv("PROBE_SAMPLE", "0")) or None
 
 
 def process_notification(event):
@@ -30,7 +38,7 @@ def process_notification(event):
  
 def lambda_handler(event, context):
     """this functions receives kinesis records and extracts information about surface observations from it"""
-    return kinesis_lambda_handler(event,context,process_notification,firehose_name)
+    return kinesis_lambda_handler(event,context,process_notification,firehose_name,probe=probe,probe_sample=probe_sample,mode=worker_mode,workers=workers,dead_letter_name=dead_letter_name)
 
 
 # def lambda_handler(event, context):
@@ -3,12 +3,11 @@ import sys
 import json
 import os
 import io
-import boto3
 import base64
 
 from .bufr_processing import process_bufr
 
-from wis2mon_lib import handle_content, serialize_wis2_message, kinesis_lambda_handler
+from wis2mon_lib import handle_content, serialize_wis2_message, kinesis_lambda_handler, ProcessorRegistry, NonRecoverableError
 
 # Configure logging
 logger = logging.getLogger()
@@ -19,6 +18,16 @@ logger.setLevel(level)
 logging.getLogger("bufr2geojson").setLevel(logging.ERROR)
 
 firehose_name = os.getenv("FIREHOSE_NAME",None)
+dead_letter_name = os.getenv("DEAD_LETTER_FIREHOSE_NAME",None)
+worker_mode = os.getenv("WORKER_MODE", "serial")
+workers = int(os.getenv("WORKERS", "0")) or None
+prefetch = os.getenv("PREFETCH", "True").lower() in ('true', '1', 't', 'yes')
+prefetch_deadline = float(os.getenv("PREFETCH_DEADLINE", "30"))
+# fanout_handler also writes every notification to NOTIFICATIONS_FIREHOSE_NAME, sharing the consumer of the stream
+notifications_firehose_name = os.getenv("NOTIFICATIONS_FIREHOSE_NAME",None)
+validate_schema = os.getenv("LAMBDA_VALIDATE","True").lower() in ('true', '1', 't', 'yes')
+probe = os.getenv("PROBE_CACHE", "True").lower() in ('true', '1', 't', 'yes')
+probe_sample = int(os.getenv("PROBE_SAMPLE", "0")) or None
 
 
 def process_surface_obs(event):
@@ -26,7 +35,11 @@ def process_surface_obs(event):
 
     content = handle_content(event)
     if content:
-        data = process_bufr( content )
+        try:
+            data = process_bufr( content )
+        except Exception as e:
+            # a bulletin eccodes cannot decode, decoding it again gives the same error
+            raise NonRecoverableError(f"cannot decode BUFR: {e}")
         logger.debug("processed bufr.. extracted {} observations".format(len(data)))
 
         message_info = serialize_wis2_message(event,validate=False,check_cache=False) ##
@@ -44,7 +57,22 @@ def process_surface_obs(event):
 def lambda_handler(event, context):
     """this functions receives kinesis records and extracts information about surface observations from it"""
 
-    return kinesis_lambda_handler(event,context,process_surface_obs,firehose_name)
+    return kinesis_lambda_handler(event,context,process_surface_obs,firehose_name,prefetch=prefetch,prefetch_deadline=prefetch_deadline,mode=worker_mode,workers=workers,dead_letter_name=dead_letter_name)
+
+
+registry = ProcessorRegistry(dead_letter_name=dead_letter_name)
+if notifications_firehose_name:
+    registry.register("notifications", lambda event: [serialize_wis2_message(event,validate=validate_schema)],
+                      firehose_name=notifications_firehose_name)
+registry.register("surface_obs", process_surface_obs,
+                  topics=["cache/a/wis2/+/data/core/weather/surface-based-observations/synop",
+                          "cache/a/wis2/+/+/data/core/weather/surface-based-observations/synop"],
+                  firehose_name=firehose_name, needs_content=True)
+
+
+def fanout_handler(event, context):
+    """one pass over the stream for all processors of the registry, the content of a notification is downloaded once"""
+    return registry.lambda_handler(event,context,prefetch=prefetch,prefetch_deadline=prefetch_deadline,probe=probe and bool(notifications_firehose_name),probe_sample=probe_sample,mode=worker_mode,workers=workers,dead_letter_name=dead_letter_name)
 
     
             
@@ -1,26 +1,32 @@
 import logging
 import json
 
-import pandas as pd
+from functools import lru_cache
 
-from bufr2geojson import __version__, transform as as_geojson
-from jsonpath_ng import jsonpath
-from jsonpath_ng.ext import parse 
+from wis2mon_lib import timed
 
 logger = logging.getLogger(__name__)
 
-exp_lat = parse('$.geometry.coordinates[0]')
-exp_lon = parse('$.geometry.coordinates[1]')
-exp_alt = parse('$.geometry.coordinates[2]')
+# JSONPath expressions, parsed on first use
+exp_lat = '$.geometry.coordinates[0]'
+exp_lon = '$.geometry.coordinates[1]'
+exp_alt = '$.geometry.coordinates[2]'
 
-exp_params_name = parse('$.properties.parameter[?(@.name == "long_station_name" )].description')
-exp_params = parse('$.properties.parameter[?(@.name != "long_station_name" )].name')
+exp_params_name = '$.properties.parameter[?(@.name == "long_station_name" )].description'
+exp_params = '$.properties.parameter[?(@.name != "long_station_name" )].name'
+
+exp_wsi = '$.properties.wigos_station_identifier'
+exp_resultdate = '$.properties.resultTime'
+exp_phendate = '$.properties.phenomenonTime'
+#exp_obsprop = '$.properties.observedProperty'
+exp_obsprop = '$.properties.name'
+
+
+@lru_cache(maxsize=None)
+def expression(path):
+    from jsonpath_ng.ext import parse
+    return parse(path)
 
-exp_wsi = parse('$.properties.wigos_station_identifier')
-exp_resultdate = parse('$.properties.resultTime')
-exp_phendate = parse('$.properties.phenomenonTime')
-#exp_obsprop = parse('$.properties.observedProperty')
-exp_obsprop = parse('$.properties.name')
 
 variables_of_interest = [
             #"non_coordinate_pressure",
@@ -49,28 +55,28 @@ def extract_info_from_geojson(geojson_record):
     
     ret = {}
     
-    m = exp_lat.find(geojson_record)
+    m = expression(exp_lat).find(geojson_record)
     ret["geom_lat"] = m[0].value if m else ""
 
-    m = exp_lon.find(geojson_record)
+    m = expression(exp_lon).find(geojson_record)
     ret["geom_lon"] = m[0].value if m else ""
 
-    m = exp_alt.find(geojson_record)
+    m = expression(exp_alt).find(geojson_record)
     ret["geom_height"] = m[0].value if m else ""
     
-    m = exp_params_name.find(geojson_record)
+    m = expression(exp_params_name).find(geojson_record)
     ret["long_name"] = m[0].value if m else ""
     
-    m = exp_wsi.find(geojson_record)
+    m = expression(exp_wsi).find(geojson_record)
     ret["wsi"] = m[0].value if m else ""
     
-    m = exp_resultdate.find(geojson_record)
+    m = expression(exp_resultdate).find(geojson_record)
     ret["result_time"] = m[0].value if m else ""
     
-    m = exp_phendate.find(geojson_record)
+    m = expression(exp_phendate).find(geojson_record)
     ret["phenomenon_time"] = m[0].value if m else ""
     
-    m = exp_obsprop.find(geojson_record)
+    m = expression(exp_obsprop).find(geojson_record)
     ret["observed_property"] = m[0].value if m else ""
     
     return ret
@@ -81,6 +87,9 @@ def group_data(data):
 
     keys = ["wsi","result_time","phenomenon_time"]
 
+    # pandas and bufr2geojson are imported when the first bulletin is decoded, not at a cold start
+    import pandas as pd
+
     try:
         df = pd.DataFrame.from_records(data)
         grp = df.groupby(by=keys).agg( { "geom_lat" : "first" , "geom_lon" : "first", "geom_height" : "first", "observed_property" : list } )
@@ -126,21 +135,25 @@ def process_bufr(data):
 
     logger.debug("processing bufr record")
 
-    geo_bufr = as_geojson(  data  )
-
-    logger.debug("geojson record: {}".format(geo_bufr))
+    from bufr2geojson import transform as as_geojson
 
     ret = []
 
-    if geo_bufr:
+    # the bulletin is decoded by eccodes while the collections are iterated
+    with timed("bufr_decode"):
+        geo_bufr = as_geojson(  data  )
+
+        logger.debug("geojson record: {}".format(geo_bufr))
+
+        if geo_bufr:
 
-        for collection in geo_bufr:
-            for key, item in collection.items():
-                data = extract_info_from_geojson(item['geojson'])
-                ret.append( data )
+            for collection in geo_bufr:
+                for key, item in collection.items():
+                    data = extract_info_from_geojson(item['geojson'])
+                    ret.append( data )
 
-        if len(ret)>0:
-            ret = extract_variables(group_data(ret),filter_variables=True)
-            logger.debug(json.dumps(ret, indent=4))
+    if len(ret)>0:
+        ret = extract_variables(group_data(ret),filter_variables=True)
+        logger.debug(json.dumps(ret, indent=4))
 
     return ret
\ No newline at end of file
@@ -1,12 +1,10 @@
 import logging
 import sys
 import json
-import xmltodict
 import os
 import base64
-import boto3
 
-from wis2mon_lib import handle_content, serialize_wis2_message, kinesis_lambda_handler
+from wis2mon_lib import handle_content, serialize_wis2_message, kinesis_lambda_handler, timed, NonRecoverableError
 
 # Configure logging
 logger = logging.getLogger()
@@ -17,6 +15,11 @@ logger.setLevel(level)
 logging.getLogger("xml2dict").setLevel(logging.ERROR)
 
 firehose_name = os.getenv("FIREHOSE_NAME",None)
+dead_letter_name = os.getenv("DEAD_LETTER_FIREHOSE_NAME",None)
+worker_mode = os.getenv("WORKER_MODE", "serial")
+workers = int(os.getenv("WORKERS", "0")) or None
+prefetch = os.getenv("PREFETCH", "True").lower() in ('true', '1', 't', 'yes')
+prefetch_deadline = float(os.getenv("PREFETCH_DEADLINE", "30"))
 
 def extract_cap_infos(cap_message):
     logger.debug("processing cap {}".format(cap_message))
@@ -84,7 +87,14 @@ def process_cap(event):
 
     cap_infos = []
     if content:
-        cap = xmltodict.parse(content)
+        import xmltodict
+
+        try:
+            with timed("cap_parse"):
+                cap = xmltodict.parse(content)
+        except Exception as e:
+            # malformed XML, parsing it again gives the same error
+            raise NonRecoverableError(f"cannot parse CAP: {e}")
         cap = alter_keys(cap,remove_namespace)
         logger.debug("CAP as dict {}".format(cap))
 
@@ -113,7 +123,7 @@ def process_cap(event):
 def lambda_handler(event, context):
     """this functions receives kinesis records and extracts information about CAPs from it"""
     
-    return kinesis_lambda_handler(event,context,process_cap,firehose_name)
+    return kinesis_lambda_handler(event,context,process_cap,firehose_name,prefetch=prefetch,prefetch_deadline=prefetch_deadline,mode=worker_mode,workers=workers,dead_letter_name=dead_letter_name)
     
 
 
@@ -26,8 +26,12 @@ CREATE TABLE IF NOT EXISTS notifications (
     meta_validates BOOLEAN,
     meta_content_embedded BOOLEAN,
     meta_remote_content_size INT,
+    meta_integrity VARCHAR(20),
+    meta_replica VARCHAR(400),
+    meta_record_key VARCHAR(100),
     date_inserted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (id),
+    UNIQUE INDEX (meta_record_key),
     INDEX (date_inserted),
     INDEX (meta_topic),
     INDEX (meta_broker)
@@ -39,6 +43,14 @@ CREATE TABLE IF NOT EXISTS notifications (
 
 -- ALTER TABLE notifications ADD COLUMN meta_content_embedded BOOLEAN AFTER meta_cache_status;
 -- ALTER TABLE notifications ADD COLUMN meta_remote_content_size INT AFTER meta_content_embedded;
+-- needed by DB_INTEGRITY_COLUMNS of s3tords
+-- ALTER TABLE notifications ADD COLUMN meta_integrity VARCHAR(20) AFTER meta_remote_content_size;
+-- ALTER TABLE notifications ADD COLUMN meta_replica VARCHAR(400) AFTER meta_integrity;
+
+-- needed by DB_RECORD_KEY of s3tords, rows inserted before have no key
+-- ALTER TABLE notifications ADD COLUMN meta_record_key VARCHAR(100) AFTER meta_replica, ADD UNIQUE INDEX (meta_record_key);
+-- ALTER TABLE surfaceobservations ADD COLUMN meta_record_key VARCHAR(100) AFTER meta_topic, ADD UNIQUE INDEX (meta_record_key);
+-- ALTER TABLE caps ADD COLUMN meta_record_key VARCHAR(100) AFTER meta_topic, ADD UNIQUE INDEX (meta_record_key);
 
 
 CREATE TABLE IF NOT EXISTS surfaceobservations (
@@ -59,8 +71,10 @@ CREATE TABLE IF NOT EXISTS surfaceobservations (
     all_observed_properties TEXT,
     meta_broker VARCHAR(255),
     meta_topic VARCHAR(255),
+    meta_record_key VARCHAR(100),
     date_inserted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,   
     PRIMARY KEY (id),
+    UNIQUE INDEX (meta_record_key),
     INDEX (date_inserted),
     INDEX (meta_broker),
     INDEX (observed_property_pressure_reduced_to_mean_sea_level),
@@ -99,8 +113,10 @@ CREATE TABLE IF NOT EXISTS caps (
     cap_info_web VARCHAR(255),
     meta_broker VARCHAR(255),
     meta_topic VARCHAR(255),
+    meta_record_key VARCHAR(100),
     date_inserted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,   
     PRIMARY KEY (id),
+    UNIQUE INDEX (meta_record_key),
     INDEX (date_inserted),
     INDEX (meta_broker),
     INDEX (cap_sender),
@@ -0,0 +1,558 @@
+"""local benchmarks for the bridge. Does not need a Global Broker or AWS, e.g.
+
+python3 benchmark.py queue --messages 20000 --publish-latency 2 --workers 8
+python3 benchmark.py kinesis --messages 20000 --failure-rate 0.1 --shards 20
+python3 benchmark.py dedup --notifications 100000 --brokers 3
+python3 benchmark.py meta --messages 50000
+python3 benchmark.py spool --messages 20000 --outage 0.3:0.6
+python3 benchmark.py router --messages 500000
+python3 benchmark.py profile --messages 50000
+
+wis2mon_lib (../wis2mon-lib) must be installed, or on PYTHONPATH
+"""
+import argparse
+import base64
+import hashlib
+import os
+import json
+import logging
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+from datetime import datetime
+
+from worker_pool import WorkerPool
+from kinesis_output import KinesisPublisher
+from router import TopicRouter, topic_matches, rewrite_topic
+from dedup import Deduplicator, SeenSet
+from meta_injection import parse_object, extract_ids, inject_meta
+from spool import Spool, SpoolingPublisher
+
+from wis2mon_lib import ProfileWindow
+
+logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level="WARNING")
+
+Message = namedtuple("Message", ["topic", "payload"])
+
+SAMPLE_TOPIC = "cache/a/wis2/deu/dwd/data/core/weather/surface-based-observations/synop"
+SAMPLE_NOTIFICATION = {
+    "id": "0f3a4c9e-5b0a-4c2e-9f7b-2d6f1c8a9e11",
+    "type": "Feature",
+    "version": "v04",
+    "geometry": {"type": "Point", "coordinates": [13.4, 52.5, 34.0]},
+    "properties": {
+        "data_id": "wis2/de-dwd-gts-to-wis2/data/core/weather/surface-based-observations/synop/A_ISMD01EDZW181200_C_EDZW_20231018120000_12345678",
+        "datetime": "2023-10-18T12:00:00Z",
+        "pubtime": "2023-10-18T12:01:23Z",
+        "integrity": {"method": "sha512", "value": "A" * 86 + "=="},
+        "wigos_station_identifier": "0-20000-0-10384",
+    },
+    "links": [
+        {
+            "rel": "canonical",
+            "type": "application/x-bufr",
+            "href": "https://globalcache.example.int/de-dwd-gts-to-wis2/data/core/weather/surface-based-observations/synop/A_ISMD01EDZW181200_C_EDZW_20231018120000_12345678.bin",
+        }
+    ],
+}
+
+
+def sample_messages(n):
+    payload = json.dumps(SAMPLE_NOTIFICATION).encode("utf8")
+    return [Message(SAMPLE_TOPIC, payload) for _ in range(n)]
+
+
+class FakeBroker:
+    """stands in for paho's network loop: one thread that delivers messages to on_message back to back
+    and records how long each callback blocks the loop"""
+
+    def __init__(self, messages, on_message):
+        self.messages = messages
+        self.on_message = on_message
+        self.max_stall = 0.0
+        self.total_stall = 0.0
+
+    def run(self):
+        for msg in self.messages:
+            start = time.perf_counter()
+            self.on_message(None, None, msg)
+            stall = time.perf_counter() - start
+            self.total_stall += stall
+            self.max_stall = max(self.max_stall, stall)
+
+
+class FakePublisher:
+    """stands in for the AWS IoT connection, publish takes latency seconds"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload, qos=None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.published += 1
+
+
+def route(publisher, topic, payload, time_received):
+    """same work as wis2toaws.message_routing"""
+    topic_new = rewrite_topic(topic)
+    notification = parse_object(payload)
+    if notification is not None:
+        extract_ids(notification)
+    meta = {"time_received": time_received, "broker": "localhost", "topic": topic}
+    publisher.publish(topic=topic_new, payload=inject_meta(payload, meta))
+
+
+def report(name, n, elapsed, broker, extra=""):
+    print(f"{name:8s} {n} messages in {elapsed:.2f}s, {n / elapsed:10.0f} msg/s, "
+          f"loop stall total {broker.total_stall:.2f}s max {broker.max_stall * 1000:.1f}ms {extra}")
+
+
+def bench_queue(args):
+    messages = sample_messages(args.messages)
+
+    # inline: routing and publishing on the network thread, as before
+    publisher = FakePublisher(args.publish_latency / 1000)
+
+    def on_message_inline(client, userdata, msg):
+        route(publisher, msg.topic, msg.payload, datetime.now().isoformat())
+
+    broker = FakeBroker(messages, on_message_inline)
+    start = time.perf_counter()
+    broker.run()
+    report("inline", len(messages), time.perf_counter() - start, broker)
+
+    # staged: network thread enqueues, workers route and publish
+    publisher = FakePublisher(args.publish_latency / 1000)
+    pool = WorkerPool(lambda item: route(publisher, *item), num_workers=args.workers,
+                      max_size=args.queue_size, put_timeout=args.put_timeout, name="bench").start()
+
+    def on_message_queued(client, userdata, msg):
+        pool.submit((msg.topic, msg.payload, datetime.now().isoformat()))
+
+    broker = FakeBroker(messages, on_message_queued)
+    start = time.perf_counter()
+    broker.run()
+    pool.queue.join()
+    elapsed = time.perf_counter() - start
+    stats = pool.stats()
+    pool.stop()
+    report("queued", len(messages), elapsed, broker,
+           f"dropped {stats['dropped']} max depth {stats['max_depth']}")
+    assert stats["processed"] + stats["dropped"] == len(messages), "messages lost in the queue"
+
+    # shutdown while the output stalls and the queue is full must not hang
+    stalled = threading.Event()
+    pool = WorkerPool(lambda item: stalled.wait(), num_workers=2, max_size=10, put_timeout=0, name="stalled").start()
+    for i in range(20):
+        pool.submit(i)
+    start = time.perf_counter()
+    pool.stop(timeout=1)
+    stopped = time.perf_counter() - start
+    stalled.set()
+    assert stopped < 2, f"stop() blocked for {stopped:.1f}s on a full queue"
+    print(f"stop with a stalled output and a full queue returned after {stopped:.2f}s")
+
+
+class FakeKinesisClient:
+    """stands in for the boto3 kinesis client. put_records rejects a share of the records with
+    ProvisionedThroughputExceededException, like a throttled stream does, and enforces the API limits"""
+
+    def __init__(self, shards=1, failure_rate=0.0, latency=0.0):
+        self.shards = shards
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.requests = 0
+        self.records = {}
+        self.shard_counts = {}
+        self._lock = threading.Lock()
+
+    def shard_for(self, key):
+        h = int(hashlib.md5(key.encode("utf8")).hexdigest(), 16)
+        return h * self.shards >> 128
+
+    def put_records(self, StreamName, Records):
+        assert len(Records) <= 500, "more than 500 records in PutRecords"
+        assert sum(len(r["Data"]) + len(r["PartitionKey"]) for r in Records) <= 5 * 1024 * 1024, "PutRecords larger than 5 MB"
+        if self.latency:
+            time.sleep(self.latency)
+
+        results = []
+        failed = 0
+        with self._lock:
+            self.requests += 1
+            for r in Records:
+                if random.random() < self.failure_rate:
+                    failed += 1
+                    results.append({"ErrorCode": "ProvisionedThroughputExceededException", "ErrorMessage": "Rate exceeded"})
+                    continue
+                self.records.setdefault(StreamName, []).append(r["Data"])
+                shard = (StreamName, self.shard_for(r["PartitionKey"]))
+                self.shard_counts[shard] = self.shard_counts.get(shard, 0) + 1
+                results.append({"SequenceNumber": str(self.requests), "ShardId": f"shardId-{shard[1]:012d}"})
+        return {"FailedRecordCount": failed, "Records": results}
+
+
+def sample_topics():
+    """rewritten topics as published by the bridge"""
+    return [
+        "cache/deu/dwd/data/core/weather/surface-based-observations/synop",
+        "cache/fra/meteofrance/data/core/weather/surface-based-observations/synop",
+        "cache/int/swic/data/core/weather/advisories-warnings/cap",
+        "origin/bra/inmet/data/core/weather/surface-based-observations/synop",
+        "cache/chn/cma/data/core/weather/prediction/forecast/medium-range/deterministic",
+    ]
+
+
+def bench_kinesis(args):
+    client = FakeKinesisClient(shards=args.shards, failure_rate=args.failure_rate, latency=args.put_latency / 1000)
+    routes = [
+        ("cache/+/+/data/core/weather/surface-based-observations/synop", "surface-obs"),
+        ("cache/+/swic/data/core/weather/advisories-warnings/#", "cap"),
+        ("#", "notifications"),
+    ]
+    router = TopicRouter(routes)
+    publisher = KinesisPublisher(client, router.pipelines, flush_interval=args.flush_interval, max_retries=10)
+    for b in publisher.batchers.values():
+        b.backoff = 0.01
+
+    topics = sample_topics()
+    expected = {}
+    start = time.perf_counter()
+    for i in range(args.messages):
+        topic = topics[i % len(topics)]
+        n = dict(SAMPLE_NOTIFICATION)
+        n["properties"] = dict(n["properties"], data_id=f"{n['properties']['data_id']}_{i}")
+        publisher.publish(topic, json.dumps(n), n["properties"]["data_id"], router.match(topic))
+        for topic_filter, stream in routes:
+            if topic_matches(topic_filter, topic):
+                expected[stream] = expected.get(stream, 0) + 1
+    publisher.close()
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.messages} messages in {elapsed:.2f}s, {args.messages / elapsed:.0f} msg/s, {client.requests} PutRecords calls")
+    for stream, stats in publisher.stats().items():
+        if stream == "unrouted":
+            continue
+        delivered = len(client.records.get(stream, []))
+        shard_counts = [c for (s, _), c in client.shard_counts.items() if s == stream]
+        spread = f"shard min/max {min(shard_counts)}/{max(shard_counts)}" if shard_counts else ""
+        print(f"  {stream:14s} expected {expected.get(stream, 0)} delivered {delivered} {stats} {spread}")
+        assert delivered == expected.get(stream, 0) and not stats["failed"] and not stats["buffered"], \
+            f"{stream}: {delivered} of {expected.get(stream, 0)} messages delivered"
+        data_ids = {json.loads(data)["properties"]["data_id"] for data in client.records.get(stream, [])}
+        assert len(data_ids) == delivered, f"{stream}: messages delivered twice"
+
+
+def bench_dedup(args):
+    """every notification arrives once per broker, copies are interleaved within a small window"""
+    import tracemalloc
+
+    brokers = [f"gb{i}" for i in range(args.brokers)]
+    copies = []
+    for i in range(args.notifications):
+        n = {"id": f"id-{i}", "properties": {"data_id": f"{SAMPLE_NOTIFICATION['properties']['data_id']}_{i}"}}
+        for b in brokers:
+            copies.append((i + random.random() * args.window, b, n))
+    copies.sort(key=lambda c: c[0])
+
+    tracemalloc.start()
+    dedup = Deduplicator(SeenSet(ttl=args.ttl, max_entries=args.max_entries), policy="drop")
+    passed = 0
+    start = time.perf_counter()
+    for _, broker, n in copies:
+        if dedup.check(n["id"], n["properties"]["data_id"], broker) is None:
+            passed += 1
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{len(copies)} copies of {args.notifications} notifications in {elapsed:.2f}s, "
+          f"{len(copies) / elapsed:.0f} checks/s, passed {passed}, peak memory {peak / 1024 / 1024:.1f} MiB")
+    for broker, stats in dedup.stats().items():
+        print(f"  {broker}: {stats}")
+
+
+def full_parse(payload, meta):
+    """the former message_routing path"""
+    msg = json.loads(payload.decode("utf-8", "ignore"))
+    notification_id, data_id = msg.get("id"), (msg.get("properties") or {}).get("data_id")
+    msg["_meta"] = meta
+    return json.dumps(msg).encode("utf-8")
+
+
+def fast_path(payload, meta):
+    notification = parse_object(payload)
+    if notification is None:
+        return full_parse(payload, meta)
+    notification_id, data_id = extract_ids(notification)
+    return inject_meta(payload, meta)
+
+
+def bench_meta(args):
+    meta = {"time_received": datetime.now().isoformat(), "broker": "globalbroker.meteo.fr", "topic": SAMPLE_TOPIC}
+
+    embedded = json.loads(json.dumps(SAMPLE_NOTIFICATION))
+    embedded["properties"]["content"] = {"encoding": "base64", "size": args.content_size,
+                                         "value": base64.b64encode(os.urandom(args.content_size)).decode()}
+    samples = {
+        "link only": json.dumps(SAMPLE_NOTIFICATION).encode("utf8"),
+        f"embedded {args.content_size} bytes": json.dumps(embedded, indent=2).encode("utf8"),
+    }
+
+    # malformed objects are not spliced, ids are only taken from the top level
+    for malformed in (b'{"id": 1,}', b'{"a":{"b":1}', b'{"a": [1}', b'{"id": "x" "y"}'):
+        assert parse_object(malformed) is None, f"{malformed} accepted"
+    nested = b'{"links": [{"id": "L", "data_id": "d"}], "id": "N", "properties": {"data_id": "D"}}'
+    assert extract_ids(parse_object(nested)) == ("N", "D"), "ids read from a nested object"
+    assert extract_ids(parse_object(b'{"links": [{"id": "L"}]}')) == (None, None)
+
+    for name, payload in samples.items():
+        assert json.loads(fast_path(payload, meta)) == json.loads(full_parse(payload, meta))
+        results = []
+        for fn in (full_parse, fast_path):
+            start = time.perf_counter()
+            for _ in range(args.messages):
+                fn(payload, meta)
+            results.append(args.messages / (time.perf_counter() - start))
+        print(f"{name:24s} {len(payload):7d} bytes: full parse {results[0]:9.0f} msg/s, "
+              f"splice {results[1]:9.0f} msg/s, speedup {results[1] / results[0]:.1f}x")
+
+
+class FakeIotConnection:
+    """stands in for the AWS IoT connection. While down, published messages are lost like
+    messages published into an interrupted connection"""
+
+    def __init__(self):
+        self.up = True
+        self.delivered = set()
+        self.lost = 0
+        self.unrouted = 0
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload, data_id=None, pipelines=()):
+        with self._lock:
+            if not pipelines:
+                self.unrouted += 1
+            if self.up:
+                self.delivered.add(data_id)
+            else:
+                self.lost += 1
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def bench_spool(args):
+    outage_start, outage_end = (float(f) for f in args.outage.split(":"))
+    directory = tempfile.mkdtemp(prefix="wis2bridge-spool-")
+    try:
+        connection = FakeIotConnection()
+        spool = Spool(directory, segment_bytes=args.segment_bytes, max_bytes=args.max_bytes)
+        publisher = SpoolingPublisher(connection, spool, drain_rate=args.drain_rate)
+
+        payload = json.dumps(SAMPLE_NOTIFICATION).encode("utf8")
+        max_depth = 0
+        start = time.perf_counter()
+        for i in range(args.messages):
+            progress = i / args.messages
+            if connection.up and outage_start <= progress < outage_end:
+                # the connection drops, on_connection_interrupted fires a little later
+                connection.up = False
+                publisher.set_available(False)
+            elif not connection.up and progress >= outage_end:
+                connection.up = True
+                publisher.set_available(True)
+            publisher.publish("cache/deu/dwd/data/core/weather/surface-based-observations/synop", payload, str(i),
+                              ("surface-obs",))
+            max_depth = max(max_depth, spool.depth())
+            if args.rate:
+                time.sleep(1 / args.rate)
+        received = time.perf_counter() - start
+
+        while spool.depth() > 0 and time.perf_counter() - start < args.timeout:
+            time.sleep(0.1)
+        drained = time.perf_counter() - start
+        stats = spool.stats()
+        publisher.close()
+
+        print(f"{args.messages} messages, received in {received:.2f}s, spool drained after {drained:.2f}s")
+        print(f"  delivered {len(connection.delivered)} lost {connection.lost} max spool depth {max_depth} {stats}")
+        assert connection.lost == 0, "messages published into the interrupted connection"
+        assert len(connection.delivered) + stats["evicted"] + stats["dropped"] == args.messages, "messages lost"
+        assert connection.unrouted == 0, "pipelines of spooled messages lost"
+
+        # segments left by a previous run are drained after a restart
+        spool = Spool(directory, segment_bytes=args.segment_bytes, max_bytes=args.max_bytes)
+        for i in range(100):
+            spool.append("cache/deu/dwd/data/core/weather/surface-based-observations/synop", payload, f"r{i}", ("a", "b"))
+        spool.close()
+        spool = Spool(directory, segment_bytes=args.segment_bytes, max_bytes=args.max_bytes)
+        records = spool.read(1000)
+        spool.commit(len(records))
+        assert [r[2] for r in records] == [f"r{i}" for i in range(100)], "spooled messages not recovered in order"
+        assert all(r[3] == ("a", "b") and r[1] == payload for r in records), "spooled messages changed"
+        assert spool.depth() == 0
+        print(f"  restart: {len(records)} spooled messages recovered in order")
+    finally:
+        shutil.rmtree(directory)
+
+
+def wis2_topics(n, centres=300):
+    """n source topics with a distribution resembling WIS2 traffic, dominated by synop and temp from many centres"""
+    categories = [
+        ("data/core/weather/surface-based-observations/synop", 60),
+        ("data/core/weather/surface-based-observations/temp", 8),
+        ("data/core/weather/surface-based-observations/ship", 4),
+        ("data/core/weather/surface-based-observations/buoy", 4),
+        ("data/core/weather/aviation/metar", 8),
+        ("data/core/weather/prediction/forecast/medium-range/deterministic/global", 8),
+        ("data/core/weather/advisories-warnings", 3),
+        ("metadata", 5),
+    ]
+    names, weights = zip(*categories)
+    rng = random.Random(42)
+    ret = []
+    for _ in range(n):
+        centre = rng.randrange(centres)
+        category = rng.choices(names, weights)[0]
+        centre_path = "int/swic" if category.endswith("advisories-warnings") else f"c{centre % 120:03d}/centre{centre}"
+        channel = rng.choice(("cache", "origin"))
+        ret.append(f"{channel}/a/wis2/{centre_path}/{category}")
+    return ret
+
+
+def bench_router(args):
+    routes = [
+        ("cache/+/+/data/core/weather/surface-based-observations/synop", "surface-obs"),
+        ("cache/+/swic/data/core/weather/advisories-warnings/#", "cap"),
+    ]
+    if args.all_notifications:
+        routes.append(("#", "notifications"))
+    topics = wis2_topics(args.messages)
+
+    # before: rewrite every topic and test every filter
+    start = time.perf_counter()
+    routed = 0
+    for topic in topics:
+        topic_new = rewrite_topic(topic)
+        if [p for f, p in routes if topic_matches(f, topic_new)]:
+            routed += 1
+    before = time.perf_counter() - start
+
+    router = TopicRouter(routes)
+    start = time.perf_counter()
+    for topic in topics:
+        router.route(topic)
+    after = time.perf_counter() - start
+
+    stats = router.stats()
+    print(f"{len(topics)} messages, {stats['cached_topics']} distinct topics, {len(routes)} routes")
+    print(f"  split and match per message {len(topics) / before:10.0f} msg/s")
+    print(f"  compiled router             {len(topics) / after:10.0f} msg/s, speedup {before / after:.1f}x")
+    print(f"  routed {routed}, dropped before parsing {stats['dropped']} ({stats['dropped'] / len(topics):.0%}), hits {stats['hits']}")
+
+
+def bench_profile(args):
+    meta = {"time_received": datetime.now().isoformat(), "broker": "globalbroker.meteo.fr", "topic": SAMPLE_TOPIC}
+    payload = json.dumps(SAMPLE_NOTIFICATION).encode("utf8")
+    directory = tempfile.mkdtemp(prefix="wis2bridge-profile-")
+
+    def process(item):
+        full_parse(item, meta)
+
+    def run(name, window=None):
+        handler = window.wrap(process) if window else process
+        pool = WorkerPool(handler, num_workers=args.workers, max_size=args.messages, name="bench").start()
+        if window and name != "window closed":
+            window.begin()
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            pool.submit(payload)
+        pool.queue.join()
+        elapsed = time.perf_counter() - start
+        if window and name != "window closed":
+            window.end()
+        pool.stop()
+        print(f"  {name:24s} {args.messages / elapsed:9.0f} msg/s")
+
+    print(f"{args.workers} workers, profiles in {directory}")
+    run("not profiled")
+    run("window closed", ProfileWindow("cprofile", directory=directory))
+    run("sampling", ProfileWindow("sampling", directory=directory))
+    run("cprofile", ProfileWindow("cprofile", directory=directory))
+    run("cprofile + tracemalloc", ProfileWindow("cprofile", directory=directory, memory=True))
+    for name in sorted(os.listdir(directory)):
+        print(f"  {name} {os.path.getsize(os.path.join(directory, name))} bytes")
+    shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("queue", help="inline routing vs bounded worker queue")
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--publish-latency", type=float, default=1.0, help="simulated publish latency in ms")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--queue-size", type=int, default=10000)
+    p.add_argument("--put-timeout", type=float, default=1.0)
+    p.set_defaults(func=bench_queue)
+
+    p = sub.add_parser("kinesis", help="direct Kinesis output against a local stand-in with partial failures")
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--shards", type=int, default=20)
+    p.add_argument("--failure-rate", type=float, default=0.05, help="share of records rejected per PutRecords call")
+    p.add_argument("--put-latency", type=float, default=5.0, help="simulated PutRecords latency in ms")
+    p.add_argument("--flush-interval", type=float, default=1.0)
+    p.set_defaults(func=bench_kinesis)
+
+    p = sub.add_parser("dedup", help="cross-broker duplicate suppression")
+    p.add_argument("--notifications", type=int, default=100000)
+    p.add_argument("--brokers", type=int, default=3)
+    p.add_argument("--window", type=float, default=50, help="copies of a notification arrive within this many notifications")
+    p.add_argument("--ttl", type=int, default=3600)
+    p.add_argument("--max-entries", type=int, default=200000)
+    p.set_defaults(func=bench_dedup)
+
+    p = sub.add_parser("meta", help="full parse vs splicing _meta into the raw payload")
+    p.add_argument("--messages", type=int, default=50000)
+    p.add_argument("--content-size", type=int, default=8192, help="size of embedded content in bytes")
+    p.set_defaults(func=bench_meta)
+
+    p = sub.add_parser("spool", help="simulated AWS outage with the disk spool")
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--outage", default="0.3:0.6", help="outage as start:end fraction of the messages")
+    p.add_argument("--rate", type=float, default=0, help="incoming messages per second, 0 for as fast as possible")
+    p.add_argument("--drain-rate", type=float, default=5000)
+    p.add_argument("--segment-bytes", type=int, default=1024 * 1024)
+    p.add_argument("--max-bytes", type=int, default=256 * 1024 * 1024)
+    p.add_argument("--timeout", type=float, default=60)
+    p.set_defaults(func=bench_spool)
+
+    p = sub.add_parser("router", help="per message topic rewrite and matching vs compiled router")
+    p.add_argument("--messages", type=int, default=500000)
+    p.add_argument("--all-notifications", action="store_true", help="also route everything to the notifications pipeline")
+    p.set_defaults(func=bench_router)
+
+    p = sub.add_parser("profile", help="routing throughput outside and inside a profiling window")
+    p.add_argument("--messages", type=int, default=50000)
+    p.add_argument("--workers", type=int, default=4)
+    p.set_defaults(func=bench_profile)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
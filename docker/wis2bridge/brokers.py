@@ -0,0 +1,80 @@
+import logging
+import threading
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class Broker:
+    """configuration and health of the subscription to one Global Broker"""
+
+    def __init__(self, host, port, username=None, password=None, topics=None, name=None):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.topics = topics or ["cache/a/wis2/#"]
+        self.name = name or host
+
+        self._lock = threading.Lock()
+        self.connected = False
+        self.connects = 0
+        self.disconnects = 0
+        self.received = 0
+        self.last_message = None
+        self._rate_count = 0
+        self._rate_start = time.monotonic()
+
+    def on_connect(self):
+        with self._lock:
+            self.connected = True
+            self.connects += 1
+
+    def on_disconnect(self):
+        with self._lock:
+            self.connected = False
+            self.disconnects += 1
+
+    def on_message(self):
+        with self._lock:
+            self.received += 1
+            self._rate_count += 1
+            self.last_message = time.time()
+
+    def stats(self):
+        """health of the subscription, the message rate is computed since the previous call"""
+        now = time.monotonic()
+        with self._lock:
+            rate = self._rate_count / (now - self._rate_start) if now > self._rate_start else 0.0
+            self._rate_count = 0
+            self._rate_start = now
+            return {
+                "connected": self.connected,
+                "reconnects": max(self.connects - 1, 0),
+                "disconnects": self.disconnects,
+                "received": self.received,
+                "rate": round(rate, 2),
+                "seconds_since_last_message": round(time.time() - self.last_message, 1) if self.last_message else None,
+            }
+
+    def __repr__(self):
+        return f"Broker({self.name}, {self.host}:{self.port}, {self.topics})"
+
+
+def load_brokers():
+    """brokers from WIS_BROKERS, a JSON list like
+    [{"host": "globalbroker.meteo.fr", "port": 443, "username": "everyone", "password": "everyone", "topics": ["cache/a/wis2/#"]}],
+    or the single broker given by WIS_BROKER_HOST, WIS_BROKER_PORT, WIS_USERNAME, WIS_PASSWORD and TOPICS"""
+    default_topics = [t.strip() for t in os.getenv("TOPICS", "cache/a/wis2/#").split(",")]
+
+    brokers = os.getenv("WIS_BROKERS")
+    if brokers:
+        return [
+            Broker(b["host"], b["port"], b.get("username"), b.get("password"), b.get("topics", default_topics), b.get("name"))
+            for b in json.loads(brokers)
+        ]
+
+    return [Broker(os.getenv("WIS_BROKER_HOST"), os.getenv("WIS_BROKER_PORT"),
+                   os.getenv("WIS_USERNAME"), os.getenv("WIS_PASSWORD"), default_topics)]
@@ -0,0 +1,92 @@
+import logging
+import threading
+import hashlib
+import base64
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class S3Store:
+    """stores offloaded content in S3, referenced as s3://bucket/key"""
+
+    def __init__(self, s3_client, bucket, prefix="claim-check/"):
+        self.client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, name, data):
+        key = self.prefix + name
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        return f"s3://{self.bucket}/{key}"
+
+
+class LocalStore:
+    """stores offloaded content in a local directory, referenced as file:///path. Stand-in for S3 in tests"""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def put(self, name, data):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return "file://" + path
+
+
+class ClaimCheck:
+    """moves embedded content of notifications larger than threshold bytes into a store.
+    properties.content.value is replaced by properties.content.ref, the URI of the decoded content,
+    which wis2mon_lib.handle_content resolves"""
+
+    def __init__(self, store, threshold=64 * 1024):
+        self.store = store
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.offloaded = 0
+        self.bytes_offloaded = 0
+        self.failed = 0
+
+    def applies(self, payload):
+        return len(payload) > self.threshold
+
+    def offload(self, notification):
+        """replace the embedded content of a parsed notification by a reference. Returns True if it was offloaded.
+        If the content cannot be decoded or stored the notification is left unchanged, so it is published inline"""
+        content = (notification.get("properties") or {}).get("content")
+        if not isinstance(content, dict) or "value" not in content:
+            return False
+
+        encoding = str(content.get("encoding", "base64")).lower()
+        try:
+            if encoding == "base64":
+                data = base64.b64decode(content["value"])
+            elif encoding in ("utf8", "utf-8"):
+                data = content["value"].encode("utf8")
+            else:
+                logger.warning(f"cannot offload content with encoding {encoding}")
+                return False
+
+            # content addressed, so copies from several brokers are stored once
+            ref = self.store.put(hashlib.sha256(data).hexdigest(), data)
+        except Exception as e:
+            logger.error(f"cannot offload content, publishing it inline: {e}")
+            with self._lock:
+                self.failed += 1
+            return False
+        del content["value"]
+        content["ref"] = ref
+
+        with self._lock:
+            self.offloaded += 1
+            self.bytes_offloaded += len(data)
+        logger.debug(f"offloaded {len(data)} bytes of content to {ref}")
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"offloaded": self.offloaded, "bytes_offloaded": self.bytes_offloaded, "failed": self.failed}
@@ -0,0 +1,103 @@
+import logging
+import threading
+import hashlib
+import time
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("off", "drop", "annotate")
+
+
+class SeenSet:
+    """memory bounded set of recently seen keys. Keys are stored as 16 byte digests, expire ttl seconds
+    after they were first seen and the oldest keys are evicted once max_entries is reached.
+    Thread safe, so one instance can be shared by several broker subscriptions"""
+
+    def __init__(self, ttl=3600, max_entries=200000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+        self.expired = 0
+
+    def add(self, key, value):
+        """remember key, returns the value stored when the key was first seen or None if the key is new"""
+        digest = hashlib.md5(key.encode("utf8")).digest()
+        now = self.clock()
+
+        with self._lock:
+            self._expire(now)
+
+            entry = self._entries.get(digest)
+            if entry is not None:
+                return entry[1]
+
+            if len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+            self._entries[digest] = (now + self.ttl, value)
+            return None
+
+    def _expire(self, now):
+        # entries are kept in insertion order and all have the same ttl, so the oldest expire first
+        while self._entries:
+            digest, (expires, _) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            del self._entries[digest]
+            self.expired += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def notification_key(notification_id, data_id):
+    return "{}|{}".format(notification_id, data_id)
+
+
+class Deduplicator:
+    """suppresses copies of a notification received from several Global Brokers.
+    With policy "drop" only the first copy is passed on, with "annotate" all copies are passed on
+    and later copies are marked in _meta"""
+
+    def __init__(self, seen, policy="drop"):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown deduplication policy {policy}, use one of {POLICIES}")
+        self.seen = seen
+        self.policy = policy
+        self._lock = threading.Lock()
+        self.received = {}
+        self.duplicates = {}
+
+    def check(self, notification_id, data_id, broker):
+        """returns the broker which delivered the first copy if the notification is a duplicate, otherwise None.
+        Notifications without an id cannot be told apart and are never duplicates"""
+        if notification_id is None:
+            first_broker = None
+        else:
+            first_broker = self.seen.add(notification_key(notification_id, data_id), broker)
+
+        with self._lock:
+            self.received[broker] = self.received.get(broker, 0) + 1
+            if first_broker is not None:
+                self.duplicates[broker] = self.duplicates.get(broker, 0) + 1
+
+        return first_broker
+
+    def stats(self):
+        with self._lock:
+            ret = {
+                broker: {
+                    "received": received,
+                    "duplicates": self.duplicates.get(broker, 0),
+                    "duplicate_ratio": round(self.duplicates.get(broker, 0) / received, 4),
+                }
+                for broker, received in self.received.items()
+            }
+        ret["seen_entries"] = len(self.seen)
+        ret["seen_evicted"] = self.seen.evicted
+        return ret
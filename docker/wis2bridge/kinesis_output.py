@@ -0,0 +1,183 @@
+import logging
+import threading
+import hashlib
+import random
+import time
+import json
+import os
+
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+# limits of the Kinesis PutRecords API
+MAX_RECORDS_PER_REQUEST = 500
+MAX_BYTES_PER_REQUEST = 5 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1024 * 1024
+
+
+def partition_key(data_id):
+    """hash the data_id so that records are spread evenly over the shards"""
+    if not data_id:
+        return uuid4().hex
+    return hashlib.md5(data_id.encode("utf8")).hexdigest()
+
+
+def load_kinesis_routes():
+    """routing table from KINESIS_ROUTES (JSON list of {"topic": filter, "stream": name}) or
+    the default pipelines, which mirror the IoT topic rules of the stack"""
+    routes = os.getenv("KINESIS_ROUTES")
+    if routes:
+        return [(r["topic"], r["stream"]) for r in json.loads(routes)]
+
+    defaults = [
+        ("cache/+/+/data/core/weather/surface-based-observations/synop", os.getenv("KINESIS_STREAM_SURFACEOBS")),
+        ("cache/+/swic/data/core/weather/advisories-warnings/#", os.getenv("KINESIS_STREAM_CAP")),
+        ("#", os.getenv("KINESIS_STREAM_NOTIFICATIONS")),
+    ]
+    return [(topic_filter, stream) for topic_filter, stream in defaults if stream]
+
+
+class KinesisBatcher:
+    """aggregates records for one stream into PutRecords calls. A batch is sent once it reaches
+    500 records or 5 MB, or flush_interval seconds after the previous flush"""
+
+    def __init__(self, kinesis_client, stream_name, flush_interval=1.0, max_retries=5, backoff=0.1):
+        self.client = kinesis_client
+        self.stream_name = stream_name
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._lock = threading.Lock()
+        self._records = []
+        self._bytes = 0
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.requests = 0
+
+    def put(self, data, key):
+        """add a record, sends the batch in the calling thread if it is full"""
+        size = len(data) + len(key.encode("utf8"))
+        if size > MAX_BYTES_PER_RECORD:
+            logger.error(f"record of {size} bytes exceeds the Kinesis record limit, discarding")
+            with self._lock:
+                self.failed += 1
+            return
+
+        batch = None
+        with self._lock:
+            if self._bytes + size > MAX_BYTES_PER_REQUEST:
+                batch = self._take()
+            self._records.append({"Data": data, "PartitionKey": key})
+            self._bytes += size
+            if len(self._records) >= MAX_RECORDS_PER_REQUEST:
+                full = self._take()
+                batch = batch + full if batch else full
+
+        if batch:
+            self._send(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def _take(self):
+        records = self._records
+        self._records = []
+        self._bytes = 0
+        return records
+
+    def _send(self, records):
+        # a batch taken on a size overflow plus a full one can exceed the count limit
+        for i in range(0, len(records), MAX_RECORDS_PER_REQUEST):
+            self._put_records(records[i:i + MAX_RECORDS_PER_REQUEST])
+
+    def _put_records(self, records):
+        """send records, retrying only the entries which failed"""
+        attempt = 0
+        while records:
+            try:
+                with self._lock:
+                    self.requests += 1
+                response = self.client.put_records(StreamName=self.stream_name, Records=records)
+                failed = [r for r, result in zip(records, response["Records"]) if "ErrorCode" in result]
+            except Exception as e:
+                logger.warning(f"PutRecords to {self.stream_name} failed: {e}")
+                failed = records
+
+            with self._lock:
+                self.sent += len(records) - len(failed)
+
+            if not failed:
+                return
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error(f"giving up on {len(failed)} records for {self.stream_name} after {self.max_retries} retries")
+                with self._lock:
+                    self.failed += len(failed)
+                return
+
+            with self._lock:
+                self.retried += len(failed)
+            logger.debug(f"retrying {len(failed)} of {len(records)} records for {self.stream_name}")
+            time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            records = failed
+
+    def stats(self):
+        with self._lock:
+            return {"sent": self.sent, "failed": self.failed, "retried": self.retried,
+                    "requests": self.requests, "buffered": len(self._records)}
+
+
+class KinesisPublisher:
+    """publishes bridge messages straight into the Kinesis streams of the pipelines instead of IoT Core"""
+
+    def __init__(self, kinesis_client, streams, flush_interval=1.0, max_retries=5):
+        self.flush_interval = flush_interval
+        self.batchers = {stream: KinesisBatcher(kinesis_client, stream, flush_interval, max_retries)
+                         for stream in streams}
+        self.unrouted = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="kinesis-flush", daemon=True)
+        self._thread.start()
+
+    def publish(self, topic, payload, data_id=None, pipelines=()):
+        """write the message to the streams given as pipelines by the TopicRouter"""
+        streams = pipelines
+        if not streams:
+            logger.debug(f"no stream for topic {topic}")
+            self.unrouted += 1
+            return
+
+        data = payload.encode("utf8") if isinstance(payload, str) else payload
+        key = partition_key(data_id)
+        for stream in streams:
+            self.batchers[stream].put(data, key)
+
+    def flush(self):
+        for batcher in self.batchers.values():
+            batcher.flush()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"error flushing to Kinesis {e}", exc_info=True)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def stats(self):
+        ret = {stream: batcher.stats() for stream, batcher in self.batchers.items()}
+        ret["unrouted"] = self.unrouted
+        return ret
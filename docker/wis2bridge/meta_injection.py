@@ -0,0 +1,29 @@
+import json
+
+_WHITESPACE = b" \t\r\n"
+
+
+def parse_object(payload):
+    """the JSON object in payload, or None if the payload is not valid UTF-8 JSON or not an object.
+    The object is parsed to validate it and to read its ids, only the re-encoding is saved by inject_meta"""
+    try:
+        notification = json.loads(payload.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    return notification if isinstance(notification, dict) else None
+
+
+def extract_ids(notification):
+    """returns (id, data_id) of a notification, only the top-level id and properties.data_id"""
+    properties = notification.get("properties")
+    return notification.get("id"), properties.get("data_id") if isinstance(properties, dict) else None
+
+
+def inject_meta(payload, meta):
+    """add a "_meta" member to the raw JSON object in payload by splicing it in before the closing brace.
+    If the object already has a _meta member the appended one wins when parsed, like assigning the key.
+    The payload must have been parsed by parse_object()"""
+    payload = payload.strip(_WHITESPACE)
+    body = payload[:-1].rstrip(_WHITESPACE)
+    separator = b"" if body == b"{" else b","
+    return b"".join((body, separator, b'"_meta":', json.dumps(meta).encode("utf-8"), b"}"))
@@ -0,0 +1,118 @@
+import logging
+import threading
+import json
+import os
+
+from wis2mon_lib import topic_matches
+
+logger = logging.getLogger(__name__)
+
+
+def rewrite_topic(topic):
+    """shorten a WIS2 topic to the depth supported by AWS IoT"""
+    topic_levels = topic.split("/")
+
+    # only take levels 4 to 12, if they are there. Levels 1-3 are fix for the moment
+    topic_new = "/".join(topic_levels[3:9]) if len(topic_levels) > 10 else "/".join(topic_levels[3:])
+    return topic_levels[0] + "/" + topic_new
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie:
+    """topic filters stored by level, so that a topic is matched against all filters in one walk"""
+
+    def __init__(self):
+        self.root = _Node()
+
+    def insert(self, topic_filter, value):
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.values.append(value)
+
+    def match(self, topic):
+        """values of all filters matching topic"""
+        levels = topic.split("/")
+        ret = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, i = stack.pop()
+            wildcard = node.children.get("#")
+            if wildcard:
+                ret.extend(wildcard.values)
+            if i == len(levels):
+                ret.extend(node.values)
+                continue
+            for key in (levels[i], "+"):
+                child = node.children.get(key)
+                if child:
+                    stack.append((child, i + 1))
+        return ret
+
+
+def load_routes(default_pipeline="iot"):
+    """routing table from ROUTES (JSON list of {"topic": filter, "pipeline": name}). Without it every topic
+    is routed to default_pipeline"""
+    routes = os.getenv("ROUTES")
+    if routes:
+        return [(r["topic"], r["pipeline"]) for r in json.loads(routes)]
+    return [("#", default_pipeline)]
+
+
+class TopicRouter:
+    """decides the rewritten topic and target pipelines of a message from its source topic.
+    Filters are matched against the rewritten topic and compiled into a trie at startup,
+    the result is cached per distinct source topic"""
+
+    def __init__(self, routes, cache_size=100000):
+        self.routes = routes
+        self.cache_size = cache_size
+
+        self.trie = TopicTrie()
+        self.pipelines = []
+        for i, (topic_filter, pipeline) in enumerate(routes):
+            self.trie.insert(topic_filter, (i, pipeline))
+            if pipeline not in self.pipelines:
+                self.pipelines.append(pipeline)
+
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.hits = {pipeline: 0 for pipeline in self.pipelines}
+        self.dropped = 0
+
+    def match(self, topic_new):
+        """pipelines for a rewritten topic, in the order of the routing table"""
+        ret = []
+        for _, pipeline in sorted(self.trie.match(topic_new)):
+            if pipeline not in ret:
+                ret.append(pipeline)
+        return tuple(ret)
+
+    def route(self, topic):
+        """returns (rewritten topic, pipelines) for a source topic. No pipelines means the message can be dropped"""
+        entry = self._cache.get(topic)
+        if entry is None:
+            topic_new = rewrite_topic(topic)
+            entry = (topic_new, self.match(topic_new))
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[topic] = entry
+
+        with self._lock:
+            if entry[1]:
+                for pipeline in entry[1]:
+                    self.hits[pipeline] += 1
+            else:
+                self.dropped += 1
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {"hits": dict(self.hits), "dropped": self.dropped, "cached_topics": len(self._cache)}
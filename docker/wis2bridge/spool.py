@@ -0,0 +1,270 @@
+import logging
+import threading
+import struct
+import mmap
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# record: topic length, data_id length, payload length, followed by the three byte strings.
+# The pipelines of the message follow the topic, each after a NUL which MQTT topics cannot contain
+_HEADER = struct.Struct(">III")
+_PIPELINE_SEPARATOR = "\0"
+_PREFIX = "segment-"
+_SUFFIX = ".spool"
+
+
+class Spool:
+    """disk backed append-only queue of messages, stored in segment files.
+    Writes append to the active segment, reads memory-map the oldest closed segment and delete it once drained.
+    If the spool grows beyond max_bytes the oldest segment is evicted. Segments left over from a previous run
+    are picked up again, so messages are delivered at least once"""
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._closed = []      # [path, size, records] of closed segments, oldest first
+        self._active = None
+        self._active_path = None
+        self._active_size = 0
+        self._active_records = 0
+        self._reading = None   # path of the segment being drained
+        self._read_offset = 0
+        self._read_count = 0
+        self._pending_ends = []
+        self._sequence = 0
+
+        self.spooled = 0
+        self.drained = 0
+        self.evicted = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def _recover(self):
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith(_PREFIX) and n.endswith(_SUFFIX))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            records, size = 0, 0
+            for _, end in self._iterate(path, 0):
+                records, size = records + 1, end
+            if records:
+                # a truncated record at the end of the segment is ignored
+                self._closed.append([path, size, records])
+            else:
+                os.remove(path)
+            self._sequence = max(self._sequence, int(name[len(_PREFIX):-len(_SUFFIX)]))
+        if names:
+            logger.info(f"recovered {len(names)} spool segments with {self.depth()} messages from {self.directory}")
+
+    def _open_segment(self):
+        self._sequence += 1
+        self._active_path = os.path.join(self.directory, f"{_PREFIX}{self._sequence:012d}{_SUFFIX}")
+        self._active = open(self._active_path, "ab")
+        self._active_size = 0
+        self._active_records = 0
+
+    def _close_segment(self):
+        if self._active is None:
+            return
+        self._active.close()
+        if self._active_records:
+            self._closed.append([self._active_path, self._active_size, self._active_records])
+        else:
+            os.remove(self._active_path)
+        self._active = None
+
+    def append(self, topic, payload, data_id=None, pipelines=()):
+        topic = _PIPELINE_SEPARATOR.join((topic,) + tuple(pipelines)).encode("utf-8")
+        data_id = (data_id or "").encode("utf-8")
+        payload = payload.encode("utf-8") if isinstance(payload, str) else payload
+        record = b"".join((_HEADER.pack(len(topic), len(data_id), len(payload)), topic, data_id, payload))
+
+        with self._lock:
+            while self._size() + len(record) > self.max_bytes:
+                if not self._evict():
+                    self.dropped += 1
+                    logger.error("spool full, dropping message")
+                    return False
+
+            if self._active is None or self._active_size + len(record) > self.segment_bytes:
+                self._close_segment()
+                self._open_segment()
+
+            self._active.write(record)
+            self._active.flush()
+            self._active_size += len(record)
+            self._active_records += 1
+            self.spooled += 1
+        return True
+
+    def _evict(self):
+        """remove the oldest segment which is not being drained"""
+        for i, (path, size, records) in enumerate(self._closed):
+            if path == self._reading:
+                continue
+            os.remove(path)
+            del self._closed[i]
+            self.evicted += records
+            logger.warning(f"spool exceeds {self.max_bytes} bytes, evicted {records} messages in {path}")
+            return True
+        return False
+
+    def _size(self):
+        return sum(s[1] for s in self._closed) + (self._active_size if self._active else 0)
+
+    def read(self, max_records):
+        """returns up to max_records (topic, payload, data_id, pipelines) tuples from the oldest segment, without removing them.
+        Call commit() once they have been published"""
+        with self._lock:
+            if not self._closed and self._active_records:
+                # only the active segment holds messages, close it so that it can be read
+                self._close_segment()
+            if not self._closed:
+                return []
+            self._reading = self._closed[0][0]
+            offset = self._read_offset
+
+        ret = []
+        self._pending_ends = []
+        for record, end in self._iterate(self._reading, offset):
+            ret.append(record)
+            self._pending_ends.append(end)
+            if len(ret) >= max_records:
+                break
+        return ret
+
+    def commit(self, count):
+        """mark the first count records returned by the last read() as published"""
+        if count <= 0:
+            return
+        with self._lock:
+            self.drained += count
+            self._read_count += count
+            self._read_offset = self._pending_ends[count - 1]
+            self._pending_ends = []
+            path, size, records = self._closed[0]
+            if self._read_offset >= size:
+                os.remove(path)
+                self._closed.pop(0)
+                self._reading = None
+                self._read_offset = 0
+                self._read_count = 0
+
+    def _iterate(self, path, offset):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                while offset + _HEADER.size <= size:
+                    topic_len, data_id_len, payload_len = _HEADER.unpack_from(m, offset)
+                    start = offset + _HEADER.size
+                    end = start + topic_len + data_id_len + payload_len
+                    if end > size:
+                        logger.error(f"truncated record in {path} at {offset}")
+                        return
+                    topic, *pipelines = m[start:start + topic_len].decode("utf-8").split(_PIPELINE_SEPARATOR)
+                    data_id = m[start + topic_len:start + topic_len + data_id_len].decode("utf-8") or None
+                    payload = m[start + topic_len + data_id_len:end]
+                    offset = end
+                    yield (topic, payload, data_id, tuple(pipelines)), end
+
+    def depth(self):
+        return sum(s[2] for s in self._closed) + (self._active_records if self._active else 0) - self._read_count
+
+    def stats(self):
+        with self._lock:
+            return {
+                "depth": self.depth(),
+                "bytes": self._size(),
+                "segments": len(self._closed) + (1 if self._active else 0),
+                "spooled": self.spooled,
+                "drained": self.drained,
+                "evicted": self.evicted,
+                "dropped": self.dropped,
+            }
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+
+class SpoolingPublisher:
+    """wraps a publisher and spools messages while its connection is down.
+    After the connection is back new messages are published directly, while a background thread
+    drains the spool at drain_rate messages per second"""
+
+    def __init__(self, publisher, spool, drain_rate=100, drain_batch=100):
+        self.publisher = publisher
+        self.spool = spool
+        self.drain_rate = drain_rate
+        self.drain_batch = drain_batch
+
+        self.available = threading.Event()
+        self.available.set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._drain, name="spool-drain", daemon=True)
+        self._thread.start()
+
+    def set_available(self, available):
+        if available:
+            logger.info(f"output available, draining {self.spool.depth()} spooled messages")
+            self.available.set()
+        else:
+            logger.warning("output unavailable, spooling messages")
+            self.available.clear()
+
+    def publish(self, topic, payload, data_id=None, pipelines=()):
+        if self.available.is_set():
+            try:
+                self.publisher.publish(topic, payload, data_id, pipelines)
+                return
+            except Exception as e:
+                logger.error(f"publishing failed, spooling message {e}")
+        self.spool.append(topic, payload, data_id, pipelines)
+
+    def _drain(self):
+        while not self._stop.is_set():
+            if not self.available.wait(1):
+                continue
+            records = self.spool.read(self.drain_batch)
+            if not records:
+                self._stop.wait(1)
+                continue
+
+            start = time.monotonic()
+            published = 0
+            for topic, payload, data_id, pipelines in records:
+                if not self.available.is_set():
+                    break
+                try:
+                    self.publisher.publish(topic, payload, data_id, pipelines)
+                except Exception as e:
+                    logger.error(f"publishing spooled message failed {e}")
+                    break
+                published += 1
+
+            # only the published prefix is committed, the rest is read again
+            self.spool.commit(published)
+
+            # rate limit the drain so that it does not starve new traffic
+            delay = published / self.drain_rate - (time.monotonic() - start) if self.drain_rate else 0
+            if delay > 0:
+                self._stop.wait(delay)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.spool.close()
+        self.publisher.close()
+
+    def stats(self):
+        ret = self.publisher.stats()
+        ret["spool"] = self.spool.stats()
+        return ret
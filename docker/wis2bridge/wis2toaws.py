@@ -21,6 +21,17 @@ from uuid import uuid4
 from awscrt import mqtt
 from awsiot import mqtt_connection_builder
 
+from worker_pool import WorkerPool
+from brokers import load_brokers
+from kinesis_output import KinesisPublisher, load_kinesis_routes
+from router import TopicRouter, load_routes
+from dedup import Deduplicator, SeenSet
+from meta_injection import parse_object, extract_ids, inject_meta
+from spool import Spool, SpoolingPublisher
+from claim_check import ClaimCheck, S3Store, LocalStore
+
+from wis2mon_lib import Metrics, ProfileWindow, encode_record, WIRE_FORMATS
+
 from paho.mqtt.properties import Properties
 from paho.mqtt.packettypes import PacketTypes
 
@@ -40,41 +51,113 @@ def get_random_string(length):
     return result_str
 
 
-topics = [t.strip() for t in os.getenv("TOPICS","cache/a/wis2/#").split(",")]
-wis_broker_host = os.getenv("WIS_BROKER_HOST")
-wis_broker_port = int(os.getenv("WIS_BROKER_PORT"))
-wis_user = os.getenv("WIS_USERNAME")
-wis_pw = os.getenv("WIS_PASSWORD")
+brokers = load_brokers()
 client_id = os.getenv("CLIENT_ID") + get_random_string(6)
 aws_broker = os.getenv("AWS_BROKER")
 
+queue_size = int(os.getenv("QUEUE_SIZE","10000"))
+queue_put_timeout = float(os.getenv("QUEUE_PUT_TIMEOUT","1"))
+worker_threads = int(os.getenv("WORKER_THREADS","4"))
+stats_interval = int(os.getenv("STATS_INTERVAL","60"))
+
+# "iot" publishes to AWS IoT Core, "kinesis" writes directly into the Kinesis streams of the pipelines
+output_mode = os.getenv("OUTPUT_MODE","iot").lower()
+kinesis_flush_interval = float(os.getenv("KINESIS_FLUSH_INTERVAL","1"))
+kinesis_max_retries = int(os.getenv("KINESIS_MAX_RETRIES","5"))
+kinesis_endpoint_url = os.getenv("KINESIS_ENDPOINT_URL")
+
+# "off", "drop" (pass the first copy of a notification only) or "annotate" (mark later copies in _meta)
+dedup_policy = os.getenv("DEDUP_POLICY","off").lower()
+dedup_ttl = int(os.getenv("DEDUP_TTL","3600"))
+dedup_max_entries = int(os.getenv("DEDUP_MAX_ENTRIES","200000"))
+
+# splice _meta into the raw payload instead of parsing and re-serializing the notification
+fast_meta = os.getenv("FAST_META","True").lower() in ('true', '1', 't', 'yes')
+
+# "json" or "msgpack", the compact encoding is decoded by wis2mon_lib.decode_record
+wire_format = os.getenv("WIRE_FORMAT","json").lower()
+if wire_format not in WIRE_FORMATS:
+    raise Exception(f"unknown WIRE_FORMAT {wire_format}, use one of {WIRE_FORMATS}")
+
+# spool messages to disk while the AWS connection is interrupted, disabled if SPOOL_DIR is not set
+spool_dir = os.getenv("SPOOL_DIR")
+spool_max_bytes = int(os.getenv("SPOOL_MAX_BYTES",str(1024*1024*1024)))
+spool_segment_bytes = int(os.getenv("SPOOL_SEGMENT_BYTES",str(16*1024*1024)))
+spool_drain_rate = float(os.getenv("SPOOL_DRAIN_RATE","100"))
+
+# throughput and latency metrics, written as CloudWatch EMF lines to stdout
+metrics_enabled = os.getenv("METRICS","True").lower() in ('true', '1', 't', 'yes')
+metrics_interval = int(os.getenv("METRICS_INTERVAL","60"))
+metrics_namespace = os.getenv("METRICS_NAMESPACE","WIS2monitoring")
+
+metrics = Metrics(namespace=metrics_namespace, interval=metrics_interval, Service="wis2bridge") if metrics_enabled else None
+
+# move embedded content of large notifications to S3 (or a local directory) and reference it instead
+claim_check_bucket = os.getenv("CLAIM_CHECK_BUCKET")
+claim_check_prefix = os.getenv("CLAIM_CHECK_PREFIX","claim-check/")
+claim_check_dir = os.getenv("CLAIM_CHECK_DIR")
+claim_check_threshold = int(os.getenv("CLAIM_CHECK_THRESHOLD",str(64*1024)))
+
+# profile the bridge for PROFILE_SECONDS every PROFILE_EVERY_SECONDS, off by default
+profile_kind = os.getenv("PROFILE","off").lower()
+profile_seconds = float(os.getenv("PROFILE_SECONDS","30"))
+profile_every_seconds = float(os.getenv("PROFILE_EVERY_SECONDS","3600"))
+profile_dir = os.getenv("PROFILE_DIR","/tmp/profiles")
+profile_bucket = os.getenv("PROFILE_BUCKET")
+profile_prefix = os.getenv("PROFILE_PREFIX","profiles/")
+profile_memory = os.getenv("PROFILE_MEMORY","False").lower() in ('true', '1', 't', 'yes')
+
+deduplicator = Deduplicator(SeenSet(ttl=dedup_ttl,max_entries=dedup_max_entries),policy=dedup_policy) if dedup_policy != "off" else None
+
 #cert_text = open(os.getenv("CERT_FILE"),"rb").read()
 #key_text = open(os.getenv("KEY_FILE",None),"rb").read()
 cert_id = os.getenv("CERT_ID")
 
-key_text = bytes(os.getenv("KEY"),"utf8")
-
 
 session = boto3.Session()
-iot_c = session.client('iot')
 
-#logging.debug(f"from file {cert_text}")
+def get_certificate():
+    iot_c = session.client('iot')
+
+    #logging.debug(f"from file {cert_text}")
+
+    cert_text = iot_c.describe_certificate(
+        certificateId = cert_id
+    )['certificateDescription']['certificatePem']
+    cert_text = bytes(cert_text,"utf8")
+
+    logging.debug(f"obtained cert {cert_id} {cert_text}")
+
+    return cert_text
+
+
+class IotPublisher:
+    """publishes bridge messages to AWS IoT Core"""
+
+    def __init__(self, connection):
+        self.connection = connection
 
-cert_text = iot_c.describe_certificate(
-    certificateId = cert_id
-)['certificateDescription']['certificatePem']
-cert_text = bytes(cert_text,"utf8")
+    def publish(self, topic, payload, data_id=None, pipelines=()):
+        self.connection.publish(topic=topic,payload=payload,qos=mqtt.QoS.AT_LEAST_ONCE)
 
-logging.debug(f"obtained cert {cert_id} {cert_text}")
+    def close(self):
+        self.connection.disconnect()
+
+    def stats(self):
+        return {}
 
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
     logging.warning("Connection interrupted. error: {}".format(error))
+    if spool_dir:
+        publisher.set_available(False)
 
 # Callback when an interrupted connection is re-established.
 def on_connection_resumed(connection, return_code, session_present, **kwargs):
     logging.info("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
+    if spool_dir and return_code == mqtt.ConnectReturnCode.ACCEPTED:
+        publisher.set_available(True)
 
     if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
         logging.info("Session did not persist. Resubscribing to existing topics...")
@@ -96,12 +179,15 @@ def on_resubscribe_complete(resubscribe_future):
 def on_connect_wis(client, userdata, flags, rc):
     """
     set the bad connection flag for rc >0, Sets onnected_flag if connected ok
-    also subscribes to topics
+    also subscribes to topics. userdata is the Broker
     """
-    logging.info("Connected flags:"+str(flags)+" result code: "+str(rc)) 
-    for topic in topics:   
-        logging.info("subscribing to:"+str(topic))
-        client_wis2.subscribe(topic,qos=1)
+    logging.info(f"{userdata.name} connected flags:"+str(flags)+" result code: "+str(rc)) 
+    if rc != 0:
+        return
+    userdata.on_connect()
+    for topic in userdata.topics:   
+        logging.info(f"{userdata.name} subscribing to:"+str(topic))
+        client.subscribe(topic,qos=1)
 
 def on_subscribe(client,userdata,mid,granted_qos):
     """removes mid values from subscribe list"""
@@ -109,58 +195,108 @@ def on_subscribe(client,userdata,mid,granted_qos):
     client.subscribe_flag=True
 
 def on_message(client, userdata, msg):
+    """runs on the paho network thread, only enqueue the message so that the loop is not stalled"""
     topic=msg.topic
     logging.debug(f"message received with topic {topic}")
-    m_decode=str(msg.payload.decode("utf-8","ignore"))
-    #logging.debug("message received")
-    message_routing(client,topic,m_decode)
+    userdata.on_message()
+    if metrics:
+        metrics.count("MessagesReceived", Broker=userdata.host)
+    if not pool.submit( (userdata.host, topic, msg.payload, datetime.now().isoformat(), time.monotonic()) ):
+        logging.warning(f"queue full, dropping message from {userdata.name} published on {topic}")
+        if metrics:
+            metrics.count("MessagesDropped", Broker=userdata.host)
+
+def process_message(item):
+    """runs on a worker thread"""
+    broker, topic, payload, time_received, received_at = item
+    message_routing(broker,topic,payload,time_received,received_at)
 
 def on_disconnect(client, userdata, rc):
-    logging.info("connection to broker has been lost")
+    logging.info(f"connection to broker {userdata.name} has been lost")
+    userdata.on_disconnect()
     client.connected_flag=False
     client.disconnect_flag=True
 
-def message_routing(client,topic,msg):
+def message_routing(broker,topic,payload,time_received,received_at=None):
     #logging.debug("message_routing")
-    logging.debug("routing topic: "+topic)
-    logging.debug("routing message:  "+msg)
+    logging.debug("routing topic: %s", topic)
+    logging.debug("routing message: %s", payload)
     
     #topic=topic.replace("sig/","")
     
     #topic="sdk/test/python"
     #topic="bfa/ouagadougou_met_centre/data/core/weather/surface-based-observations/synop"
     
-    topic_levels = topic.split("/")
-
-    # only take levels 4 to 12, if they are there. Levels 1-3 are fix for the moment
-    topic_new = "/".join(topic_levels[3:9]) if len(topic_levels) > 10 else "/".join(topic_levels[3:])
-    topic_new = topic_levels[0] + "/" + topic_new
+    # rewritten topic and target pipelines, cached per source topic
+    topic_new, pipelines = router.route(topic)
+    top_level = topic_new.split("/",1)[0]
+    if metrics:
+        metrics.observe("PayloadSize", len(payload), "Bytes", Topic=top_level)
+    if not pipelines:
+        logging.debug(f"discarding message on unrouted topic {topic}")
+        if metrics:
+            metrics.count("MessagesUnrouted", Topic=top_level)
+        return
 
     # insert metadata into the message
-    if not msg or msg.isspace():
+    if not payload or payload.isspace():
         logging.debug(f"discarding empty message published on {topic}")
         return
-    try:
-        msg = json.loads(msg)
-    except json.JSONDecodeError as e:
-        logging.error(f"cannot parse json message '{msg}',{e}, {topic}")
-        return    
 
-    msg["_meta"] = { "time_received" : datetime.now().isoformat() , "broker" : wis_broker_host , "topic" : topic }
-    msg = json.dumps(msg)
+    offload = claim_check and claim_check.applies(payload)
+    # valid UTF-8 JSON objects are passed on as received with _meta spliced in, unless their content is offloaded
+    # or they are re-encoded
+    notification = parse_object(payload)
+    splice = notification is not None and fast_meta and not offload and wire_format == "json"
+    if notification is None:
+        msg = payload.decode("utf-8","ignore")
+        try:
+            notification = json.loads(msg)
+        except json.JSONDecodeError as e:
+            logging.error(f"cannot parse json message '{msg}',{e}, {topic}")
+            return    
+        if not isinstance(notification,dict):
+            logging.error(f"message is not a JSON object '{msg}', {topic}")
+            return
+    notification_id, data_id = extract_ids(notification)
+
+    first_broker = deduplicator.check(notification_id,data_id,broker) if deduplicator else None
+    if first_broker and deduplicator.policy == "drop":
+        logging.debug(f"discarding duplicate of message received from {first_broker} published on {topic}")
+        if metrics:
+            metrics.count("MessagesDuplicate", Broker=broker)
+        return
+
+    if offload and claim_check.offload(notification) and metrics:
+        metrics.count("MessagesOffloaded", Topic=top_level)
 
-    logging.debug(f"publishing topic {topic_new} with length {len(topic_levels)} and message length {len(msg)} and {msg}")      
-    client_aws.publish(topic=topic_new,payload=msg,qos=mqtt.QoS.AT_LEAST_ONCE)
+    meta = { "time_received" : time_received , "broker" : broker , "topic" : topic }
+    if first_broker:
+        meta["duplicate_of"] = first_broker
+
+    if splice:
+        msg = inject_meta(payload,meta)
+    else:
+        notification["_meta"] = meta
+        msg = encode_record(notification,wire_format)
+
+    logging.debug("publishing topic %s to %s with message length %s and %s", topic_new, pipelines, len(msg), msg)
+    publisher.publish(topic_new,msg,data_id,pipelines)
+
+    if metrics:
+        metrics.count("MessagesPublished", Topic=top_level)
+        if received_at:
+            metrics.observe("PublishLatency", (time.monotonic() - received_at) * 1000, "Milliseconds", Broker=broker)
         
-def create_wis2_connection():
-    transport = "websockets" if wis_broker_port==443 else "tcp"
-    logging.info(f"creating wis2 connection to {wis_broker_host}:{wis_broker_port} using {wis_user}/{wis_pw} over {transport}")
+def create_wis2_connection(broker):
+    transport = "websockets" if broker.port==443 else "tcp"
+    logging.info(f"creating wis2 connection to {broker.host}:{broker.port} using {broker.username}/{broker.password} over {transport}")
     
-    client = mqtt_paho.Client(client_id=client_id, transport=transport,
-         protocol=mqtt_paho.MQTTv311, clean_session=False)
+    client = mqtt_paho.Client(client_id=client_id + "_" + get_random_string(6), transport=transport,
+         protocol=mqtt_paho.MQTTv311, clean_session=False, userdata=broker)
                          
-    client.username_pw_set(wis_user, wis_pw)
-    if wis_broker_port != 1883:
+    client.username_pw_set(broker.username, broker.password)
+    if broker.port != 1883:
         logging.info("setting up TLS connection")
         client.tls_set(certfile=None, keyfile=None, cert_reqs=ssl.CERT_REQUIRED)
     
@@ -172,15 +308,40 @@ def create_wis2_connection():
     #properties=Properties(PacketTypes.CONNECT)
     #properties.SessionExpiryInterval=30*60 # in seconds
     
-    client.connect(wis_broker_host,
+    # connect in the network thread, so that an unreachable broker does not stop the others
+    client.connect_async(broker.host,
                    #port=8883,
-                   port=wis_broker_port,
+                   port=broker.port,
                    #clean_start=mqtt_paho.,
                    #properties=properties,
                    keepalive=60)
+    client.loop_start()
     
     return client
     
+def log_stats():
+    """periodically log queue depth and drop counters"""
+    while True:
+        time.sleep(stats_interval)
+        logging.info("queue stats: {}".format(pool.stats(reset_max_depth=True)))
+        logging.info("route stats: {}".format(router.stats()))
+        for broker in brokers:
+            logging.info("broker {} stats: {}".format(broker.name, broker.stats()))
+        if output_mode == "kinesis" or spool_dir:
+            logging.info("output stats: {}".format(publisher.stats()))
+        if deduplicator:
+            logging.info("deduplication stats: {}".format(deduplicator.stats()))
+        if claim_check:
+            logging.info("claim check stats: {}".format(claim_check.stats()))
+
+def collect_metrics(metrics):
+    """sample queue and spool depth before each metrics flush"""
+    stats = pool.stats(reset_max_depth=False)
+    metrics.gauge("QueueDepth", stats["depth"])
+    metrics.gauge("QueueMaxDepth", stats["max_depth"])
+    if spool_dir and output_mode != "kinesis":
+        metrics.gauge("SpoolDepth", publisher.spool.depth())
+
 def create_aws_connection():
     logging.info(f"creating AWS connection to {aws_broker}")
     return mqtt_connection_builder.mtls_from_bytes( 
@@ -188,37 +349,81 @@ def create_aws_connection():
         client_id = client_id,
         on_connection_interrupted = on_connection_interrupted,
         on_connection_resumed  = on_connection_resumed,
-        cert_bytes  = cert_text ,
-        pri_key_bytes = key_text,
+        cert_bytes  = get_certificate() ,
+        pri_key_bytes = bytes(os.getenv("KEY"),"utf8"),
         ca_filepath = CA
     )
 
 def handler(signum, frame):
     signame = signal.Signals(signum).name
     logging.info(f"received signal {signame}")
-    client_wis2.loop_stop()
-    client_wis2.disconnect()
+    for client in clients_wis2:
+        client.disconnect()
+        client.loop_stop()
     
-    time.sleep(5)
-    client_aws.disconnect()
+    pool.stop(timeout=5)
+    publisher.close()
+    if metrics:
+        metrics.stop()
+    if profile_window:
+        profile_window.stop()
+    stopped.set()
+
 
+clients_wis2 = []
+profile_window = None
+stopped = threading.Event()
 
 signal.signal(signal.SIGTERM, handler)
 signal.signal(signal.SIGINT, handler)
                 
 # start
 try:
-    logging.info("creating connection to AWS")
-    client_aws = create_aws_connection()
-    connect = client_aws.connect()
-    connect.result()
-    logging.info("connected to AWS")    
+    claim_check = None
+    if claim_check_bucket:
+        claim_check = ClaimCheck(S3Store(session.client('s3'), claim_check_bucket, claim_check_prefix), threshold=claim_check_threshold)
+    elif claim_check_dir:
+        claim_check = ClaimCheck(LocalStore(claim_check_dir), threshold=claim_check_threshold)
+
+    if output_mode == "kinesis":
+        logging.info("publishing directly to Kinesis")
+        router = TopicRouter(load_kinesis_routes())
+        logging.info(f"kinesis routes {router.routes}")
+        kinesis_client = session.client('kinesis', endpoint_url=kinesis_endpoint_url)
+        publisher = KinesisPublisher(kinesis_client, router.pipelines, flush_interval=kinesis_flush_interval, max_retries=kinesis_max_retries)
+    else:
+        router = TopicRouter(load_routes())
+        logging.info(f"routes {router.routes}")
+        logging.info("creating connection to AWS")
+        client_aws = create_aws_connection()
+        connect = client_aws.connect()
+        connect.result()
+        logging.info("connected to AWS")    
+        publisher = IotPublisher(client_aws)
+        if spool_dir:
+            logging.info(f"spooling to {spool_dir} while the AWS connection is interrupted")
+            spool = Spool(spool_dir, segment_bytes=spool_segment_bytes, max_bytes=spool_max_bytes)
+            publisher = SpoolingPublisher(publisher, spool, drain_rate=spool_drain_rate)
+
+    if profile_kind != "off":
+        store = S3Store(session.client('s3'), profile_bucket, profile_prefix) if profile_bucket else None
+        profile_window = ProfileWindow(profile_kind, duration=profile_seconds, every=profile_every_seconds,
+                                       directory=profile_dir, store=store, memory=profile_memory).start()
+        logging.info(f"profiling with {profile_kind} for {profile_seconds} seconds every {profile_every_seconds} seconds")
+
+    pool = WorkerPool(profile_window.wrap(process_message) if profile_window else process_message, num_workers=worker_threads, max_size=queue_size, put_timeout=queue_put_timeout, name="publisher").start()
+    threading.Thread(target=log_stats, name="stats", daemon=True).start()
+    if metrics:
+        metrics.add_collector(collect_metrics)
+        metrics.start()
     
-    logging.info("creating connection to WIS2")
-    client_wis2 = create_wis2_connection()
-    logging.info("connected to WIS2")
+    # one paho client per Global Broker, all feeding the same queue and AWS connection
+    for broker in brokers:
+        logging.info(f"creating connection to WIS2 broker {broker}")
+        clients_wis2.append(create_wis2_connection(broker))
 
-    client_wis2.loop_forever() #start loop
+    while not stopped.wait(1):
+        pass
     logging.info("loop")
 
 except Exception as e:
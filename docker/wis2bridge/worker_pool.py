@@ -0,0 +1,116 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WorkerPool:
+    """bounded queue decoupling the MQTT receive callback from routing and publishing.
+    The receive callback only calls submit(), a pool of worker threads calls the handler.
+    If the queue is full submit() blocks for at most put_timeout seconds (backpressure) and then drops the item"""
+
+    def __init__(self, handler, num_workers=4, max_size=10000, put_timeout=1.0, name="worker"):
+        self.handler = handler
+        self.num_workers = num_workers
+        self.max_size = max_size
+        self.put_timeout = put_timeout
+        self.name = name
+
+        self.queue = queue.Queue(maxsize=max_size)
+        self.threads = []
+        self._stopping = threading.Event()
+
+        self._lock = threading.Lock()
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+
+    def start(self):
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+        logger.info(f"started {self.num_workers} {self.name} threads with queue size {self.max_size}")
+        return self
+
+    def submit(self, item):
+        """enqueue an item. Returns False if the item was dropped because the queue stayed full"""
+        with self._lock:
+            self.received += 1
+        try:
+            if self.put_timeout and self.put_timeout > 0:
+                self.queue.put(item, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self, reset_max_depth=False):
+        with self._lock:
+            ret = {
+                "received": self.received,
+                "dropped": self.dropped,
+                "processed": self.processed,
+                "failed": self.failed,
+                "depth": self.queue.qsize(),
+                "max_depth": self.max_depth,
+            }
+            if reset_max_depth:
+                self.max_depth = 0
+        return ret
+
+    def stop(self, timeout=None):
+        """let the workers drain the queue and wait at most timeout seconds for them to finish. Never blocks on a
+        full queue, so it can be called from a signal handler while the output stalls"""
+        self._stopping.set()
+        # wake idle workers, the others see the event once the queue is empty
+        for _ in self.threads:
+            try:
+                self.queue.put_nowait(_STOP)
+            except queue.Full:
+                break
+        end = time.monotonic() + timeout if timeout is not None else None
+        for t in self.threads:
+            t.join(max(end - time.monotonic(), 0) if end is not None else None)
+        alive = sum(t.is_alive() for t in self.threads)
+        if alive:
+            logger.warning(f"{alive} {self.name} threads still busy after {timeout} seconds, {self.queue.qsize()} queued items abandoned")
+        self.threads = []
+        logger.info(f"stopped {self.name} threads {self.stats()}")
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            try:
+                if item is _STOP:
+                    return
+                self.handler(item)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"error processing queued message {e}", exc_info=True)
+            finally:
+                self.queue.task_done()
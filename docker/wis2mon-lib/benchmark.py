@@ -0,0 +1,1123 @@
+"""local benchmarks for wis2mon_lib, using the notifications of the test events of the processing Lambdas, e.g.
+
+python3 benchmark.py wire
+python3 benchmark.py fetch --latency 0.2
+python3 benchmark.py probe
+python3 benchmark.py cache
+python3 benchmark.py validate
+python3 benchmark.py integrity
+python3 benchmark.py circuit
+python3 benchmark.py replicas
+python3 benchmark.py imports --budget-ms 500
+python3 benchmark.py records --workers 4
+python3 benchmark.py firehose --failure-rate 0.1
+python3 benchmark.py retries
+python3 benchmark.py deadline
+python3 benchmark.py stages
+python3 benchmark.py profile
+python3 benchmark.py fanout
+"""
+import argparse
+import base64
+import glob
+import hashlib
+import importlib
+import importlib.util
+import io
+import itertools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import copy
+import random
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from wis2mon_lib import cache, ContentCache, health, HostHealth, RetryError, replicas, ReplicaIndex
+from wis2mon_lib import encode_record, decode_record, handle_content, fetch_contents, serialize_wis2_message, \
+    probe_cache, clear_prefetched, load_schema, validate_many, download_content, ContentTooLarge, process_records, \
+    FirehoseSink, firehose_sink, kinesis_lambda_handler, NonRecoverableError, DocumentTooLarge, \
+    lambda_metrics, timed, profiling, InvocationProfiler, ProcessorRegistry, DeadlineExceeded, record_deadline
+from wis2mon_lib.firehose import MAX_BATCH_RECORDS, MAX_BATCH_BYTES, MAX_RECORD_BYTES
+
+DOCKER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TEST_EVENTS = os.path.join(DOCKER_DIR, "*", "test", "test_notification.json")
+
+# module imported by the Lambda runtime, and the directory it is imported from
+ENTRY_POINTS = {
+    "wis2mon_lib": ("wis2mon_lib", DOCKER_DIR),
+    "notifications": ("app", os.path.join(DOCKER_DIR, "lambda_notifications_new")),
+    "surface-obs": ("app.app", os.path.join(DOCKER_DIR, "lambda_surface-obs")),
+    "swic": ("app", os.path.join(DOCKER_DIR, "lambda_swic")),
+}
+
+
+def load_notifications():
+    """notifications from the Kinesis and Firehose test events of the Lambdas"""
+    ret = []
+    for path in sorted(glob.glob(TEST_EVENTS)):
+        with open(path) as f:
+            event = json.load(f)
+        records = [r["kinesis"]["data"] for r in event.get("Records", [])] + [r["data"] for r in event.get("records", [])]
+        ret.extend(json.loads(base64.b64decode(data)) for data in records)
+    return ret
+
+
+def bench_wire(args):
+    notifications = load_notifications()
+    print(f"{len(notifications)} notifications from the test events")
+
+    for wire_format in ("json", "msgpack"):
+        records = [encode_record(n, wire_format) for n in notifications]
+        for n, r in zip(notifications, records):
+            assert decode_record(r) == n, "round trip changed the notification"
+
+        # Kinesis carries the record base64 encoded to the Lambda
+        encoded = [base64.b64encode(r) for r in records]
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for data in encoded:
+                decode_record(base64.b64decode(data))
+        elapsed = time.perf_counter() - start
+
+        total = sum(len(r) for r in records)
+        print(f"  {wire_format:8s} {total / len(records):9.0f} bytes/record, "
+              f"decode {elapsed / (args.repeat * len(records)) * 1e6:7.1f} us/record")
+
+
+class LatencyHandler(BaseHTTPRequestHandler):
+    """serves /<n> with n bytes after the latency of the server, /missing with 404, /redirect/<n> redirects to /<n>"""
+
+    def do_GET(self):
+        next(self.server.gets)
+        time.sleep(self.server.latency)
+        if self.path == "/missing":
+            self.send_error(404)
+            return
+        body = b"x" * int(self.path.split("?")[0].strip("/"))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        if self.path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/redirect"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200 if self.path != "/missing" else 404)
+        self.send_header("Content-Length", self.path.strip("/") if self.path != "/missing" else "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class LatencyServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # connections of all concurrent downloads wait to be accepted, the default backlog of 5 drops some on a busy host
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # clients abandoning requests at their deadline
+        pass
+
+
+def start_server(latency):
+    """local HTTP server standing in for the global caches, each request takes latency seconds"""
+    server = LatencyServer(("127.0.0.1", 0), LatencyHandler)
+    server.latency = latency
+    server.gets = itertools.count()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def url_notifications(server, count, size):
+    """notifications referencing content on the local server, every tenth one missing"""
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    return [{
+        "id": str(i),
+        "properties": {"data_id": f"test/{i}"},
+        "links": [{"rel": "canonical", "type": "application/bufr",
+                   "href": f"{base}/missing" if i % 10 == 9 else f"{base}/{size + i}"}],
+    } for i in range(count)]
+
+
+def bench_fetch(args):
+    cache.content_cache = None
+    server = start_server(args.latency)
+    notifications = url_notifications(server, args.records, args.size)
+    print(f"{args.records} records, {args.latency * 1000:.0f} ms latency per request")
+
+    start = time.perf_counter()
+    serial = [handle_content(n) for n in notifications]
+    elapsed = time.perf_counter() - start
+    print(f"  serial      {elapsed:6.2f} s")
+
+    for per_host in (1, 4, 16):
+        start = time.perf_counter()
+        batch = fetch_contents(notifications, max_workers=16, max_per_host=per_host)
+        elapsed = time.perf_counter() - start
+        assert batch == serial, "batch fetch returned different content"
+        print(f"  concurrent  {elapsed:6.2f} s  ({per_host} per host)")
+
+    start = time.perf_counter()
+    batch = fetch_contents(notifications, max_workers=16, max_per_host=4, deadline=args.latency * 2.5)
+    elapsed = time.perf_counter() - start
+    timed_out = sum(isinstance(r, Exception) for r in batch)
+    print(f"  deadline    {elapsed:6.2f} s  ({timed_out} of {len(batch)} timed out)")
+    server.shutdown()
+
+
+def bench_probe(args):
+    server = start_server(args.latency)
+    notifications = url_notifications(server, args.records, 100)
+    for n in notifications:
+        n["_meta"] = {"time_received": "2024-01-01T00:00:00", "broker": "test", "topic": "cache/a/wis2/test"}
+    # several brokers announce the same URL
+    notifications = notifications * args.copies
+    print(f"{len(notifications)} notifications, {args.records} distinct URLs, {args.latency * 1000:.0f} ms latency")
+
+    def columns(rows):
+        return [(r["meta_cache_status"], r["meta_remote_content_size"]) for r in rows]
+
+    start = time.perf_counter()
+    serial = [serialize_wis2_message(n, validate=False) for n in notifications]
+    print(f"  serial      {time.perf_counter() - start:6.2f} s")
+
+    for sample in (None, 10):
+        start = time.perf_counter()
+        probe_cache(notifications, sample=sample)
+        batch = [serialize_wis2_message(n, validate=False) for n in notifications]
+        clear_prefetched()
+        elapsed = time.perf_counter() - start
+        if sample is None:
+            assert columns(batch) == columns(serial), "batch probe returned different results"
+        checked = sum(r["meta_cache_status"] is not None for r in batch)
+        print(f"  batch       {elapsed:6.2f} s  (sample {sample}, {checked} of {len(batch)} checked)")
+
+    # the columns describe the cache URL itself, not where it redirects to
+    redirect = dict(notifications[0], links=[dict(notifications[0]["links"][0],
+                                                  href=f"http://127.0.0.1:{server.server_address[1]}/redirect/100")])
+    row = serialize_wis2_message(redirect, validate=False)
+    assert (row["meta_cache_status"], row["meta_remote_content_size"]) == (302, "0"), "HEAD followed a redirect"
+    server.shutdown()
+
+
+def bench_cache(args):
+    server = start_server(args.latency)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    shutil.rmtree(args.dir, ignore_errors=True)
+
+    # every object is announced by several caches, each with its own href
+    notifications = []
+    for copy in range(args.copies):
+        for i in range(args.records):
+            size = args.size + i
+            notifications.append({
+                "id": f"{copy}-{i}",
+                "properties": {
+                    "data_id": f"test/{i}",
+                    "integrity": {"method": "sha512", "value": hashlib.sha512(b"x" * size).hexdigest()},
+                },
+                "links": [{"rel": "canonical", "href": f"{base}/{size}?cache={copy}"}],
+            })
+    print(f"{len(notifications)} notifications, {args.records} distinct objects, {args.copies} caches")
+
+    for name, content_cache in (("no cache", None), ("memory", ContentCache()),
+                                ("small memory + dir", ContentCache(max_bytes=args.size * 10, directory=args.dir))):
+        cache.content_cache = content_cache
+        gets = next(server.gets)
+        start = time.perf_counter()
+        for n in notifications:
+            handle_content(n)
+        elapsed = time.perf_counter() - start
+        downloads = next(server.gets) - gets - 1
+        stats = content_cache.stats() if content_cache else {}
+        print(f"  {name:20s} {elapsed:6.2f} s, {downloads:4d} downloads, "
+              f"{stats.get('bytes_saved', 0) / 1e6:6.1f} MB saved, {stats.get('file_hits', 0)} file hits")
+    server.shutdown()
+
+
+def bench_validate(args):
+    import jsonschema
+
+    valid = load_notifications()
+    # invalid variants: missing links, wrong type of the geometry and of the datetime
+    invalid = []
+    for n in valid[:10]:
+        for key in ("links", "geometry", "properties"):
+            broken = copy.deepcopy(n)
+            if key == "properties":
+                broken["properties"]["datetime"] = 12
+            elif key == "geometry":
+                broken["geometry"] = "none"
+            else:
+                del broken["links"]
+            invalid.append(broken)
+    notifications = valid + invalid
+
+    def per_call(j):
+        try:
+            jsonschema.validate(instance=j, schema=load_schema())
+            return True
+        except jsonschema.exceptions.ValidationError:
+            return False
+
+    expected = [per_call(n) for n in notifications]
+    assert validate_many(notifications) == expected, "precompiled validator returned different results"
+    print(f"{len(notifications)} notifications, {sum(expected)} valid")
+
+    # content offloaded by the claim check of the bridge is validated as published
+    cache.content_cache = None
+    directory = tempfile.mkdtemp()
+    offloaded = []
+    for i, n in enumerate(n for n in valid if "value" in n["properties"].get("content", {})):
+        n = copy.deepcopy(n)
+        content = n["properties"]["content"]
+        path = os.path.join(directory, str(i))
+        with open(path, "wb") as f:
+            f.write(base64.b64decode(content["value"]) if content["encoding"] == "base64" else content["value"].encode("utf8"))
+        del content["value"]
+        content["ref"] = f"file://{path}"
+        offloaded.append(n)
+    verdicts = [serialize_wis2_message(n, validate=True, check_cache=False)["meta_validates"] for n in offloaded]
+    assert offloaded and all(verdicts), f"offloaded valid notifications do not validate: {verdicts}"
+    assert validate_many(offloaded) == verdicts, "validate_many does not rehydrate"
+    print(f"  {len(offloaded)} offloaded notifications valid")
+    shutil.rmtree(directory)
+
+    for name, fn in (("jsonschema.validate", lambda: [per_call(n) for n in notifications]),
+                     ("validate_many", lambda: validate_many(notifications))):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            fn()
+        elapsed = time.perf_counter() - start
+        print(f"  {name:20s} {args.repeat * len(notifications) / elapsed:9.0f} messages/s")
+
+
+def bench_integrity(args):
+    cache.content_cache = None
+    server = start_server(0)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # embedded content of the test notifications
+    verdicts = {}
+    for n in load_notifications():
+        if "content" in n["properties"]:
+            n = dict(n, _meta={"time_received": "", "broker": "test", "topic": "origin/a/wis2/test"})
+            verdict = serialize_wis2_message(n, validate=False, check_cache=False)["meta_integrity"]
+            verdicts[verdict] = verdicts.get(verdict, 0) + 1
+    print(f"embedded content of the test notifications: {verdicts}")
+
+    # malformed base64 is an invalid verdict when serialized and can never be processed
+    broken = {"id": "broken", "links": [], "_meta": {"time_received": "", "broker": "test", "topic": "origin/a/wis2/test"},
+              "properties": {"content": {"encoding": "base64", "value": "abc"},
+                             "integrity": {"method": "sha512", "value": "0"}}}
+    verdict = serialize_wis2_message(broken, validate=False, check_cache=False)["meta_integrity"]
+    assert verdict == "invalid", f"malformed base64: {verdict} instead of invalid"
+    try:
+        handle_content(broken)
+        raise AssertionError("malformed base64 decoded")
+    except NonRecoverableError as e:
+        print(f"  malformed base64 {verdict}, {e}")
+
+    # properties of the wrong type: a verdict when serialized, never an exception other than NonRecoverableError
+    malformed = [
+        ("null encoding", {"encoding": None, "value": "YWJj"}, {"method": "sha512", "value": "0"}, None, False),
+        ("utf8 number", {"encoding": "utf8", "value": 42}, {"method": "sha512", "value": "0"}, "invalid", False),
+        ("number method", {"encoding": "base64", "value": "YWJj"}, {"method": 512, "value": "0"}, "unsupported", True),
+        ("number digest", {"encoding": "base64", "value": "YWJj"}, {"method": "sha512", "value": 0}, "invalid", True),
+    ]
+    for name, content, integrity, expected, decodes in malformed:
+        n = dict(broken, properties={"content": content, "integrity": integrity})
+        verdict = serialize_wis2_message(n, validate=False, check_cache=False)["meta_integrity"]
+        assert verdict == expected, f"{name}: {verdict} instead of {expected}"
+        try:
+            handle_content(dict(n, _meta=dict(n["_meta"])))
+            outcome = "decoded"
+        except NonRecoverableError:
+            outcome = "not retried"
+        assert (outcome == "decoded") == decodes, f"{name}: {outcome}"
+        print(f"  {name:16s} {verdict}, {outcome}")
+
+    size = args.size
+    data = b"x" * size
+    url = f"{base}/{size}"
+    cases = [
+        ("sha512 base64", {"method": "sha512", "value": base64.b64encode(hashlib.sha512(data).digest()).decode()}, "valid"),
+        ("sha256 hex", {"method": "sha256", "value": hashlib.sha256(data).hexdigest()}, "valid"),
+        ("md5 hex", {"method": "md5", "value": hashlib.md5(data).hexdigest()}, "valid"),
+        ("sha3-256 base64", {"method": "sha3-256", "value": base64.b64encode(hashlib.sha3_256(data).digest()).decode()}, "valid"),
+        ("corrupted", {"method": "sha512", "value": base64.b64encode(hashlib.sha512(data + b"y").digest()).decode()}, "invalid"),
+        ("unknown method", {"method": "crc32", "value": "0"}, "unsupported"),
+        ("no integrity", None, None),
+    ]
+    for name, integrity, expected in cases:
+        content, verdict = download_content(url, integrity=integrity)
+        assert content == data and verdict == expected, f"{name}: {verdict} instead of {expected}"
+        print(f"  {name:16s} {verdict}")
+
+    try:
+        download_content(url, max_size=size // 2)
+        raise AssertionError("max_size not enforced")
+    except ContentTooLarge as e:
+        print(f"  max size         {e}")
+
+    integrity = cases[0][1]
+    for name, fn in (("download + hash", lambda: hashlib.sha512(download_content(url)[0]).digest()),
+                     ("streaming", lambda: download_content(url, integrity=integrity))):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            fn()
+        elapsed = time.perf_counter() - start
+        print(f"  {name:16s} {elapsed / args.repeat * 1000:7.2f} ms per {size / 1e6:.0f} MB download")
+    server.shutdown()
+
+
+def bench_circuit(args):
+    cache.content_cache = None
+    server = start_server(0.02)
+    url = f"http://127.0.0.1:{server.server_address[1]}/1000"
+
+    def run(name, count):
+        start = time.perf_counter()
+        outcomes = {}
+        for _ in range(count):
+            try:
+                download_content(url, timeout=args.timeout)
+                outcome = "ok"
+            except RetryError:
+                outcome = "fail fast"
+            except Exception:
+                outcome = "timeout"
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        elapsed = time.perf_counter() - start
+        stats = health.host_health.stats() if health.host_health else {}
+        state = next(iter(stats.values()), {}).get("state")
+        print(f"  {name:28s} {elapsed:6.2f} s  {outcomes}  circuit {state}")
+
+    for name, host_health in (("without circuit breaker", None),
+                              ("with circuit breaker", HostHealth(open_seconds=args.open_seconds))):
+        print(name)
+        health.host_health = host_health
+        server.latency = 0.02
+        run("healthy", 20)
+        if host_health:
+            print(f"  {'adaptive timeout':28s} {host_health.allow(url, args.timeout):6.2f} s")
+            host_health.success(url, 0.02)
+        # the cache stops answering
+        server.latency = args.timeout * 2
+        run("down", args.records)
+        server.latency = 0.02
+        if host_health:
+            time.sleep(args.open_seconds)
+        run("recovered", 20)
+
+    # a trial request cut short by the deadline of its record must not keep the circuit half open
+    host_health = health.host_health = HostHealth(error_threshold=0.1, min_requests=1, open_seconds=0)
+    host_health.failure(url)
+    server.latency = 1
+    try:
+        with record_deadline(time.monotonic() + 0.1):
+            download_content(url, timeout=args.timeout)
+    except DeadlineExceeded:
+        pass
+    server.latency = 0.02
+    download_content(url, timeout=args.timeout)
+    assert host_health.state(url) == "closed", "circuit stuck after a trial cut short by the deadline"
+    print("trial cut short by the deadline: released, circuit closed by the next request")
+    server.shutdown()
+
+
+def bench_replicas(args):
+    cache.content_cache = None
+    # three global caches with the same data: fast, slow and one which stalls
+    servers = {"fast": start_server(0.01), "slow": start_server(0.2), "stalled": start_server(3)}
+    bases = {name: f"http://127.0.0.1:{server.server_address[1]}" for name, server in servers.items()}
+    names = {base: name for name, base in bases.items()}
+
+    # each object is announced by each cache, the notification processed references one of them
+    indexed, processed = [], []
+    for i in range(args.records):
+        size = 1000 + i
+        integrity = {"method": "sha512", "value": hashlib.sha512(b"x" * size).hexdigest()}
+        copies = [{
+            "id": f"{name}-{i}",
+            "_meta": {"time_received": "", "broker": "test", "topic": "cache/a/wis2/test"},
+            "properties": {"data_id": f"test/{i}", "integrity": integrity},
+            "links": [{"rel": "canonical", "type": "application/bufr", "href": f"{base}/{size}"}],
+        } for name, base in bases.items()]
+        indexed.extend(copies)
+        processed.append(copies[i % len(copies)])
+    print(f"{args.records} objects announced by {len(bases)} caches")
+
+    for name, index in (("canonical href", None), ("fastest replica", ReplicaIndex())):
+        replicas.replica_index = index
+        health.host_health = HostHealth()
+        if index is not None:
+            for n in indexed:
+                index.add(n)
+
+        served = {}
+        latencies = []
+        for n in processed:
+            start = time.perf_counter()
+            try:
+                handle_content(n)
+                replica = names[n["_meta"]["replica"].rsplit("/", 1)[0]]
+            except Exception:
+                replica = "failed"
+            latencies.append(time.perf_counter() - start)
+            served[replica] = served.get(replica, 0) + 1
+        latencies.sort()
+        print(f"  {name:16s} total {sum(latencies):6.2f} s, p50 {latencies[len(latencies) // 2] * 1000:6.0f} ms, "
+              f"max {latencies[-1] * 1000:6.0f} ms, served by {served}")
+
+    # forked workers get an executor of their own, the one of the parent has no threads there
+    start = time.perf_counter()
+    results = process_records(lambda n: handle_content(n) is not None, processed, mode="process", workers=2)
+    elapsed = time.perf_counter() - start
+    assert results == [True] * len(processed), f"forked workers failed: {results}"
+    print(f"  {'forked workers':16s} total {elapsed:6.2f} s")
+
+    for server in servers.values():
+        server.shutdown()
+
+
+def import_time(module, directory):
+    """ import time of module in a fresh interpreter in microseconds and the cumulative times of the modules it
+    imports directly, as reported by python -X importtime """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=directory,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise Exception(proc.stderr.strip().splitlines()[-1])
+
+    # modules are listed after their imports, nested imports are indented
+    children = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == module:
+                return int(cumulative), {c: t for c, t in children}
+            children = []
+        elif depth == 1:
+            children.append((name.strip(), int(cumulative)))
+    raise Exception(f"{module} not found in the import times")
+
+
+def bench_imports(args):
+    over_budget = False
+    for name, (module, directory) in ENTRY_POINTS.items():
+        try:
+            runs = [import_time(module, directory) for _ in range(args.repeat)]
+        except Exception as e:
+            print(f"{name:14s} cannot be imported here: {e}")
+            continue
+        total, modules = min(runs, key=lambda r: r[0])
+        over_budget = over_budget or (args.budget_ms and total / 1000 > args.budget_ms)
+        print(f"{name:14s} {total / 1000:7.1f} ms")
+        top = sorted(((t, m) for m, t in modules.items()), reverse=True)
+        for t, m in top[:args.top]:
+            print(f"    {m:30s} {t / 1000:7.1f} ms")
+
+    if over_budget:
+        print(f"import time above the budget of {args.budget_ms} ms")
+        sys.exit(1)
+
+
+def load_entry_point(name):
+    """ module of a Lambda entry point. Single file apps are loaded under their own name, all of them are app.py """
+    module, directory = ENTRY_POINTS[name]
+    sys.path.insert(0, directory)
+    if "." in module:
+        # package with relative imports
+        return importlib.import_module(module)
+
+    spec = importlib.util.spec_from_file_location(f"lambda_{name.replace('-', '_')}", os.path.join(directory, module + ".py"))
+    app = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = app
+    spec.loader.exec_module(app)
+    return app
+
+
+def pipelines(args):
+    """ (name, function, payloads) of the processing functions which can run here """
+    notifications = load_notifications()
+    ret = [("notifications", lambda n: [serialize_wis2_message(n, validate=True, check_cache=False)], notifications)]
+
+    cap = [n for n in notifications if "/swic/" in n["_meta"]["topic"] and "content" in n["properties"]]
+    ret.append(("swic", load_entry_point("swic").process_cap, cap))
+
+    try:
+        surface_obs = load_entry_point("surface-obs")
+        import bufr2geojson
+        bufr = [n for n in notifications if "surface-based-observations" in n["_meta"]["topic"] and "content" in n["properties"]]
+        ret.append(("surface-obs", surface_obs.process_surface_obs, bufr))
+    except ImportError as e:
+        print(f"surface-obs skipped: {e}")
+
+    # I/O bound: downloads from the local server with latency
+    server = start_server(args.latency)
+    ret.append(("download", lambda n: [len(handle_content(n) or b"")], url_notifications(server, 40, 1000)))
+    return ret
+
+
+def bench_records(args):
+    cache.content_cache = None
+    print(f"{os.cpu_count()} CPUs, {args.workers} workers")
+
+    def comparable(results):
+        return [[{k: v for k, v in d.items() if k != "meta_lambda_datetime"} if isinstance(d, dict) else d
+                 for d in r] if isinstance(r, list) else repr(r) for r in results]
+
+    for name, fn, payloads in pipelines(args):
+        payloads = (payloads * (args.records // max(len(payloads), 1) + 1))[:args.records]
+        print(f"{name} ({len(payloads)} records)")
+        expected = None
+        for mode in ("serial", "thread", "process"):
+            start = time.perf_counter()
+            results = process_records(fn, payloads, mode=mode, workers=args.workers)
+            elapsed = time.perf_counter() - start
+            failed = sum(isinstance(r, Exception) for r in results)
+            expected = expected or comparable(results)
+            assert comparable(results) == expected, f"{mode} returned different results"
+            print(f"  {mode:8s} {len(payloads) / elapsed:9.0f} records/s, {failed} failed")
+
+
+class StandInFirehose:
+    """put_record_batch of a local stand-in for Firehose which enforces the limits of the API, fails failure_rate
+    of the entries and throttle_rate of the calls as a whole"""
+
+    def __init__(self, failure_rate, throttle_rate, seed=1):
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.delivered = []
+        self.calls = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.calls += 1
+        if len(Records) > MAX_BATCH_RECORDS:
+            raise Exception(f"ValidationException: {len(Records)} records in one call")
+        if sum(len(r["Data"]) for r in Records) > MAX_BATCH_BYTES:
+            raise Exception("ValidationException: batch larger than 4 MiB")
+        if any(len(r["Data"]) > MAX_RECORD_BYTES for r in Records):
+            raise Exception("ValidationException: record larger than 1000 KiB")
+        if self.random.random() < self.throttle_rate:
+            raise Exception("ThrottlingException: rate exceeded")
+
+        responses = []
+        for r in Records:
+            if self.random.random() < self.failure_rate:
+                responses.append({"ErrorCode": "ServiceUnavailableException", "ErrorMessage": "slow down"})
+            else:
+                self.delivered.append(r["Data"])
+                responses.append({"RecordId": str(len(self.delivered))})
+        return {"FailedPutCount": sum(1 for r in responses if "ErrorCode" in r), "RequestResponses": responses}
+
+
+def bench_firehose(args):
+    # the warnings about each failed entry
+    logging.getLogger("wis2mon_lib.firehose").setLevel(logging.ERROR)
+    # a bulletin expands into many rows, e.g. one per station
+    rows = [dict(n, row=i) for i, n in zip(range(args.rows), itertools.cycle(load_notifications()))]
+    expected = sorted(json.dumps(r) for r in rows)
+
+    print(f"{len(rows)} rows, {sum(len(json.dumps(r)) + 1 for r in rows) / 1e6:.1f} MB")
+    stand_in = StandInFirehose(0, 0)
+    try:
+        # one put_record_batch for all rows, as before
+        stand_in.put_record_batch(DeliveryStreamName="test", Records=[{"Data": json.dumps(r) + "\n"} for r in rows])
+        print(f"  {'single call':14s} ok")
+    except Exception as e:
+        print(f"  {'single call':14s} {e}")
+
+    # entries which still fail after max_attempts are reported, not dropped silently
+    stand_in = StandInFirehose(1.0, 0)
+    try:
+        FirehoseSink("test", client=stand_in, max_attempts=3, sleep=lambda s: None).send(rows[:10])
+        raise AssertionError("undelivered rows not reported")
+    except RetryError as e:
+        assert stand_in.calls == 3, f"{stand_in.calls} calls instead of 3 attempts"
+        print(f"  {'always failing':14s} {e}")
+
+    for pack in (False, True):
+        stand_in = StandInFirehose(args.failure_rate, args.throttle_rate)
+        sink = FirehoseSink("test", client=stand_in, pack=pack, max_attempts=args.attempts, sleep=lambda s: None)
+        name = "packed" if pack else "one per line"
+        sink.send(rows)
+        delivered = sorted(line.decode() for data in stand_in.delivered for line in data.splitlines())
+        assert delivered == expected, "rows lost or duplicated"
+        stats = sink.stats()
+        assert stats["lines"] == len(rows) and stats["records"] == len(stand_in.delivered)
+        print(f"  {name:14s} {stats['records']:6d} records in {stats['calls']:3d} calls, {stats['retried']} retried, "
+              f"every row delivered once")
+
+    # a row larger than a Firehose record only dead-letters the record which produced it
+    lambda_metrics.stream = io.StringIO()
+    output, dead = StandInFirehose(0, 0), StandInFirehose(0, 0)
+    firehose_sink("output").client, firehose_sink("dead").client = output, dead
+    oversized = {"row": "x" * MAX_RECORD_BYTES}
+    try:
+        FirehoseSink("test", client=output).send([oversized])
+        raise AssertionError("oversized row sent")
+    except DocumentTooLarge:
+        pass
+    records = [{"kinesis": {"sequenceNumber": str(1000 + i), "partitionKey": "test",
+                            "data": base64.b64encode(encode_record({"id": str(i)})).decode()}} for i in range(10)]
+    response = kinesis_lambda_handler({"Records": records}, None,
+                                      lambda n: [oversized if n["id"] == "3" else {"id": n["id"]}], "output",
+                                      dead_letter_name="dead")
+    assert not response["batchItemFailures"], "batch retried for an oversized row"
+    assert len(output.delivered) == 9 and len(dead.delivered) == 1, "oversized row not dead-lettered alone"
+    print(f"  {'oversized row':14s} record dead-lettered, the other {len(output.delivered)} rows delivered")
+
+
+def bench_retries(args):
+    cache.content_cache = None
+    logging.getLogger("wis2mon_lib").setLevel(logging.CRITICAL)
+    # the EMF metrics of each invocation
+    lambda_metrics.stream = io.StringIO()
+    server = start_server(args.latency)
+    notifications = url_notifications(server, args.records, 1000)
+    records = [{"kinesis": {"sequenceNumber": str(1000 + i), "partitionKey": "test",
+                            "data": base64.b64encode(encode_record(n)).decode()}} for i, n in enumerate(notifications)]
+    # a record which is not a notification at all
+    records[args.records // 2]["kinesis"]["data"] = base64.b64encode(b"not a notification").decode()
+    unreachable = notifications[args.records // 3]["id"]
+
+    def pipeline(attempts):
+        """ rows of one record, the cache of one of them is unreachable for the first attempts invocations """
+        calls = {"records": 0, "invocations": 0}
+
+        def process(n):
+            calls["records"] += 1
+            if n["id"] == unreachable and calls["invocations"] <= attempts:
+                raise RetryError("cache unreachable")
+            handle_content(n)
+            return [{"id": n["id"]}]
+        process.__name__ = "retries"
+        return process, calls
+
+    # before: any exception fails the invocation and the whole batch is retried, until it expires
+    process, calls = pipeline(args.unreachable)
+    delivered = []
+    for invocation in range(args.max_invocations):
+        calls["invocations"] += 1
+        rows, failed = [], False
+        for record in records:
+            try:
+                rows.extend(process(json.loads(base64.b64decode(record["kinesis"]["data"]))))
+            except Exception:
+                failed = True
+        if not failed:
+            delivered.extend(rows)
+            break
+    status = "blocked" if failed else "done"
+    print(f"  {'whole batch':20s} {calls['invocations']:3d} invocations, {calls['records']:5d} records processed, "
+          f"{len(delivered)} rows delivered, shard {status}")
+
+    # after: retried from the lowest failed sequence number, the record which cannot be decoded is dead-lettered
+    process, calls = pipeline(args.unreachable)
+    output, dead = StandInFirehose(0, 0), StandInFirehose(0, 0)
+    firehose_sink("output").client = output
+    firehose_sink("dead").client = dead
+    pending = records
+    while pending and calls["invocations"] < args.max_invocations:
+        calls["invocations"] += 1
+        response = kinesis_lambda_handler({"Records": pending}, None, process, "output", dead_letter_name="dead")
+        failures = [int(f["itemIdentifier"]) for f in response["batchItemFailures"]]
+        pending = [r for r in pending if failures and int(r["kinesis"]["sequenceNumber"]) >= min(failures)]
+    ids = [json.loads(line)["id"] for line in output.delivered]
+    assert len(ids) == len(set(ids)), "rows delivered twice"
+    status = "blocked" if pending else "done"
+    print(f"  {'batch item failures':20s} {calls['invocations']:3d} invocations, {calls['records']:5d} records processed, "
+          f"{len(ids)} rows delivered, {len(dead.delivered)} dead-lettered, shard {status}")
+
+    # a record which fails inside the processor on every attempt, e.g. content the parser rejects, is dead-lettered
+    # after MAX_RECORD_ATTEMPTS instead of blocking the shard
+    broken = notifications[args.records // 4]["id"]
+
+    def parse(n):
+        if n["id"] == broken:
+            raise ValueError("cannot parse content")
+        return [{"id": n["id"]}]
+    output, dead = StandInFirehose(0, 0), StandInFirehose(0, 0)
+    firehose_sink("output").client = output
+    firehose_sink("dead").client = dead
+    pending, invocations = records, 0
+    while pending and invocations < args.max_invocations:
+        invocations += 1
+        response = kinesis_lambda_handler({"Records": pending}, None, parse, "output", dead_letter_name="dead")
+        failures = [int(f["itemIdentifier"]) for f in response["batchItemFailures"]]
+        pending = [r for r in pending if failures and int(r["kinesis"]["sequenceNumber"]) >= min(failures)]
+    errors = [json.loads(line)["error"] for line in dead.delivered]
+    assert not pending, "shard blocked by a record failing in the processor"
+    assert any("cannot parse content" in e for e in errors), "failing record not dead-lettered"
+    print(f"  {'failing processor':20s} {invocations:3d} invocations, {len(output.delivered)} rows delivered, "
+          f"{len(dead.delivered)} dead-lettered, shard done")
+
+    # a delivery stream which fails after the rows of another were sent: the batch is retried and those rows are
+    # sent again, with the same meta_record_key so the load into the database skips them
+    output, flaky = StandInFirehose(0, 0), StandInFirehose(0, 1.0)
+    firehose_sink("output").client, firehose_sink("flaky").client = output, flaky
+    firehose_sink("flaky").sleep = lambda s: None
+    records = [{"kinesis": {"sequenceNumber": str(1000 + i), "partitionKey": "test",
+                            "data": base64.b64encode(encode_record({"id": str(i)})).decode()}} for i in range(50)]
+
+    def fan(n):
+        return {"output": [{"id": n["id"]}], "flaky": [{"id": n["id"]}]}
+    invocations = 0
+    while True:
+        invocations += 1
+        try:
+            kinesis_lambda_handler({"Records": records}, None, fan, None)
+            break
+        except RetryError:
+            flaky.throttle_rate = 0
+    rows = [json.loads(line) for line in output.delivered]
+    keys = {r["meta_record_key"] for r in rows}
+    assert len(keys) == len(records) == len({r["id"] for r in rows}), "rows lost or keys not stable"
+    print(f"  {'failing stream':20s} {invocations:3d} invocations, {len(rows)} rows sent, {len(keys)} distinct keys")
+    server.shutdown()
+
+
+class StandInContext:
+    """Lambda context of an invocation with timeout seconds"""
+
+    def __init__(self, timeout):
+        self.end = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.end - time.monotonic()) * 1000))
+
+
+def bench_deadline(args):
+    cache.content_cache = None
+    logging.getLogger("wis2mon_lib").setLevel(logging.CRITICAL)
+    # the EMF metrics of each invocation
+    lambda_metrics.stream = io.StringIO()
+    server = start_server(args.latency)
+    notifications = url_notifications(server, args.records, 1000)
+    records = [{"kinesis": {"sequenceNumber": str(1000 + i), "partitionKey": "test",
+                            "data": base64.b64encode(encode_record(n)).decode()}} for i, n in enumerate(notifications)]
+
+    def process(n):
+        handle_content(n)
+        return [{"id": n["id"]}]
+
+    print(f"{args.records} records of {args.latency} s each, invocations time out after {args.timeout} s")
+    # without a deadline the invocation is killed by the timeout and the batch replayed, nothing is delivered
+    start = time.perf_counter()
+    process_records(process, [json.loads(base64.b64decode(r["kinesis"]["data"])) for r in records])
+    elapsed = time.perf_counter() - start
+    status = "timed out, batch replayed forever" if elapsed > args.timeout else "done"
+    print(f"  {'without deadline':18s} {elapsed:6.2f} s per invocation, {status}")
+
+    output = StandInFirehose(0, 0)
+    firehose_sink("output").client = output
+    pending, invocations, longest = records, 0, 0
+    while pending and invocations < args.records:
+        invocations += 1
+        start = time.perf_counter()
+        response = kinesis_lambda_handler({"Records": pending}, StandInContext(args.timeout), process, "output",
+                                          reserve=args.reserve)
+        longest = max(longest, time.perf_counter() - start)
+        failures = [int(f["itemIdentifier"]) for f in response["batchItemFailures"]]
+        pending = [r for r in pending if failures and int(r["kinesis"]["sequenceNumber"]) >= min(failures)]
+    ids = [json.loads(line)["id"] for line in output.delivered]
+    assert len(ids) == len(set(ids)) == args.records, "rows lost or delivered twice"
+    print(f"  {'with deadline':18s} {longest:6.2f} s per invocation at most, {invocations} invocations, "
+          f"{len(ids)} rows delivered once")
+
+    # a cache which stalls, the record budget gives up on it early
+    stalled = start_server(args.timeout * 2)
+    notification = url_notifications(stalled, 1, 1000)[0]
+    for name, budget in (("without budget", None), (f"budget {args.budget} s", args.budget)):
+        start = time.perf_counter()
+        result = process_records(process, [notification], record_budget=budget)[0]
+        outcome = type(result).__name__ if isinstance(result, Exception) else "ok"
+        print(f"  {name:18s} {time.perf_counter() - start:6.2f} s on a stalled download, {outcome}")
+    stalled.shutdown()
+    server.shutdown()
+
+
+def emf_percentile(values, counts, q):
+    rank, seen = q / 100 * sum(counts), 0
+    for value, count in zip(values, counts):
+        seen += count
+        if seen >= rank:
+            return value
+
+
+def bench_stages(args):
+    cache.content_cache = None
+    logging.getLogger("wis2mon_lib").setLevel(logging.CRITICAL)
+    firehose_sink("output").client = StandInFirehose(0, 0)
+
+    # cost of timing a stage
+    lambda_metrics.take()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        with timed("overhead"):
+            pass
+    print(f"timed(): {(time.perf_counter() - start) / args.repeat * 1e6:.2f} us per stage")
+
+    for name, fn, payloads in pipelines(args):
+        payloads = (payloads * (args.records // max(len(payloads), 1) + 1))[:args.records]
+        records = [{"kinesis": {"sequenceNumber": str(1000 + i), "partitionKey": "test",
+                                "data": base64.b64encode(encode_record(n)).decode()}} for i, n in enumerate(payloads)]
+
+        def process(n):
+            return fn(n)
+        process.__name__ = name
+
+        stream = lambda_metrics.stream = io.StringIO()
+        lambda_metrics.take()
+        kinesis_lambda_handler({"Records": records}, None, process, "output")
+
+        print(f"{name} ({len(records)} records)")
+        for line in stream.getvalue().splitlines():
+            emf = json.loads(line)
+            if "StageDuration" not in emf:
+                continue
+            values, counts = emf["StageDuration"]["Values"], emf["StageDuration"]["Counts"]
+            p50, p90, p99 = (emf_percentile(values, counts, q) for q in (50, 90, 99))
+            print(f"  {emf['Stage']:14s} {sum(counts):6d}  p50 {p50:9.3f}  p90 {p90:9.3f}  p99 {p99:9.3f} ms")
+
+
+def bench_profile(args):
+    cache.content_cache = None
+    logging.getLogger("wis2mon_lib").setLevel(logging.CRITICAL)
+    firehose_sink("output").client = StandInFirehose(0, 0)
+    lambda_metrics.stream = io.StringIO()
+    directory = tempfile.mkdtemp(prefix="wis2mon-profile-")
+
+    disabled = InvocationProfiler(every=0)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        with disabled.profile("overhead"):
+            pass
+    print(f"profile() when disabled: {(time.perf_counter() - start) / args.repeat * 1e6:.2f} us per invocation")
+    sampled_out = InvocationProfiler(every=1000000)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        with sampled_out.profile("overhead"):
+            pass
+    print(f"profile() when not sampled: {(time.perf_counter() - start) / args.repeat * 1e6:.2f} us per invocation")
+
+    for name, fn, payloads in pipelines(args):
+        payloads = (payloads * (args.records // max(len(payloads), 1) + 1))[:args.records]
+        records = [{"kinesis": {"sequenceNumber": str(1000 + i), "partitionKey": "test",
+                                "data": base64.b64encode(encode_record(n)).decode()}} for i, n in enumerate(payloads)]
+
+        def process(n):
+            return fn(n)
+        process.__name__ = name
+
+        print(f"{name} ({len(records)} records)")
+        for label, profiler in (("not profiled", InvocationProfiler(every=0)),
+                                ("sampling", InvocationProfiler(every=1, directory=directory)),
+                                ("cprofile", InvocationProfiler(every=1, kind="cprofile", directory=directory)),
+                                ("sampling + tracemalloc", InvocationProfiler(every=1, directory=directory,
+                                                                             memory=True))):
+            profiling.lambda_profiler = profiler
+            start = time.perf_counter()
+            kinesis_lambda_handler({"Records": records}, None, process, "output")
+            print(f"  {label:24s} {time.perf_counter() - start:7.3f} s")
+
+    profiling.lambda_profiler = InvocationProfiler(every=0)
+    for name in sorted(os.listdir(directory)):
+        print(f"  {name} {os.path.getsize(os.path.join(directory, name))} bytes")
+    shutil.rmtree(directory)
+
+
+def bench_fanout(args):
+    cache.content_cache = None
+    logging.getLogger("wis2mon_lib").setLevel(logging.CRITICAL)
+    lambda_metrics.stream = io.StringIO()
+    server = start_server(args.latency)
+    notifications = url_notifications(server, args.records, 1000)
+    # every other notification is synop, the others are not downloaded by the content processors
+    for n in notifications:
+        kind = "synop" if int(n["id"]) % 2 == 0 else "temp"
+        n["_meta"] = {"topic": f"cache/a/wis2/deu/dwd/data/core/weather/surface-based-observations/{kind}"}
+    records = [{"kinesis": {"sequenceNumber": str(1000 + i), "partitionKey": "test",
+                            "data": base64.b64encode(encode_record(n)).decode()}} for i, n in enumerate(notifications)]
+    synop = "cache/a/wis2/+/+/data/core/weather/surface-based-observations/synop"
+    synops = sum(1 for n in notifications if n["_meta"]["topic"].endswith("synop"))
+
+    def notification(n):
+        return [{"id": n["id"], "topic": n["_meta"]["topic"]}]
+
+    def observations(n):
+        content = handle_content(n)
+        return [{"id": n["id"], "bytes": len(content)}] if content else []
+
+    def sizes(n):
+        content = handle_content(n)
+        return [{"id": n["id"], "size": len(content) if content else 0}]
+
+    pipelines = [("notifications", notification, ["#"], False),
+                 ("observations", observations, [synop], True),
+                 ("sizes", sizes, [synop], True)]
+    print(f"{args.records} records, {synops} synop, {len(pipelines)} pipelines, {args.latency} s per download")
+
+    def sinks():
+        ret = {}
+        for name, *_ in pipelines:
+            ret[name] = firehose_sink(name).client = StandInFirehose(0, 0)
+        return ret
+
+    # one Lambda per pipeline, each consuming the stream and filtering by topic itself
+    delivered = sinks()
+    gets = next(server.gets)
+    start = time.perf_counter()
+    for name, fn, topics, content in pipelines:
+        registry = ProcessorRegistry(name)
+        registry.register(name, fn, topics, firehose_name=name, needs_content=content)
+        kinesis_lambda_handler({"Records": records}, None, registry.process, None,
+                               prefetch=registry.needs_content if content else False)
+    elapsed = time.perf_counter() - start
+    downloads = next(server.gets) - gets - 1
+    print(f"  {'separate':10s} {elapsed:6.2f} s, {downloads:4d} downloads, "
+          + ", ".join(f"{name} {len(d.delivered)}" for name, d in delivered.items()))
+    separate = {name: sorted(d.delivered) for name, d in delivered.items()}
+
+    # one Lambda for all pipelines
+    delivered = sinks()
+    registry = ProcessorRegistry()
+    for name, fn, topics, content in pipelines:
+        registry.register(name, fn, topics, firehose_name=name, needs_content=content)
+    gets = next(server.gets)
+    start = time.perf_counter()
+    response = registry.lambda_handler({"Records": records}, None, prefetch=True)
+    elapsed = time.perf_counter() - start
+    downloads = next(server.gets) - gets - 1
+    print(f"  {'fanout':10s} {elapsed:6.2f} s, {downloads:4d} downloads, "
+          + ", ".join(f"{name} {len(d.delivered)}" for name, d in delivered.items()))
+
+    assert not response["batchItemFailures"], "records failed"
+    assert downloads == synops, "content downloaded more than once"
+    for name, d in delivered.items():
+        assert sorted(d.delivered) == separate[name], f"{name} rows differ from the separate pipeline"
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("wire", help="bytes per record and decode time of JSON vs MessagePack records")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_wire)
+
+    p = sub.add_parser("fetch", help="serial vs concurrent download of a batch from a local server with latency")
+    p.add_argument("--records", type=int, default=100)
+    p.add_argument("--size", type=int, default=20000)
+    p.add_argument("--latency", type=float, default=0.1)
+    p.set_defaults(func=bench_fetch)
+
+    p = sub.add_parser("probe", help="serial vs batched cache HEAD checks of serialize_wis2_message")
+    p.add_argument("--records", type=int, default=50)
+    p.add_argument("--copies", type=int, default=3)
+    p.add_argument("--latency", type=float, default=0.1)
+    p.set_defaults(func=bench_probe)
+
+    p = sub.add_parser("cache", help="downloads saved by the content cache for copies from several caches")
+    p.add_argument("--records", type=int, default=50)
+    p.add_argument("--copies", type=int, default=3)
+    p.add_argument("--size", type=int, default=50000)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--dir", default="/tmp/wis2mon-benchmark-cache")
+    p.set_defaults(func=bench_cache)
+
+    p = sub.add_parser("validate", help="messages/s of jsonschema.validate vs the precompiled validator")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_validate)
+
+    p = sub.add_parser("integrity", help="integrity verdicts and cost of streaming verification")
+    p.add_argument("--size", type=int, default=10 * 1000 * 1000)
+    p.add_argument("--repeat", type=int, default=10)
+    p.set_defaults(func=bench_integrity)
+
+    p = sub.add_parser("circuit", help="cost of a cache which stops answering with and without the circuit breaker")
+    p.add_argument("--records", type=int, default=30)
+    p.add_argument("--timeout", type=float, default=0.5)
+    p.add_argument("--open-seconds", type=float, default=2)
+    p.set_defaults(func=bench_circuit)
+
+    p = sub.add_parser("replicas", help="download latency from the canonical href vs the fastest replica")
+    p.add_argument("--records", type=int, default=30)
+    p.set_defaults(func=bench_replicas)
+
+    p = sub.add_parser("imports", help="import time of each Lambda entry point, fails above --budget-ms")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--top", type=int, default=5)
+    p.add_argument("--budget-ms", type=float, default=None)
+    p.set_defaults(func=bench_imports)
+
+    p = sub.add_parser("records", help="records/s of the pipeline functions serial, in threads and in processes")
+    p.add_argument("--records", type=int, default=200)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--latency", type=float, default=0.05)
+    p.set_defaults(func=bench_records)
+
+    p = sub.add_parser("firehose", help="chunking and retries of FirehoseSink against a stand-in with failures")
+    p.add_argument("--rows", type=int, default=3000)
+    p.add_argument("--failure-rate", type=float, default=0.1)
+    p.add_argument("--throttle-rate", type=float, default=0.1)
+    p.add_argument("--attempts", type=int, default=8)
+    p.set_defaults(func=bench_firehose)
+
+    p = sub.add_parser("retries", help="records reprocessed when one cache is unreachable and one record is broken")
+    p.add_argument("--records", type=int, default=300)
+    p.add_argument("--unreachable", type=int, default=3, help="invocations until the unreachable cache recovers")
+    p.add_argument("--max-invocations", type=int, default=10)
+    p.add_argument("--latency", type=float, default=0.0)
+    p.set_defaults(func=bench_retries)
+
+    p = sub.add_parser("deadline", help="progress of a batch which does not fit in one invocation, record budgets")
+    p.add_argument("--records", type=int, default=60)
+    p.add_argument("--latency", type=float, default=0.1)
+    p.add_argument("--timeout", type=float, default=2.5)
+    p.add_argument("--reserve", type=float, default=0.5)
+    p.add_argument("--budget", type=float, default=0.5)
+    p.set_defaults(func=bench_deadline)
+
+    p = sub.add_parser("stages", help="per-stage p50/p90/p99 from the EMF metrics of the pipeline functions")
+    p.add_argument("--records", type=int, default=100)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--repeat", type=int, default=100000)
+    p.set_defaults(func=bench_stages)
+
+    p = sub.add_parser("profile", help="cost of the profiling hook, disabled and profiling each invocation")
+    p.add_argument("--records", type=int, default=100)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--repeat", type=int, default=100000)
+    p.set_defaults(func=bench_profile)
+
+    p = sub.add_parser("fanout", help="downloads and time of one Lambda per pipeline vs one processor registry")
+    p.add_argument("--records", type=int, default=100)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.set_defaults(func=bench_fanout)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ setup(
     author='Timo Pröscholdt',
     author_email='tproescholdt@wmo.int',
     install_requires=[
-        'urllib3', 'jsonschema', 'requests',
+        'urllib3', 'jsonschema', 'requests', 'msgpack',
         'importlib-metadata; python_version == "3.8"',
     ],
     packages=find_namespace_packages(where="src"),
@@ -1,2 +1,14 @@
 from .lib import *
-from .wis2_lambda import *
\ No newline at end of file
+from .wis2_lambda import *
+from .wire_format import *
+from .fetch import *
+from .cache import *
+from .errors import *
+from .health import *
+from .replicas import *
+from .parallel import *
+from .firehose import *
+from .deadline import *
+from .metrics import *
+from .profiling import *
+from .processors import *
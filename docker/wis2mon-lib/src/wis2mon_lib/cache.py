@@ -0,0 +1,167 @@
+import logging
+import threading
+import hashlib
+import os
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(notification):
+    """ cache key of the content of a notification: the declared integrity digest, so copies announced with different
+    hrefs share an entry, or the data_id and pubtime if the notification has no integrity (an update of the data
+    is published with a new pubtime). None if neither is available """
+    properties = notification.get("properties") or {}
+    integrity = properties.get("integrity") or {}
+    if integrity.get("method") and integrity.get("value"):
+        return "integrity:{}:{}".format(integrity["method"].lower(), integrity["value"])
+    if properties.get("data_id"):
+        return "data_id:{}:{}".format(properties["data_id"], properties.get("pubtime"))
+    return None
+
+
+class ContentCache:
+    """ LRU cache of downloaded content bounded by max_bytes in memory. With directory, entries evicted from memory
+    are kept in files up to directory_max_bytes, e.g. in /tmp which survives between warm Lambda invocations """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, directory=None, directory_max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.directory_max_bytes = directory_max_bytes
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._files = OrderedDict()
+        self._files_bytes = 0
+
+        self.hits = 0
+        self.file_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # files of a previous instance in the same execution environment, oldest first
+            paths = [os.path.join(directory, f) for f in os.listdir(directory) if not f.endswith(".tmp")]
+            for path in sorted(paths, key=os.path.getmtime):
+                size = os.path.getsize(path)
+                self._files[os.path.basename(path)] = size
+                self._files_bytes += size
+
+    def _file_name(self, key):
+        return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._memory or (self.directory is not None and self._file_name(key) in self._files)
+
+    def get(self, key):
+        """ cached content of key, None on a miss """
+        with self._lock:
+            content = self._memory.get(key)
+            if content is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += len(content)
+                return content
+
+            name = self._file_name(key) if self.directory else None
+            if name not in self._files:
+                self.misses += 1
+                return None
+            self._files.move_to_end(name)
+
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                content = f.read()
+        except OSError as e:
+            logger.warning("cannot read cached content {}: {}".format(name, e))
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.file_hits += 1
+            self.bytes_saved += len(content)
+            self._put_memory(key, content)
+        return content
+
+    def put(self, key, content):
+        if content is None or len(content) > self.max_bytes:
+            return
+        with self._lock:
+            self._put_memory(key, content)
+
+    def _put_memory(self, key, content):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = content
+        self._memory_bytes += len(content)
+
+        while self._memory_bytes > self.max_bytes:
+            evicted_key, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.evictions += 1
+            if self.directory:
+                self._put_file(evicted_key, evicted)
+
+    def _put_file(self, key, content):
+        name = self._file_name(key)
+        if name in self._files or len(content) > self.directory_max_bytes:
+            return
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning("cannot write cached content {}: {}".format(name, e))
+            return
+        self._files[name] = len(content)
+        self._files_bytes += len(content)
+
+        while self._files_bytes > self.directory_max_bytes:
+            evicted, size = self._files.popitem(last=False)
+            self._files_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, evicted))
+            except OSError:
+                pass
+
+    def stats(self, reset=False):
+        with self._lock:
+            ret = {
+                "hits": self.hits,
+                "file_hits": self.file_hits,
+                "misses": self.misses,
+                "bytes_saved": self.bytes_saved,
+                "evictions": self.evictions,
+                "entries": len(self._memory),
+                "bytes": self._memory_bytes,
+                "file_entries": len(self._files),
+                "file_bytes": self._files_bytes,
+            }
+            if reset:
+                self.hits = self.file_hits = self.misses = self.bytes_saved = self.evictions = 0
+            return ret
+
+
+def default_content_cache():
+    """ content cache configured by CONTENT_CACHE_BYTES (0 disables the cache), CONTENT_CACHE_DIR and
+    CONTENT_CACHE_DIR_BYTES """
+    max_bytes = int(os.getenv("CONTENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+    if max_bytes <= 0:
+        return None
+    return ContentCache(
+        max_bytes=max_bytes,
+        directory=os.getenv("CONTENT_CACHE_DIR") or None,
+        directory_max_bytes=int(os.getenv("CONTENT_CACHE_DIR_BYTES", str(256 * 1024 * 1024))),
+    )
+
+
+# shared by all pipelines of a Lambda, replace or set to None to change or disable caching
+content_cache = default_content_cache()
@@ -0,0 +1,57 @@
+import contextvars
+import contextlib
+import time
+import os
+
+from .errors import RetryError
+
+# time kept free at the end of an invocation to deliver the output and report the checkpoint
+RESERVE_SECONDS = float(os.getenv("DEADLINE_RESERVE_SECONDS", "30"))
+# time each record may take, 0 for no limit
+RECORD_BUDGET = float(os.getenv("RECORD_BUDGET_SECONDS", "0")) or None
+
+# time.monotonic() by which the record being processed must be done, None without a deadline
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(RetryError):
+    """ the record was not processed, or its processing was stopped, because its time ran out """
+    pass
+
+
+def invocation_deadline(context, reserve=None):
+    """ time.monotonic() at which an invocation should stop taking new records, reserve seconds before the Lambda
+    times out. None if context does not tell the remaining time """
+    reserve = RESERVE_SECONDS if reserve is None else reserve
+    remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if remaining is None:
+        return None
+    return time.monotonic() + remaining() / 1000 - reserve
+
+
+@contextlib.contextmanager
+def record_deadline(end):
+    """ downloads in this block stop at end, a time.monotonic() or None """
+    token = _deadline.set(end)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_timeout(timeout):
+    """ timeout limited to the time left for the current record. Raises DeadlineExceeded if no time is left """
+    end = _deadline.get()
+    if end is None:
+        return timeout
+    remaining = end - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("no time left for the record")
+    return min(timeout, remaining) if timeout else remaining
+
+
+def check_deadline():
+    """ raises DeadlineExceeded once the time of the current record is up """
+    end = _deadline.get()
+    if end is not None and time.monotonic() >= end:
+        raise DeadlineExceeded("no time left for the record")
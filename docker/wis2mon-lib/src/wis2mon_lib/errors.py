@@ -0,0 +1,7 @@
+class RetryError(Exception):
+    """ processing failed for a reason which may go away, e.g. an unreachable cache, the record can be retried """
+    pass
+
+class NonRecoverableError(Exception):
+    """ processing of the record can never succeed, e.g. content which cannot be decoded """
+    pass
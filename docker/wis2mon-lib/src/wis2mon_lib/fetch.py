@@ -0,0 +1,330 @@
+import logging
+import threading
+import hashlib
+import base64
+import binascii
+import random
+import time
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from . import cache, health
+from .errors import NonRecoverableError
+from .deadline import DeadlineExceeded, remaining_timeout, check_deadline
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 16
+MAX_PER_HOST = 4
+# larger downloads are aborted, 0 disables the limit
+MAX_CONTENT_SIZE = int(os.getenv("CONTENT_MAX_BYTES", str(64 * 1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+
+# created on first use, importing requests is a noticeable part of a cold start
+requests_session = None
+_session_lock = threading.Lock()
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+# content downloaded ahead by prefetch_contents and HEAD results of probe_cache, by URL
+_prefetched = {}
+_probed = {}
+
+
+class ContentTooLarge(NonRecoverableError):
+    pass
+
+
+def new_hash(integrity):
+    """ hash object for the method of properties.integrity, None without integrity or for unsupported methods """
+    if not isinstance(integrity, dict) or not isinstance(integrity.get("method"), str):
+        return None
+    try:
+        # sha3-256 is sha3_256 in hashlib
+        return hashlib.new(integrity["method"].lower().replace("-", "_"))
+    except ValueError:
+        return None
+
+
+def integrity_verdict(hasher, integrity):
+    """ "valid" or "invalid" if the digest of hasher matches the value of integrity, base64 (as specified by WIS2)
+    or hex encoded, "unsupported" for unknown methods and None without integrity """
+    if not isinstance(integrity, dict) or not integrity.get("method"):
+        return None
+    if hasher is None:
+        return "unsupported"
+    value = integrity.get("value") or ""
+    if not isinstance(value, str):
+        return "invalid"
+    if value.lower() == hasher.hexdigest():
+        return "valid"
+    try:
+        return "valid" if base64.b64decode(value) == hasher.digest() else "invalid"
+    except (binascii.Error, ValueError):
+        return "invalid"
+
+
+def verify_integrity(content, integrity):
+    """ integrity verdict of content already in memory, e.g. embedded in the notification """
+    hasher = new_hash(integrity)
+    if hasher is not None:
+        hasher.update(content)
+    return integrity_verdict(hasher, integrity)
+
+
+@timed("download")
+def download_content(url, timeout=4, integrity=None, max_size=None):
+    """ download url, computing the digest declared by integrity while the content arrives.
+    Returns the content (None if the URL does not exist) and the integrity verdict. Raises ContentTooLarge when the
+    content exceeds max_size bytes (MAX_CONTENT_SIZE by default) and an exception on timeouts or connection problems """
+    max_size = MAX_CONTENT_SIZE if max_size is None else max_size
+    hasher = new_hash(integrity)
+
+    with _request("GET", url, timeout, stream=True) as resp:
+        if not resp:
+            return None, None
+
+        length = resp.headers.get("Content-Length")
+        if max_size and length and length.isdigit() and int(length) > max_size:
+            raise ContentTooLarge(f"{url} has {length} bytes, more than {max_size}")
+
+        chunks = []
+        size = 0
+        try:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                # a slow download stops when the time of the record is up
+                check_deadline()
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise ContentTooLarge(f"{url} has more than {max_size} bytes")
+                if hasher is not None:
+                    hasher.update(chunk)
+                chunks.append(chunk)
+        except _request_exception():
+            # e.g. a read timeout or a connection dropped in the middle of the content
+            if health.host_health:
+                health.host_health.failure(url)
+            raise
+
+        logger.debug("downloaded {} bytes from {} in {}".format(size, url, resp.elapsed))
+
+    return b"".join(chunks), integrity_verdict(hasher, integrity)
+
+
+def download(url, timeout=4):
+    """ download url. Returns None if the URL does not exist, raises an exception on timeouts or connection problems """
+    return download_content(url, timeout=timeout)[0]
+
+
+@timed("head")
+def head(url, timeout=4):
+    """ HEAD url, returns the status code and the Content-Length header (-1 if missing) of url itself, redirects
+    are not followed """
+    resp = _request("HEAD", url, timeout, allow_redirects=False)
+    return resp.status_code, resp.headers.get("Content-Length", -1)
+
+
+def _request_exception():
+    import requests
+    return requests.RequestException
+
+
+def _request(method, url, timeout, **kwargs):
+    """ request under the circuit breaker of the host: fails with RetryError while the host is down, the timeout
+    adapts to the latencies of the host, connection problems and server errors count as failures """
+    session = get_session()
+    limited = remaining_timeout(timeout)
+    host_health = health.host_health
+    if host_health is None:
+        try:
+            return session.request(method, url, timeout=limited, **kwargs)
+        except _request_exception() as e:
+            if limited < timeout:
+                raise DeadlineExceeded(f"no time left for the record downloading {url}: {e}")
+            raise
+
+    timeout = host_health.allow(url, timeout)
+    limited = min(timeout, limited)
+    start = time.monotonic()
+    try:
+        resp = session.request(method, url, timeout=limited, **kwargs)
+    except _request_exception() as e:
+        if limited < timeout:
+            # cut short by the deadline of the record, says nothing about the host
+            host_health.release(url)
+            raise DeadlineExceeded(f"no time left for the record downloading {url}: {e}")
+        host_health.failure(url)
+        raise
+    if resp.status_code >= 500:
+        host_health.failure(url)
+    else:
+        host_health.success(url, time.monotonic() - start)
+    return resp
+
+
+def canonical_href(notification):
+    """ URL of the content of a notification, None if the content is embedded """
+    content = notification.get("properties", {}).get("content", {})
+    if "value" in content or "ref" in content:
+        return None
+    return [l["href"] for l in notification["links"] if l["rel"] == "canonical"][0]
+
+
+def get_session():
+    """ requests session shared by all downloads """
+    global requests_session
+    with _session_lock:
+        if requests_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            # keep enough pooled connections per host for concurrent downloads
+            session.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=MAX_WORKERS))
+            session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=MAX_WORKERS))
+            requests_session = session
+    return requests_session
+
+
+def _host_limit(url, max_per_host):
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        limit = _host_limits.get((host, max_per_host))
+        if limit is None:
+            limit = _host_limits[(host, max_per_host)] = threading.BoundedSemaphore(max_per_host)
+    return limit
+
+
+def _fetch(request, url, end, timeout, max_per_host):
+    remaining = end - time.monotonic() if end else None
+    if remaining is not None and remaining <= 0:
+        raise TimeoutError(f"deadline passed before downloading {url}")
+
+    limit = _host_limit(url, max_per_host)
+    if not limit.acquire(timeout=remaining):
+        raise TimeoutError(f"deadline passed waiting for a connection to download {url}")
+    try:
+        remaining = end - time.monotonic() if end else timeout
+        if remaining <= 0:
+            raise TimeoutError(f"deadline passed before downloading {url}")
+        return request(url, timeout=min(timeout, remaining))
+    finally:
+        limit.release()
+
+
+def fetch_urls(urls, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST, deadline=None, timeout=4, request=download):
+    """ download urls concurrently, with at most max_per_host parallel downloads per host and an overall deadline
+    in seconds. Returns one result per URL in input order: the content, None if the URL does not exist,
+    or the exception raised by the download. Identical URLs are downloaded once.
+    request(url, timeout) is called for each URL, e.g. head to check URLs instead of downloading them """
+    end = time.monotonic() + deadline if deadline else None
+    unique = list(dict.fromkeys(urls))
+
+    results = {}
+    if unique:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unique))) as executor:
+            futures = {url: executor.submit(_fetch, request, url, end, timeout, max_per_host) for url in unique}
+            for url, future in futures.items():
+                try:
+                    results[url] = future.result()
+                except Exception as e:
+                    logger.debug("cannot download {}: {}".format(url, e))
+                    results[url] = e
+
+    return [results[url] for url in urls]
+
+
+def fetch_contents(notifications, **kwargs):
+    """ content of a batch of notifications, in input order. Content which is not embedded is downloaded concurrently,
+    see fetch_urls for the arguments and the possible results """
+    from .lib import handle_content
+
+    hrefs = [canonical_href(n) for n in notifications]
+    downloaded = iter(fetch_urls([h for h in hrefs if h], **kwargs))
+
+    ret = []
+    for notification, href in zip(notifications, hrefs):
+        if href:
+            ret.append(next(downloaded))
+        else:
+            try:
+                ret.append(handle_content(notification))
+            except Exception as e:
+                ret.append(e)
+    return ret
+
+
+def prefetch_contents(notifications, **kwargs):
+    """ download the content of a batch of notifications concurrently, handle_content then returns it without
+    downloading. Content already in the content cache, or announced again with another href, is not downloaded.
+    Call clear_prefetched() once the batch is processed """
+    from .replicas import download_notification
+
+    hrefs, keys, by_href = [], set(), {}
+    for n in notifications:
+        href = canonical_href(n)
+        if not href or href in _prefetched:
+            continue
+        key = cache.content_key(n) if cache.content_cache else None
+        if key is not None and (key in keys or key in cache.content_cache):
+            # copy of content which is cached or downloaded from another href
+            continue
+        keys.add(key)
+        hrefs.append(href)
+        by_href[href] = n
+
+    def request(url, timeout):
+        return download_notification(by_href[url], timeout=timeout)
+
+    _prefetched.update(zip(hrefs, fetch_urls(hrefs, request=request, **kwargs)))
+    logger.debug("prefetched {} URLs".format(len(hrefs)))
+
+
+def probe_cache(notifications, sample=None, **kwargs):
+    """ check the canonical URLs of the cache notifications of a batch concurrently with HEAD requests,
+    serialize_wis2_message then uses the results instead of checking each URL itself.
+    With sample at most sample random URLs per host are checked, the others are recorded as not checked """
+    by_host = {}
+    for n in notifications:
+        if n.get("_meta", {}).get("topic", "").split("/")[0] != "cache":
+            continue
+        hrefs = [l["href"] for l in n.get("links", []) if l.get("rel") == "canonical"]
+        if hrefs and hrefs[-1] not in _probed:
+            by_host.setdefault(urlparse(hrefs[-1]).netloc, {})[hrefs[-1]] = True
+
+    urls = []
+    for host, host_urls in by_host.items():
+        host_urls = list(host_urls)
+        if sample and len(host_urls) > sample:
+            for url in host_urls:
+                _probed[url] = (None, None)
+            host_urls = random.sample(host_urls, sample)
+        urls.extend(host_urls)
+
+    _probed.update(zip(urls, fetch_urls(urls, request=head, **kwargs)))
+    logger.debug("probed {} URLs on {} hosts".format(len(urls), len(by_host)))
+
+
+def take_prefetched(url):
+    """ returns (True, (content, integrity verdict, href which served it) or exception) if url was prefetched,
+    otherwise (False, None) """
+    if url in _prefetched:
+        return True, _prefetched[url]
+    return False, None
+
+
+def take_probed(url):
+    """ returns (True, (status, content length) or exception) if url was probed, otherwise (False, None) """
+    if url in _probed:
+        return True, _probed[url]
+    return False, None
+
+
+def clear_prefetched():
+    """ forget the results of prefetch_contents and probe_cache """
+    _prefetched.clear()
+    _probed.clear()
@@ -0,0 +1,172 @@
+import logging
+import threading
+import random
+import json
+import time
+import os
+
+from .errors import RetryError, NonRecoverableError
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# limits of put_record_batch
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+MAX_RECORD_BYTES = 1000 * 1024
+
+# created on first use and reused by warm invocations, importing boto3 is a noticeable part of a cold start
+firehose_client = None
+_client_lock = threading.Lock()
+
+
+class DocumentTooLarge(NonRecoverableError):
+    """ a document which does not fit into one Firehose record """
+    pass
+
+
+def encode_lines(documents):
+    """ documents as JSON lines. Raises DocumentTooLarge for a line larger than a Firehose record and
+    NonRecoverableError for a document which is not JSON serializable """
+    try:
+        lines = [(json.dumps(d) + "\n").encode() for d in documents]
+    except (TypeError, ValueError) as e:
+        raise NonRecoverableError(f"document cannot be serialized: {e}")
+    for line in lines:
+        if len(line) > MAX_RECORD_BYTES:
+            raise DocumentTooLarge(f"document of {len(line)} bytes exceeds the Firehose record size of {MAX_RECORD_BYTES}")
+    return lines
+
+
+def get_client():
+    """ firehose client shared by all sinks """
+    global firehose_client
+    with _client_lock:
+        if firehose_client is None:
+            import boto3
+            firehose_client = boto3.client("firehose")
+    return firehose_client
+
+
+class FirehoseSink:
+    """ sends JSON documents to a Firehose delivery stream, one line each.
+
+    The lines are sent in put_record_batch calls of at most 500 records and 4 MiB. With pack several lines are
+    concatenated into one Firehose record of up to 1000 KiB, the destination still receives one document per line.
+    Entries which fail, as reported by FailedPutCount, and calls which fail as a whole are retried up to max_attempts
+    times with jittered exponential backoff; RetryError is raised if entries are still not delivered """
+
+    def __init__(self, delivery_stream, client=None, pack=False, max_attempts=5, base_delay=0.1, max_delay=5.0,
+                 sleep=time.sleep):
+        self.delivery_stream = delivery_stream
+        self.client = client
+        self.pack = pack
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+
+        self.lines = 0
+        self.records = 0
+        self.calls = 0
+        self.retried = 0
+        self.bytes = 0
+
+    def _records(self, lines):
+        self.lines += len(lines)
+        if not self.pack:
+            return lines
+
+        records, current, size = [], [], 0
+        for line in lines:
+            if current and size + len(line) > MAX_RECORD_BYTES:
+                records.append(b"".join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line)
+        if current:
+            records.append(b"".join(current))
+        return records
+
+    def _batches(self, records):
+        batch, size = [], 0
+        for record in records:
+            if batch and (len(batch) == MAX_BATCH_RECORDS or size + len(record) > MAX_BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(record)
+            size += len(record)
+        if batch:
+            yield batch
+
+    def _put_batch(self, batch):
+        client = self.client or get_client()
+        pending = batch
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self.retried += len(pending)
+                # full jitter
+                self.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+            self.calls += 1
+            try:
+                with timed("firehose_put"):
+                    response = client.put_record_batch(
+                        DeliveryStreamName=self.delivery_stream,
+                        Records=[{"Data": record} for record in pending]
+                    )
+            except Exception as e:
+                # e.g. throttling of the whole call, all entries are retried
+                logger.warning("put_record_batch of {} records failed: {}".format(len(pending), e))
+                continue
+
+            if not response.get("FailedPutCount"):
+                return
+            # responses are in the order of the records
+            failed = [(r, resp) for r, resp in zip(pending, response["RequestResponses"]) if resp.get("ErrorCode")]
+            logger.warning("{} of {} records not delivered to firehose: {}".format(
+                len(failed), len(pending), failed[0][1].get("ErrorCode")))
+            pending = [r for r, _ in failed]
+
+        raise RetryError(f"{len(pending)} records not delivered to {self.delivery_stream} "
+                         f"after {self.max_attempts} attempts")
+
+    def send(self, documents):
+        """ send documents, JSON serializable, returns the number of Firehose records sent. Raises DocumentTooLarge
+        before anything is sent if one of them does not fit into a Firehose record """
+        return self.send_lines(encode_lines(documents))
+
+    def send_lines(self, lines):
+        """ send lines returned by encode_lines, returns the number of Firehose records sent """
+        records = self._records(lines)
+        for batch in self._batches(records):
+            self._put_batch(batch)
+            self.records += len(batch)
+            self.bytes += sum(len(r) for r in batch)
+        logger.info("submitted {} lines in {} records to {}".format(len(lines), len(records),
+                                                                    self.delivery_stream))
+        return len(records)
+
+    def stats(self, reset=False):
+        ret = {
+            "lines": self.lines,
+            "records": self.records,
+            "calls": self.calls,
+            "retried": self.retried,
+            "bytes": self.bytes,
+        }
+        if reset:
+            self.lines = self.records = self.calls = self.retried = self.bytes = 0
+        return ret
+
+
+_sinks = {}
+
+
+def firehose_sink(delivery_stream):
+    """ sink of delivery_stream, kept for warm invocations. FIREHOSE_PACK enables packing several lines into each
+    Firehose record """
+    sink = _sinks.get(delivery_stream)
+    if sink is None:
+        pack = os.getenv("FIREHOSE_PACK", "False").lower() in ('true', '1', 't', 'yes')
+        sink = _sinks[delivery_stream] = FirehoseSink(delivery_stream, pack=pack)
+    return sink
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+import os
+
+from collections import deque
+from urllib.parse import urlparse
+
+from .errors import RetryError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class _Host:
+
+    def __init__(self, window):
+        self.state = CLOSED
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at = None
+        self.trial = False
+        self.latencies = deque(maxlen=window)
+
+
+class HostHealth:
+    """ per host circuit breaker with adaptive timeouts for the global caches.
+
+    Latency and error rate are tracked as exponentially weighted moving averages. Once at least min_requests requests
+    were made and the error rate exceeds error_threshold the circuit opens and requests fail immediately with
+    RetryError. After open_seconds a single trial request is let through (half open): its success closes the circuit,
+    its failure opens it again. The timeout of a request is timeout_factor times the p99 of the recent latencies of the
+    host, between min_timeout and the timeout requested by the caller """
+
+    def __init__(self, alpha=0.2, error_threshold=0.5, min_requests=5, open_seconds=30, min_timeout=0.5,
+                 timeout_factor=2.0, window=200, clock=time.monotonic):
+        self.alpha = alpha
+        self.error_threshold = error_threshold
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.min_timeout = min_timeout
+        self.timeout_factor = timeout_factor
+        self.window = window
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, url):
+        host = urlparse(url).netloc
+        h = self._hosts.get(host)
+        if h is None:
+            h = self._hosts[host] = _Host(self.window)
+        return host, h
+
+    def allow(self, url, timeout):
+        """ timeout to use for a request to url, at most timeout. Raises RetryError while the circuit of the host is
+        open, every allowed request must be followed by success, failure or release """
+        with self._lock:
+            host, h = self._host(url)
+
+            if h.state == OPEN:
+                if self.clock() - h.opened_at < self.open_seconds:
+                    h.rejected += 1
+                    raise RetryError(f"circuit open for {host}")
+                h.state = HALF_OPEN
+                h.trial = False
+                logger.info(f"circuit half open for {host}")
+
+            if h.state == HALF_OPEN:
+                if h.trial:
+                    h.rejected += 1
+                    raise RetryError(f"circuit half open for {host}, waiting for the trial request")
+                h.trial = True
+                # the trial gets the full timeout, the latencies from before the outage say little
+                return timeout
+
+            if len(h.latencies) < self.min_requests:
+                return timeout
+            latencies = sorted(h.latencies)
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            return min(timeout, max(self.min_timeout, p99 * self.timeout_factor))
+
+    def success(self, url, latency):
+        with self._lock:
+            host, h = self._host(url)
+            h.requests += 1
+            h.latency = latency if h.latency is None else self.alpha * latency + (1 - self.alpha) * h.latency
+            h.error_rate = (1 - self.alpha) * h.error_rate
+            h.latencies.append(latency)
+            if h.state != CLOSED:
+                logger.info(f"circuit closed for {host}")
+                h.state = CLOSED
+                h.error_rate = 0.0
+                h.trial = False
+
+    def failure(self, url):
+        with self._lock:
+            host, h = self._host(url)
+            h.requests += 1
+            h.failures += 1
+            h.error_rate = self.alpha + (1 - self.alpha) * h.error_rate
+            if h.state == HALF_OPEN or (h.state == CLOSED and h.requests >= self.min_requests
+                                        and h.error_rate > self.error_threshold):
+                logger.warning(f"circuit open for {host}, error rate {h.error_rate:.2f}")
+                h.state = OPEN
+                h.opened_at = self.clock()
+                h.trial = False
+
+    def release(self, url):
+        """ an allowed request ended without telling whether the host works, e.g. cut short by the deadline of the
+        record. A half open host lets the next request through as trial """
+        with self._lock:
+            self._host(url)[1].trial = False
+
+    def state(self, url):
+        with self._lock:
+            return self._host(url)[1].state
+
+    def rank(self, urls):
+        """ urls ordered by preference: hosts with a closed circuit first, then by latency. Hosts without requests yet
+        come first among their state, so their latency gets known """
+        with self._lock:
+            def key(url):
+                h = self._host(url)[1]
+                return (h.state != CLOSED, h.latency or 0.0)
+            return sorted(urls, key=key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                host: {
+                    "state": h.state,
+                    "latency": round(h.latency, 3) if h.latency is not None else None,
+                    "error_rate": round(h.error_rate, 3),
+                    "requests": h.requests,
+                    "failures": h.failures,
+                    "rejected": h.rejected,
+                } for host, h in self._hosts.items()
+            }
+
+
+def default_host_health():
+    """ circuit breaker configured by CIRCUIT_BREAKER (disabled with false), CIRCUIT_ERROR_THRESHOLD and
+    CIRCUIT_OPEN_SECONDS """
+    if os.getenv("CIRCUIT_BREAKER", "True").lower() not in ('true', '1', 't', 'yes'):
+        return None
+    return HostHealth(
+        error_threshold=float(os.getenv("CIRCUIT_ERROR_THRESHOLD", "0.5")),
+        open_seconds=float(os.getenv("CIRCUIT_OPEN_SECONDS", "30")),
+    )
+
+
+# shared by all requests of a Lambda, replace or set to None to change or disable the circuit breaker
+host_health = default_host_health()
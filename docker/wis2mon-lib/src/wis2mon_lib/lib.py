@@ -1,12 +1,19 @@
 #import urllib3
+import contextvars
+import contextlib
 import logging
 import json
 import base64
-import requests
 
 from datetime import datetime
-from jsonschema import validate
-from jsonschema.exceptions import ValidationError as JSONSchemaValidationError
+from urllib.parse import urlparse
+
+from . import cache
+from .cache import content_key
+from .fetch import download, head, take_prefetched, take_probed, new_hash, verify_integrity
+from .replicas import download_notification
+from .errors import NonRecoverableError
+from .metrics import timed
 
 logger = logging.getLogger(__name__)
 
@@ -19,53 +26,197 @@ except ImportError:
     # Try backported to PY<37 `importlib_resources`.
     import importlib_resources as pkg_resources
 from . import resources
-try:
-    file = "notification_schema.json"
-    inp_file = (pkg_resources.files(resources) / file)
-    with inp_file.open("rb") as f:  # or "rt" as text file with universal newlines
-        schema = json.load(f)
-except AttributeError:
-    # Python < PY3.9, fall back to method deprecated in PY3.11.
-    schema = json.loads(pkg_resources.read_text(resources, file))
 
-requests_session = requests.Session()
+# loaded and compiled on the first validation, only the notifications pipeline validates
+schema = None
+validator = None
+
+# content of the notifications handled in a shared_content() block, by id() of the notification
+_shared_content = contextvars.ContextVar("shared_content", default=None)
+
+
+def load_schema():
+    """ the WIS2 notification message schema """
+    global schema
+    if schema is None:
+        try:
+            file = "notification_schema.json"
+            inp_file = (pkg_resources.files(resources) / file)
+            with inp_file.open("rb") as f:  # or "rt" as text file with universal newlines
+                schema = json.load(f)
+        except AttributeError:
+            # Python < PY3.9, fall back to method deprecated in PY3.11.
+            schema = json.loads(pkg_resources.read_text(resources, file))
+    return schema
+
 
+def get_validator():
+    """ validator for the schema, checked and compiled once, jsonschema.validate would do this for every message """
+    global validator
+    if validator is None:
+        from jsonschema.validators import validator_for
+
+        validator_class = validator_for(load_schema())
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+    return validator
+
+s3_client = None
+
+
+
+def resolve_content_reference(ref):
+    """ returns the content the bridge has offloaded to ref (s3://bucket/key or file:///path) """
+    global s3_client
+
+    url = urlparse(ref)
+    if url.scheme == "s3":
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client("s3")
+        return s3_client.get_object(Bucket=url.netloc, Key=url.path.lstrip("/"))["Body"].read()
+    elif url.scheme == "file":
+        with open(url.path, "rb") as f:
+            return f.read()
+    else:
+        raise NonRecoverableError(f"content reference {ref} not supported")
+
+
+@contextlib.contextmanager
+def shared_content():
+    """ in this block handle_content gets the content of a notification once, further calls for the same notification
+    object return it (or raise the same error) without downloading again, e.g. for several processors """
+    token = _shared_content.set({})
+    try:
+        yield
+    finally:
+        _shared_content.reset(token)
 
 
 def handle_content(notification):
     """ this functions returns content to which the notification corresponds.
-    Returns None if URL does not exist. Returns an exeption if there is a timeout or other connection problem """ 
+    Returns None if URL does not exist. Returns an exeption if there is a timeout or other connection problem.
+    The integrity verdict of the content is recorded in notification["_meta"]["integrity"] """ 
+    shared = _shared_content.get()
+    if shared is None:
+        return _handle_content(notification)
+
+    key = id(notification)
+    if key not in shared:
+        try:
+            shared[key] = (_handle_content(notification), None)
+        except Exception as e:
+            shared[key] = (None, e)
+    content, error = shared[key]
+    if error is not None:
+        raise error
+    return content
+
+
+def _handle_content(notification):
+
+    integrity = notification["properties"].get("integrity")
 
-    # get the content. If it is embedded, we use this, otherwise fetch it
+    # get the content. If it is embedded we use this, otherwise fetch it or get it from where the bridge offloaded it
     if "content" in notification["properties"] and "value" in notification["properties"]["content"]:
-        encoding_method =  notification["properties"]["content"].get("encoding","base64").lower()
+        content = _embedded_content(notification["properties"]["content"])
+        _record_integrity(notification, verify_integrity(content, integrity))
+        return content
 
-        if encoding_method == "base64":
-            content = base64.b64decode(notification["properties"]["content"]["value"])
-        elif encoding_method == "utf8" or encoding_method == "utf-8":
-            content = notification["properties"]["content"]["value"].encode("utf8")
-        else:
-            raise Exception(f"encoding method {encoding_method} not supported")
+    # copies of the same data announced by several brokers and caches share a cache entry
+    key = content_key(notification) if cache.content_cache else None
+    content = cache.content_cache.get(key) if key else None
+    if content is not None:
+        # only content which matched its digest is cached
+        _record_integrity(notification, None if not integrity else "valid" if new_hash(integrity) else "unsupported")
+        return content
+
+    if "content" in notification["properties"] and "ref" in notification["properties"]["content"]:
+        content = resolve_content_reference(notification["properties"]["content"]["ref"])
+        verdict = verify_integrity(content, integrity)
     else:
         url = [ l["href"] for l in notification["links"] if l["rel"] == "canonical" ][0]
-        #resp =  http.request('GET', url) 
-        resp = requests_session.request("GET",url, timeout=4)
-        logger.debug("downloaded {} in {}".format(url,resp.elapsed))
-        
-        content =  resp.content if resp else None
-    
+
+        # downloaded ahead together with the rest of the batch, see fetch.prefetch_contents
+        prefetched, result = take_prefetched(url)
+        if not prefetched:
+            #resp =  http.request('GET', url) 
+            result = download_notification(notification, timeout=4)
+        elif isinstance(result, Exception):
+            raise result
+        content, verdict, served_by = result
+        if "_meta" in notification:
+            # the canonical href or, with replica selection, another cache with the same data
+            notification["_meta"]["replica"] = served_by
+
+    if content is not None:
+        _record_integrity(notification, verdict)
+        if verdict == "invalid":
+            logger.warning("content of {} does not match its {} digest".format(notification.get("id"), integrity.get("method")))
+        elif key:
+            cache.content_cache.put(key, content)
     return content
 
 
+def _content_encoding(content):
+    """ lower case encoding of properties.content, None for an encoding which is not a string """
+    encoding = content.get("encoding", "base64")
+    return encoding.lower() if isinstance(encoding, str) else None
+
+
+def _embedded_content(content):
+    """ the bytes of properties.content.value, NonRecoverableError if they cannot be decoded """
+    encoding_method = _content_encoding(content)
+    value = content["value"]
+    if encoding_method == "base64":
+        try:
+            with timed("decode"):
+                return base64.b64decode(value)
+        except (ValueError, TypeError) as e:
+            raise NonRecoverableError(f"embedded content is not valid base64: {e}")
+    elif encoding_method == "utf8" or encoding_method == "utf-8":
+        if not isinstance(value, str):
+            raise NonRecoverableError("embedded utf8 content is not a string")
+        return value.encode("utf8")
+    raise NonRecoverableError(f"encoding method {content.get('encoding')} not supported")
+
+
+def _record_integrity(notification, verdict):
+    if "_meta" in notification:
+        notification["_meta"]["integrity"] = verdict
+
+
+@timed("validate")
 def validate_wis2_message(j):
-    try:
-        validate(instance=j, schema=schema)
+    # is_valid stops at the first error instead of collecting them
+    if get_validator().is_valid(j):
         return True
-    except JSONSchemaValidationError as e:
-        logger.debug("invalid schema {}".format(j))
-        return False
+    logger.debug("invalid schema {}".format(j))
+    return False
+
+
+def rehydrated(notification):
+    """ the notification as it was published, with the content the bridge offloaded to properties.content.ref
+    embedded again, resolved by handle_content """
+    content = notification.get("properties", {}).get("content")
+    if not isinstance(content, dict) or "ref" not in content or "value" in content:
+        return notification
+    data = handle_content(notification) or b""
+    if _content_encoding(content) in ("utf8", "utf-8"):
+        value = data.decode("utf8")
+    else:
+        value = base64.b64encode(data).decode()
+    content = {k: v for k, v in content.items() if k != "ref"}
+    content["value"] = value
+    return dict(notification, properties=dict(notification["properties"], content=content))
 
 
+def validate_many(notifications):
+    """ validation result of each notification, in input order """
+    return [validate_wis2_message(rehydrated(j)) for j in notifications]
+
+
+@timed("serialize")
 def serialize_wis2_message(notification,validate=True,check_cache=True):
 
     logger.debug("serializing: " + json.dumps(notification))
@@ -79,7 +230,8 @@ def serialize_wis2_message(notification,validate=True,check_cache=True):
             "meta_broker" : notification["_meta"]["broker"],
             "meta_topic" : notification["_meta"]["topic"],
             "meta_lambda_datetime" : datetime.now().isoformat(),
-            "meta_validates" : validate_wis2_message(notification) if validate else None
+            # validated as published, the bridge may have offloaded the content
+            "meta_validates" : validate_wis2_message(rehydrated(notification)) if validate else None
         }
 
         properties =  notification.get("properties",{})
@@ -92,7 +244,7 @@ def serialize_wis2_message(notification,validate=True,check_cache=True):
         resp["content_size"] = content.get("size",None)
 
         integrity = properties.get("integrity",{}) 
-        resp["integrity_method"] = integrity.get("method",None)
+        resp["integrity_method"] = integrity.get("method",None) if isinstance(integrity, dict) else None
         
         resp["canonical_href"] = None
         resp["canonical_type"] = None
@@ -103,29 +255,47 @@ def serialize_wis2_message(notification,validate=True,check_cache=True):
 
         resp["meta_content_embedded"] = "content" in properties # is the content embedded?
 
+        # valid, invalid or unsupported, verified by handle_content or here for embedded content
+        if "integrity" in notification["_meta"]:
+            resp["meta_integrity"] = notification["_meta"]["integrity"]
+        elif "value" in content and _content_encoding(content) in ("base64", "utf8", "utf-8"):
+            try:
+                resp["meta_integrity"] = verify_integrity(_embedded_content(content), integrity)
+            except NonRecoverableError:
+                # content which cannot be decoded does not match any digest
+                resp["meta_integrity"] = "invalid"
+        else:
+            resp["meta_integrity"] = None
+        resp["meta_replica"] = notification["_meta"].get("replica")
+
         temp = resp["meta_topic"].split("/")
         resp["meta_source"] = temp[0] if temp else None       
         if resp.get("meta_source",None) == "cache" and check_cache :
             
             url = resp["canonical_href"]
             if url:
-                logging.debug("checking URL:" + url)
-                try:
-                    #request = http.request('HEAD', url) 
-                    #resp["meta_cache_status"] = request.status
-                    response = requests_session.head(url)
-                    resp["meta_cache_status"] = response.status_code
-                    resp["meta_remote_content_size"] = response.headers.get("Content-Length",-1)
-                    
-                except Exception as e:
-                    logging.error("cannot download "+url+","+str(e))
+                # checked together with the rest of the batch, see fetch.probe_cache
+                probed, result = take_probed(url)
+                if not probed:
+                    logging.debug("checking URL:" + url)
+                    try:
+                        #request = http.request('HEAD', url) 
+                        #resp["meta_cache_status"] = request.status
+                        result = head(url, timeout=4)
+                    except Exception as e:
+                        result = e
+
+                if isinstance(result, Exception):
+                    logging.error("cannot download "+url+","+str(result))
                     resp["meta_cache_status"] = -9
                     resp["meta_remote_content_size"] = -9
+                else:
+                    resp["meta_cache_status"], resp["meta_remote_content_size"] = result
         else:
             resp["meta_cache_status"] = None
     
     except KeyError as e:
-       logger.ERROR("error in serializing {}".format(notification),exc_info=True) 
-       raise Exception("processing error in serialization")
+       logger.error("error in serializing {}".format(notification),exc_info=True) 
+       raise NonRecoverableError("processing error in serialization")
     
     return resp
\ No newline at end of file
@@ -0,0 +1,193 @@
+import contextlib
+import logging
+import threading
+import math
+import json
+import time
+import sys
+
+logger = logging.getLogger(__name__)
+
+# EMF accepts at most 100 values per metric
+MAX_VALUES = 100
+
+
+class Histogram:
+    """ values counted in logarithmic buckets, each bucket is represented by its upper bound.
+    With a growth factor of 1.2 a reported value is at most 20% above the observed one """
+
+    def __init__(self, factor=1.2):
+        self.log_factor = math.log(factor)
+        self.factor = factor
+        self.buckets = {}
+
+    def add(self, value):
+        bucket = math.ceil(math.log(value) / self.log_factor) if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def _sorted(self):
+        items = sorted(self.buckets.items(), key=lambda i: -math.inf if i[0] is None else i[0])
+        return [0 if b is None else round(self.factor ** b, 3) for b, _ in items], [c for _, c in items]
+
+    def percentile(self, q):
+        """ upper bound of the bucket of the q-th percentile, q between 0 and 100 """
+        values, counts = self._sorted()
+        rank = q / 100 * sum(counts)
+        seen = 0
+        for value, count in zip(values, counts):
+            seen += count
+            if seen >= rank:
+                return value
+        return values[-1] if values else None
+
+    def count(self):
+        return sum(self.buckets.values())
+
+    def values_and_counts(self):
+        values, counts = self._sorted()
+        while len(values) > MAX_VALUES:
+            # merge the lowest bucket into the next one
+            counts[1] += counts[0]
+            del values[0], counts[0]
+        return values, counts
+
+
+class Metrics:
+    """ in-memory aggregation of counters, histograms and gauges, written out as CloudWatch embedded metric format
+    (EMF) lines on stdout, so recording a metric costs no API call. A Lambda flushes at the end of each invocation,
+    a long running service like the bridge every interval seconds after start(). default_dimensions are added to
+    all metrics """
+
+    def __init__(self, namespace="WIS2monitoring", stream=None, interval=60, **default_dimensions):
+        self.namespace = namespace
+        self.stream = stream
+        self.interval = interval
+        self.default_dimensions = default_dimensions
+        self.collectors = []
+
+        self._lock = threading.Lock()
+        self._data = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _entry(self, name, unit, dimensions, kind):
+        key = tuple(sorted(dimensions.items()))
+        metrics = self._data.setdefault(key, {})
+        if name not in metrics:
+            metrics[name] = [unit, None, kind]
+        return metrics[name]
+
+    def count(self, name, value=1, unit="Count", **dimensions):
+        with self._lock:
+            entry = self._entry(name, unit, dimensions, "count")
+            entry[1] = (entry[1] or 0) + value
+
+    def observe(self, name, value, unit, **dimensions):
+        """ add a value to the distribution of name """
+        with self._lock:
+            entry = self._entry(name, unit, dimensions, "histogram")
+            if entry[1] is None:
+                entry[1] = Histogram()
+            entry[1].add(value)
+
+    def gauge(self, name, value, unit="Count", **dimensions):
+        with self._lock:
+            self._entry(name, unit, dimensions, "gauge")[1] = value
+
+    def take(self):
+        """ the metrics recorded so far, which are reset """
+        with self._lock:
+            data = self._data
+            self._data = {}
+        return data
+
+    def merge(self, data):
+        """ add metrics returned by take(), e.g. of a worker process """
+        with self._lock:
+            for key, metrics in data.items():
+                for name, (unit, value, kind) in metrics.items():
+                    entry = self._entry(name, unit, dict(key), kind)
+                    if kind == "histogram":
+                        if entry[1] is None:
+                            entry[1] = Histogram(value.factor)
+                        entry[1].merge(value)
+                    elif kind == "count":
+                        entry[1] = (entry[1] or 0) + value
+                    else:
+                        entry[1] = value
+
+    def add_collector(self, fn):
+        """ fn(metrics) is called before every flush, e.g. to sample queue depths as gauges """
+        self.collectors.append(fn)
+
+    def flush(self, **dimensions):
+        """ write the metrics as EMF, with dimensions added to all of them, and log the percentiles of the
+        distributions """
+        for fn in self.collectors:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.error(f"error collecting metrics {e}", exc_info=True)
+        data = self.take()
+        timestamp = int(time.time() * 1000)
+        lines = []
+        for key, metrics in data.items():
+            record_dimensions = {**self.default_dimensions, **dimensions, **dict(key)}
+            record = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.namespace,
+                        "Dimensions": [list(record_dimensions.keys())],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, (unit, _, _) in metrics.items()],
+                    }],
+                },
+                **record_dimensions,
+            }
+            for name, (unit, value, _) in metrics.items():
+                if isinstance(value, Histogram):
+                    logger.info("{} {} count {} p50 {} p90 {} p99 {} {}".format(
+                        name, dict(key), value.count(), value.percentile(50), value.percentile(90),
+                        value.percentile(99), unit.lower()))
+                    values, counts = value.values_and_counts()
+                    value = {"Values": values, "Counts": counts}
+                record[name] = value
+            lines.append(json.dumps(record))
+
+        if lines:
+            stream = self.stream or sys.stdout
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+
+# shared by all pipelines of a Lambda
+lambda_metrics = Metrics()
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """ time a processing stage, e.g. "download", into the StageDuration distribution. Also usable as decorator """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        lambda_metrics.observe("StageDuration", (time.perf_counter() - start) * 1000, "Milliseconds", Stage=stage)
@@ -0,0 +1,117 @@
+import logging
+import pickle
+import time
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .deadline import DeadlineExceeded, record_deadline
+from .metrics import timed, lambda_metrics
+
+logger = logging.getLogger(__name__)
+
+MODES = ("serial", "thread", "process")
+
+
+def _call(fn, payload, deadline=None, record_budget=None, first=True):
+    """ fn(payload), or the exception it raised. Records other than the first are not started after deadline, each
+    record's downloads stop after record_budget seconds or at deadline """
+    start = time.monotonic()
+    if deadline is not None and not first and start >= deadline:
+        return DeadlineExceeded("deadline reached before processing the record")
+    end = start + record_budget if record_budget else None
+    if deadline is not None and not first:
+        end = min(end, deadline) if end else deadline
+    try:
+        with record_deadline(end), timed("record"):
+            return fn(payload)
+    except DeadlineExceeded as e:
+        logger.warning("record stopped: {}".format(e))
+        return e
+    except Exception as e:
+        logger.error("error processing record", exc_info=True)
+        return e
+
+
+def _picklable(result):
+    """ exceptions which cannot be sent back from a worker process are replaced by one with the same message """
+    if isinstance(result, Exception):
+        try:
+            pickle.loads(pickle.dumps(result))
+        except Exception:
+            return Exception("{}: {}".format(type(result).__name__, result))
+    return result
+
+
+def _process_worker(fn, payloads, conn, deadline, record_budget):
+    # the metrics of the parent were copied by the fork
+    lambda_metrics.take()
+    try:
+        # one message per record, a result which cannot be sent only fails its own record
+        for i, payload in enumerate(payloads):
+            result = _picklable(_call(fn, payload, deadline, record_budget, False))
+            try:
+                conn.send(result)
+            except Exception as e:
+                conn.send(Exception(f"cannot send the result from the worker process: {e!r}"))
+        # followed by the metrics of the worker
+        conn.send(lambda_metrics.take())
+    finally:
+        conn.close()
+
+
+def _process_records_forked(fn, payloads, workers, deadline, record_budget):
+    # multiprocessing pools and queues need /dev/shm, which Lambda does not have, pipes work.
+    # Forked workers see the module state of the parent, e.g. prefetched content, their changes to it are lost
+    import multiprocessing
+
+    # the first record is processed here, so the imports and caches fn builds on first use are made once in the
+    # parent, kept for the next invocation and shared by the workers, instead of being rebuilt by every worker
+    first = _call(fn, payloads[0], deadline, record_budget, True)
+    payloads = payloads[1:]
+
+    context = multiprocessing.get_context("fork")
+    workers = min(workers, len(payloads))
+    processes = []
+    for i in range(workers):
+        parent_conn, child_conn = context.Pipe(duplex=False)
+        process = context.Process(target=_process_worker, args=(fn, payloads[i::workers], child_conn, deadline, record_budget), daemon=True)
+        process.start()
+        child_conn.close()
+        processes.append((process, parent_conn))
+
+    results = [None] * len(payloads)
+    for i, (process, conn) in enumerate(processes):
+        # every worker processes every workers-th record, starting at its own index
+        for index in range(i, len(payloads), workers):
+            try:
+                results[index] = conn.recv()
+            except Exception as e:
+                # the worker died
+                results[index] = Exception(f"worker process failed: {e!r}")
+        try:
+            lambda_metrics.merge(conn.recv())
+        except Exception:
+            pass
+        conn.close()
+        process.join()
+    return [first] + results
+
+
+def process_records(fn, payloads, mode="serial", workers=None, deadline=None, record_budget=None):
+    """ fn(payload) for each payload, in input order. Returns the result of each record, or the exception it raised,
+    so one failing record does not stop the others. mode "thread" suits I/O bound functions, "process" CPU bound
+    ones like BUFR decoding, workers defaults to the number of CPUs.
+    Records are not started after deadline (a time.monotonic()), they get DeadlineExceeded as result. The first record
+    is always processed so a batch makes progress. Downloads of a record stop after record_budget seconds """
+    if mode not in MODES:
+        raise Exception(f"mode {mode} not supported, use one of {MODES}")
+    workers = workers or os.cpu_count() or 1
+
+    if mode == "serial" or workers == 1 or len(payloads) < 2:
+        return [_call(fn, payload, deadline, record_budget, i == 0) for i, payload in enumerate(payloads)]
+    if mode == "thread":
+        with ThreadPoolExecutor(max_workers=min(workers, len(payloads))) as executor:
+            return list(executor.map(lambda i: _call(fn, payloads[i], deadline, record_budget, i == 0),
+                                     range(len(payloads))))
+    return _process_records_forked(fn, payloads, workers, deadline, record_budget)
@@ -0,0 +1,117 @@
+import logging
+import threading
+
+from .errors import NonRecoverableError
+from .lib import shared_content
+from .metrics import timed, lambda_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def topic_matches(topic_filter, topic):
+    """ MQTT style topic matching supporting the + and # wildcards """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+
+class Processor:
+
+    def __init__(self, name, fn, topics, firehose_name, needs_content):
+        self.name = name
+        self.fn = fn
+        self.topics = list(topics)
+        self.firehose_name = firehose_name
+        self.needs_content = needs_content
+
+    def matches(self, topic):
+        return any(topic_matches(f, topic) for f in self.topics)
+
+
+class ProcessorRegistry:
+    """ processors of a Lambda which consumes one stream: each notification is passed to every processor with a
+    topic filter matching notification["_meta"]["topic"], and the rows returned by a processor are sent to its own
+    delivery stream. The processors of a notification share its content, which is downloaded at most once.
+
+    A NonRecoverableError of a processor only drops its own rows, a dead-letter row is sent to dead_letter_name if
+    given. Any other error fails the record, which is retried with all of its processors """
+
+    def __init__(self, name="fanout", dead_letter_name=None):
+        self.name = name
+        self.dead_letter_name = dead_letter_name
+        self.processors = []
+        self._lock = threading.Lock()
+        self._matching = {}
+
+    def register(self, name, fn, topics=("#",), firehose_name=None, needs_content=False):
+        """ fn(notification) returns the rows for firehose_name. needs_content tells the registry that fn calls
+        handle_content, so the content of matching notifications is prefetched """
+        with self._lock:
+            if any(p.name == name for p in self.processors):
+                raise Exception(f"processor {name} already registered")
+            self.processors.append(Processor(name, fn, topics, firehose_name, needs_content))
+            self._matching.clear()
+
+    def processor(self, name, topics=("#",), firehose_name=None, needs_content=False):
+        """ decorator registering a function """
+        def register(fn):
+            self.register(name, fn, topics, firehose_name, needs_content)
+            return fn
+        return register
+
+    def matching(self, topic):
+        """ processors matching topic, in registration order """
+        with self._lock:
+            matching = self._matching.get(topic)
+            if matching is None:
+                matching = self._matching[topic] = [p for p in self.processors if p.matches(topic)]
+            return matching
+
+    def _topic(self, notification):
+        return (notification.get("_meta") or {}).get("topic", "")
+
+    def needs_content(self, notification):
+        return any(p.needs_content for p in self.matching(self._topic(notification)))
+
+    def process(self, notification):
+        """ rows of all matching processors, by delivery stream """
+        ret = {}
+        with shared_content():
+            for p in self.matching(self._topic(notification)):
+                try:
+                    with timed(p.name):
+                        rows = p.fn(notification)
+                except NonRecoverableError as e:
+                    logger.error("processor {} cannot process {}: {}".format(p.name, notification.get("id"), e))
+                    lambda_metrics.count("ProcessorErrors", Processor=p.name)
+                    if self.dead_letter_name:
+                        ret.setdefault(self.dead_letter_name, []).append({
+                            "processor": p.name,
+                            "error": "{}: {}".format(type(e).__name__, e),
+                            "id": notification.get("id"),
+                            "topic": self._topic(notification),
+                        })
+                    continue
+                ret.setdefault(p.firehose_name, []).extend(rows or [])
+        return ret
+
+    def lambda_handler(self, event, context, prefetch=False, **kwargs):
+        """ kinesis_lambda_handler dispatching to the processors. With prefetch only the content of notifications
+        which a processor needs is downloaded ahead """
+        from .wis2_lambda import kinesis_lambda_handler
+
+        def fn(notification):
+            return self.process(notification)
+        fn.__name__ = self.name
+
+        return kinesis_lambda_handler(event, context, fn, None, prefetch=self.needs_content if prefetch else False,
+                                      **kwargs)
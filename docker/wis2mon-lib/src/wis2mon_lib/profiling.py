@@ -0,0 +1,291 @@
+import contextlib
+import threading
+import datetime
+import logging
+import pstats
+import random
+import sys
+import os
+
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("sampling", "cprofile")
+
+
+class StackSampler:
+    """ statistical profiler: a background thread samples the stacks of all other threads every interval seconds.
+    The samples are counted as collapsed stacks, outermost frame first, as read by flamegraph.pl and speedscope """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        return self.counts
+
+    def collapsed(self):
+        return "".join("{} {}\n".format(stack, count) for stack, count in sorted(self.counts.items()))
+
+
+def memory_report(snapshot, peak, top=20):
+    """ peak traced memory and the lines which allocated the most memory still held """
+    lines = [f"peak {peak} bytes"]
+    lines += [str(stat) for stat in snapshot.statistics("lineno")[:top]]
+    return "\n".join(lines) + "\n"
+
+
+class InvocationProfiler:
+    """ profiles one invocation in every, chosen at random so short-lived execution environments are sampled too.
+    kind "sampling" samples the stacks of all threads, "cprofile" traces every call of the invoking thread only.
+    The profile is written to directory as .collapsed or .pstats file and, with upload_to (s3://bucket/prefix),
+    copied to S3. With memory, tracemalloc records the peak memory of the invocation in a .memory.txt file.
+    Forked worker processes are not profiled. Invocations which are not sampled only draw a random number """
+
+    def __init__(self, every=0, kind="sampling", directory="/tmp/profiles", upload_to=None, memory=False,
+                 interval=0.005):
+        if kind not in KINDS:
+            raise Exception(f"profiler {kind} not supported, use one of {KINDS}")
+        self.every = every
+        self.kind = kind
+        self.directory = directory
+        self.upload_to = upload_to
+        self.memory = memory
+        self.interval = interval
+        self.profiled = 0
+        self._s3 = None
+
+    def profile(self, name):
+        """ context manager profiling the block if this invocation is sampled """
+        if not self.every or random.random() * self.every >= 1:
+            return contextlib.nullcontext()
+        return self._profile(name)
+
+    @contextlib.contextmanager
+    def _profile(self, name):
+        import tracemalloc
+
+        memory = self.memory and not tracemalloc.is_tracing()
+        if memory:
+            tracemalloc.start(10)
+        if self.kind == "cprofile":
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = StackSampler(self.interval).start()
+        try:
+            yield
+        finally:
+            if self.kind == "cprofile":
+                profiler.disable()
+            else:
+                profiler.stop()
+            snapshot = peak = None
+            if memory:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            try:
+                self._write(name, profiler, snapshot, peak)
+            except Exception as e:
+                logger.warning("cannot write the profile of {}: {}".format(name, e))
+
+    def _write(self, name, profiler, snapshot, peak):
+        os.makedirs(self.directory, exist_ok=True)
+        base = "{}-{}-{}".format(name, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"), os.getpid())
+        files = []
+        if self.kind == "cprofile":
+            files.append((base + ".pstats", None))
+            profiler.dump_stats(os.path.join(self.directory, base + ".pstats"))
+        else:
+            files.append((base + ".collapsed", profiler.collapsed().encode("utf8")))
+        if snapshot is not None:
+            logger.info("peak memory of {} {} bytes".format(name, peak))
+            files.append((base + ".memory.txt", memory_report(snapshot, peak).encode("utf8")))
+
+        for file_name, data in files:
+            path = os.path.join(self.directory, file_name)
+            if data is not None:
+                with open(path, "wb") as f:
+                    f.write(data)
+            if self.upload_to:
+                self._upload(path, file_name)
+        self.profiled += 1
+        logger.info("profile of {} written to {}".format(name, os.path.join(self.directory, base)))
+
+    def _upload(self, path, file_name):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client("s3")
+        url = urlparse(self.upload_to)
+        key = url.path.strip("/")
+        key = f"{key}/{file_name}" if key else file_name
+        with open(path, "rb") as f:
+            self._s3.put_object(Bucket=url.netloc, Key=key, Body=f.read())
+
+
+class ProfileWindow:
+    """ profiles a long running service like the bridge for duration seconds every `every` seconds, the first window
+    starts after `every`. kind "sampling" samples the stacks of all threads. "cprofile" traces the calls of the
+    functions wrapped with wrap(), e.g. message_routing on the worker threads, with one profiler per thread merged at
+    the end of the window. With memory, tracemalloc records the peak memory during the window.
+    The profile is written to directory (.collapsed, .pstats, .memory.txt) and put into store if given, e.g. an
+    S3Store of the bridge's claim_check. Outside of a window a wrapped call costs one attribute check """
+
+    def __init__(self, kind="sampling", duration=30, every=3600, directory="/tmp/profiles", store=None,
+                 memory=False, interval=0.005, name="bridge"):
+        if kind not in KINDS:
+            raise Exception(f"profiler {kind} not supported, use one of {KINDS}")
+        self.kind = kind
+        self.duration = duration
+        self.every = every
+        self.directory = directory
+        self.store = store
+        self.memory = memory
+        self.interval = interval
+        self.name = name
+        self.windows = 0
+
+        self.active = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = []
+        self._sampler = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def wrap(self, fn):
+        """ fn, traced by cProfile while a window is active """
+        if self.kind != "cprofile":
+            return fn
+
+        def wrapper(*args, **kwargs):
+            if not self.active:
+                return fn(*args, **kwargs)
+            profile = getattr(self._local, "profile", None)
+            if profile is None:
+                import cProfile
+                profile = self._local.profile = cProfile.Profile()
+                with self._lock:
+                    self._profiles.append(profile)
+            return profile.runcall(fn, *args, **kwargs)
+        return wrapper
+
+    def begin(self):
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start(10)
+        if self.kind == "sampling":
+            self._sampler = StackSampler(self.interval).start()
+        self.active = True
+        logger.info(f"profiling for {self.duration} seconds")
+
+    def end(self):
+        self.active = False
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{}-{}-{}".format(self.name, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"), os.getpid())
+        files = []
+        if self.kind == "sampling":
+            self._sampler.stop()
+            files.append((name + ".collapsed", self._sampler.collapsed().encode("utf8")))
+        else:
+            with self._lock:
+                profiles, self._profiles = self._profiles, []
+            # threads create a new profiler in the next window
+            self._local = threading.local()
+            if profiles:
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(os.path.join(self.directory, name + ".pstats"))
+                files.append((name + ".pstats", None))
+        if self.memory:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            logger.info(f"peak memory during the profile {peak} bytes")
+            files.append((name + ".memory.txt", memory_report(snapshot, peak).encode("utf8")))
+
+        for file_name, data in files:
+            path = os.path.join(self.directory, file_name)
+            if data is None:
+                # written by pstats
+                with open(path, "rb") as f:
+                    data = f.read()
+            else:
+                with open(path, "wb") as f:
+                    f.write(data)
+            if self.store:
+                try:
+                    self.store.put(file_name, data)
+                except Exception as e:
+                    logger.warning(f"cannot store profile {file_name}: {e}")
+        self.windows += 1
+        logger.info(f"profile written to {os.path.join(self.directory, name)}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profile-window", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.every):
+            self.begin()
+            stopped = self._stop.wait(self.duration)
+            try:
+                self.end()
+            except Exception as e:
+                logger.error(f"error writing the profile {e}", exc_info=True)
+            if stopped:
+                return
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+def default_profiler():
+    """ profiler configured by PROFILE_EVERY (profile one invocation in PROFILE_EVERY, 0 disables profiling),
+    PROFILER (sampling or cprofile), PROFILE_DIR, PROFILE_S3 and PROFILE_MEMORY """
+    return InvocationProfiler(
+        every=int(os.getenv("PROFILE_EVERY", "0")),
+        kind=os.getenv("PROFILER", "sampling").lower(),
+        directory=os.getenv("PROFILE_DIR", "/tmp/profiles"),
+        upload_to=os.getenv("PROFILE_S3") or None,
+        memory=os.getenv("PROFILE_MEMORY", "False").lower() in ('true', '1', 't', 'yes'),
+    )
+
+
+# replace to profile differently
+lambda_profiler = default_profiler()
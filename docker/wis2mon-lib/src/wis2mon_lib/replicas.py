@@ -0,0 +1,149 @@
+import contextvars
+import logging
+import threading
+import time
+import os
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import health
+from .errors import RetryError
+from .deadline import remaining_timeout
+from .cache import content_key
+from .fetch import download_content, canonical_href
+
+logger = logging.getLogger(__name__)
+
+# a second replica is requested when the first has not answered after this many seconds
+HEDGE_AFTER = float(os.getenv("REPLICA_HEDGE_AFTER", "0.5"))
+
+# longest wait for a download once all replicas were requested
+WAIT_SECONDS = float(os.getenv("REPLICA_WAIT_SECONDS", "60"))
+
+
+def _new_executor():
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="replica")
+
+
+_new_executor()
+# a forked worker inherits the executor without its threads, submitted downloads would never run
+os.register_at_fork(after_in_child=_new_executor)
+
+
+class ReplicaIndex:
+    """ hrefs under which the same data was announced, e.g. by each global cache, indexed by the content key of the
+    notifications (integrity digest or data_id). Entries expire after ttl seconds, at most max_entries are kept """
+
+    def __init__(self, max_entries=10000, ttl=3600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def add(self, notification):
+        key = content_key(notification)
+        href = canonical_href(notification) if key else None
+        if not href:
+            return
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[0] > self.ttl:
+                entry = self._entries[key] = [now, {}]
+            entry[1][href] = True
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def hrefs(self, notification):
+        """ known hrefs of the data of notification, its own canonical href first """
+        href = canonical_href(notification)
+        key = content_key(notification)
+        with self._lock:
+            entry = self._entries.get(key)
+            known = list(entry[1]) if entry and self.clock() - entry[0] <= self.ttl else []
+        return [href] + [h for h in known if h != href]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def download_replicas(hrefs, timeout=4, integrity=None, hedge_after=None):
+    """ download the same content from the first of hrefs which delivers it, healthy and fast hosts first. If a replica
+    has not answered after hedge_after seconds the next one is requested in parallel, a replica which fails,
+    does not have the content or does not match the integrity is replaced by the next one.
+    Returns the content, the integrity verdict and the href which served the content """
+    hedge_after = HEDGE_AFTER if hedge_after is None else hedge_after
+    if health.host_health:
+        hrefs = health.host_health.rank(hrefs)
+    remaining = iter(hrefs)
+
+    futures = {}
+    error = None
+    not_found = None
+
+    def request_next():
+        href = next(remaining, None)
+        if href is not None:
+            # in the context of the caller, which carries the deadline of the record
+            futures[_executor.submit(contextvars.copy_context().run, download_content, href, timeout, integrity)] = href
+        return href is not None
+
+    request_next()
+    while futures:
+        done, _ = wait(futures, timeout=hedge_after, return_when=FIRST_COMPLETED)
+        if not done:
+            # hedge, the pending requests keep running
+            if request_next():
+                logger.debug("hedging to a second replica after {} seconds".format(hedge_after))
+            else:
+                done, _ = wait(futures, timeout=remaining_timeout(WAIT_SECONDS), return_when=FIRST_COMPLETED)
+                if not done:
+                    raise RetryError("no replica answered within {} seconds".format(WAIT_SECONDS))
+            continue
+
+        for future in done:
+            href = futures.pop(future)
+            try:
+                content, verdict = future.result()
+            except Exception as e:
+                logger.debug("replica {} failed: {}".format(href, e))
+                error = e
+                request_next()
+                continue
+            if content is None or verdict == "invalid":
+                not_found = not_found or (content, verdict, href)
+                request_next()
+                continue
+            return content, verdict, href
+
+    if not_found:
+        return not_found
+    raise error
+
+
+def download_notification(notification, timeout=4):
+    """ content of a notification which is not embedded, its integrity verdict and the href which served it.
+    With a replica index the content is downloaded from the fastest known replica """
+    href = canonical_href(notification)
+    integrity = notification["properties"].get("integrity")
+    if replica_index is None:
+        return download_content(href, timeout=timeout, integrity=integrity) + (href,)
+
+    replica_index.add(notification)
+    return download_replicas(replica_index.hrefs(notification), timeout=timeout, integrity=integrity)
+
+
+def default_replica_index():
+    """ replica index if REPLICA_SELECTION is enabled, REPLICA_TTL seconds """
+    if os.getenv("REPLICA_SELECTION", "False").lower() not in ('true', '1', 't', 'yes'):
+        return None
+    return ReplicaIndex(ttl=float(os.getenv("REPLICA_TTL", "3600")))
+
+
+# replace or set to None to change or disable replica selection
+replica_index = default_replica_index()
@@ -0,0 +1,46 @@
+import json
+import base64
+
+# first byte of a MessagePack encoded record, JSON records start with "{" or whitespace
+MSGPACK_MARKER = 0x01
+
+WIRE_FORMATS = ("json", "msgpack")
+
+
+def _msgpack():
+    # imported with the first MessagePack record, JSON only pipelines never need it
+    try:
+        import msgpack
+    except ImportError:
+        raise Exception("msgpack is not installed")
+    return msgpack
+
+
+def encode_record(notification, wire_format="json"):
+    """encode a notification as written by the bridge. With "msgpack" embedded base64 content is carried as raw bytes"""
+    if wire_format == "json":
+        return json.dumps(notification).encode("utf-8")
+    if wire_format != "msgpack":
+        raise Exception(f"wire format {wire_format} not supported")
+    msgpack = _msgpack()
+
+    content = (notification.get("properties") or {}).get("content")
+    if isinstance(content, dict) and isinstance(content.get("value"), str) and str(content.get("encoding", "base64")).lower() == "base64":
+        content = dict(content, value=base64.b64decode(content["value"]))
+        notification = dict(notification, properties=dict(notification["properties"], content=content))
+
+    return bytes((MSGPACK_MARKER,)) + msgpack.packb(notification, use_bin_type=True)
+
+
+def decode_record(data):
+    """decode a record written by the bridge, either JSON or MessagePack with the format marker.
+    Embedded content carried as raw bytes is returned base64 encoded, as in a JSON notification"""
+    if not data or data[0] != MSGPACK_MARKER:
+        return json.loads(data)
+    msgpack = _msgpack()
+
+    notification = msgpack.unpackb(data[1:], raw=False)
+    content = (notification.get("properties") or {}).get("content")
+    if isinstance(content, dict) and isinstance(content.get("value"), bytes):
+        content["value"] = base64.b64encode(content["value"]).decode("ascii")
+    return notification
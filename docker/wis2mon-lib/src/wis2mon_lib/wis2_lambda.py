@@ -1,17 +1,29 @@
 import logging
 import json
 import base64
-import boto3
 import datetime
+import os
+import time
+import functools
+from collections import OrderedDict
+
+from .errors import RetryError, NonRecoverableError
+from .wire_format import decode_record
+from . import cache, replicas
+from .fetch import prefetch_contents, probe_cache, clear_prefetched
+from .parallel import process_records
+from .deadline import DeadlineExceeded, invocation_deadline, RECORD_BUDGET
+from .metrics import lambda_metrics, timed
+from . import profiling
+from .firehose import firehose_sink, encode_lines, DocumentTooLarge
 
 logger = logging.getLogger(__name__)
 
-class RetryError(Exception):
-    pass
-
-class NonRecoverableError(Exception):
-    pass
+# a record failing with an unexpected error (neither RetryError nor NonRecoverableError) this many times is
+# dead-lettered, so a processor bug on one record does not block the shard until the record expires
+MAX_RECORD_ATTEMPTS = int(os.getenv("MAX_RECORD_ATTEMPTS", "3"))
 
+_attempts = OrderedDict()
 
 def kinesis_firehose_processor(event,processing_function):
     output = []
@@ -20,7 +32,7 @@ def kinesis_firehose_processor(event,processing_function):
         logger.debug("processing "+record['recordId'])
     
         try:
-            payload=json.loads(base64.b64decode(record["data"]))
+            payload=decode_record(base64.b64decode(record["data"]))
             
             logger.debug("extracting info from: {}".format(payload))
             data = json.dumps(processing_function(payload)) + "\n"
@@ -44,83 +56,196 @@ def kinesis_firehose_processor(event,processing_function):
 
     return output
 
-        
-def kinesis_lambda_handler(event, context, fn, firehose_name ):
-    """this functions receives kinesis records and extracts information from it"""
+
+def content_cache_metrics():
+    """record the content cache counters since the last call"""
+    if not cache.content_cache:
+        return
+    stats = cache.content_cache.stats(reset=True)
+    logger.info("content cache {}".format(stats))
+    lambda_metrics.count('ContentCacheHits', stats["hits"] + stats["file_hits"])
+    lambda_metrics.count('ContentCacheMisses', stats["misses"])
+    lambda_metrics.count('ContentCacheBytesSaved', stats["bytes_saved"], unit='Bytes')
+
+
+def dead_letter(record, error):
+    """document sent to the dead-letter sink for a Kinesis record which can never be processed"""
+    return {
+        "sequenceNumber": record["kinesis"]["sequenceNumber"],
+        "partitionKey": record["kinesis"].get("partitionKey"),
+        "approximateArrivalTimestamp": record["kinesis"].get("approximateArrivalTimestamp"),
+        "eventSourceARN": record.get("eventSourceARN"),
+        "error": "{}: {}".format(type(error).__name__, error),
+        "data": record["kinesis"]["data"],
+    }
+
+
+def _dead_letter_lines(dead_letters):
+    lines = []
+    for document in dead_letters:
+        try:
+            lines.extend(encode_lines([document]))
+        except DocumentTooLarge:
+            # the base64 data of a record close to the Kinesis limit
+            lines.extend(encode_lines([dict(document, data=None, data_omitted=True)]))
+    return lines
+
+
+def _keyed(rows, sequence_number):
+    """rows with meta_record_key, the Kinesis record and position of the row. A row delivered twice has the same key,
+    so the load into the database can skip it"""
+    return [dict(row, meta_record_key="{}:{}".format(sequence_number, i)) if isinstance(row, dict) else row
+            for i, row in enumerate(rows)]
+
+
+def _count_attempt(record, error, max_attempts=None):
+    """error of a record, a NonRecoverableError once an unexpected error was seen max_attempts times.
+    Counted per container, a retry served by another container starts again"""
+    max_attempts = max_attempts or MAX_RECORD_ATTEMPTS
+    if isinstance(error, (RetryError, NonRecoverableError)) or max_attempts <= 0:
+        return error
+    key = (record.get("eventSourceARN"), record["kinesis"]["sequenceNumber"])
+    _attempts[key] = _attempts.pop(key, 0) + 1
+    while len(_attempts) > 10000:
+        _attempts.popitem(last=False)
+    if _attempts[key] < max_attempts:
+        return error
+    del _attempts[key]
+    return NonRecoverableError("failed {} attempts, {}: {}".format(max_attempts, type(error).__name__, error))
+
+
+def _decode(record):
+    try:
+        with timed("decode"):
+            return decode_record(base64.b64decode(record["kinesis"]["data"]))
+    except Exception as e:
+        return NonRecoverableError(f"cannot decode record: {e}")
+
+
+def _kinesis_lambda_handler(event, context, fn, firehose_name, prefetch=False, prefetch_deadline=None, probe=False, probe_sample=None, mode="serial", workers=None, dead_letter_name=None, reserve=None, record_budget=RECORD_BUDGET ):
+    """this functions receives kinesis records and extracts information from it.
+    With prefetch the content of all records is downloaded concurrently before fn is called for each record,
+    with probe the cache URLs of all records are checked concurrently (at most probe_sample per host).
+    mode "thread" or "process" calls fn for several records in parallel, see parallel.process_records.
+
+    Returns the partial batch response of the event source (reportBatchItemFailures): when records fail with
+    RetryError, or any error other than NonRecoverableError, the lowest failed sequence number is reported and Lambda
+    retries the batch from there. The output of the records before it is sent to firehose_name, records which fail
+    with NonRecoverableError are sent to the dead-letter delivery stream dead_letter_name (or logged without one), as
+    are records with a row which does not fit into a Firehose record (DocumentTooLarge) and records which failed
+    with another error MAX_RECORD_ATTEMPTS times.
+
+    Rows are delivered at least once: when a delivery stream fails after retries the whole batch is retried, and
+    the rows sent before are sent again. Each dict row carries meta_record_key, the sequence number of its record and
+    its position, which is the same for every copy (see DB_RECORD_KEY of s3tords).
+
+    No new records are started reserve seconds (DEADLINE_RESERVE_SECONDS) before the Lambda times out, the output so
+    far is delivered and the unprocessed tail is reported as failed, so long batches make progress. The downloads of
+    a record stop after record_budget seconds (RECORD_BUDGET_SECONDS).
+
+    One invocation in PROFILE_EVERY is profiled, see profiling.default_profiler.
+
+    fn returns the rows of a record for firehose_name, or a dict of rows by delivery stream. prefetch may be a
+    function selecting the notifications whose content is downloaded ahead"""
     if not event or not "Records" in event:
         return 
-    
+
     start_time = datetime.datetime.now()
     
     logger.debug("event before processing: {}".format(event))    
     logger.info("lambda event {} records".format(len(event['Records'])))
     
-    output = []
-
-    for record in event["Records"]:
-        kinesis_record = record["kinesis"]
-        record_id = kinesis_record["sequenceNumber"]
-        logger.debug("processing "+record_id)
-
-        payload = json.loads(base64.b64decode(kinesis_record["data"]))
-        logger.debug("extracting info from: {}".format(payload))
-
-        data = fn(payload)
-
-        output = output + data 
+    outputs = {}
+
+    decoded = [_decode(record) for record in event["Records"]]
+    payloads = [d for d in decoded if not isinstance(d, Exception)]
+    if replicas.replica_index is not None:
+        # copies of the same data in the batch are alternative sources for each other
+        for payload in payloads:
+            replicas.replica_index.add(payload)
+    deadline = invocation_deadline(context, reserve)
+    if deadline is not None:
+        # the downloads ahead leave time for processing
+        left = max(deadline - time.monotonic(), 0.1)
+        prefetch_deadline = min(prefetch_deadline, left) if prefetch_deadline else left
+    if prefetch:
+        prefetch_contents([p for p in payloads if prefetch is True or prefetch(p)], deadline=prefetch_deadline)
+    if probe:
+        probe_cache(payloads, sample=probe_sample, deadline=prefetch_deadline)
+
+    try:
+        processed = iter(process_records(fn, payloads, mode=mode, workers=workers, deadline=deadline,
+                                         record_budget=record_budget))
+    finally:
+        clear_prefetched()
+    results = [d if isinstance(d, Exception) else next(processed) for d in decoded]
+    results = [_count_attempt(record, data) if isinstance(data, Exception) else data
+               for record, data in zip(event["Records"], results)]
+
+    # Lambda retries from the lowest failed sequence number, records after it are processed again
+    failed = [int(record["kinesis"]["sequenceNumber"]) for record, data in zip(event["Records"], results)
+              if isinstance(data, Exception) and not isinstance(data, NonRecoverableError)]
+    checkpoint = min(failed) if failed else None
+
+    dead_letters = []
+    skipped = retried = 0
+    for record, data in zip(event["Records"], results):
+        sequence_number = record["kinesis"]["sequenceNumber"]
+        if checkpoint is not None and int(sequence_number) >= checkpoint:
+            retried += 1
+            if isinstance(data, DeadlineExceeded):
+                skipped += 1
+            elif isinstance(data, Exception):
+                logger.error("error processing {}, retried: {}".format(sequence_number, data))
+            continue
+        if not isinstance(data, NonRecoverableError):
+            # encoded per record, so a row which does not fit into a Firehose record only dead-letters its record
+            try:
+                rows = data.items() if isinstance(data, dict) else [(firehose_name, data)]
+                lines = [(name, encode_lines(_keyed(r, sequence_number))) for name, r in rows]
+            except NonRecoverableError as e:
+                data = e
+        if isinstance(data, NonRecoverableError):
+            logger.error("error processing {}, not retried: {}".format(sequence_number, data))
+            dead_letters.append(dead_letter(record, data))
+            continue
+        for name, record_lines in lines:
+            outputs.setdefault(name, []).extend(record_lines)
+
+    # successes are delivered before the failures are reported. Delivery is at least once: an exception here
+    # retries the whole batch and rows already sent are sent again, with the same meta_record_key
+    for name, output in outputs.items():
+        if len(output)>0:
+            firehose_sink(name).send_lines(output)
+    if dead_letters:
+        if dead_letter_name:
+            firehose_sink(dead_letter_name).send_lines(_dead_letter_lines(dead_letters))
+        else:
+            logger.error("dropped {} records which cannot be processed: {}".format(len(dead_letters), dead_letters))
 
     end_time = datetime.datetime.now()
     avg_duration = ((end_time-start_time).total_seconds() * 1000 ) / len(event["Records"])
 
-    cloudwatch = boto3.client('cloudwatch')
-
-    response = cloudwatch.put_metric_data(
-        MetricData = [
-            {
-                'MetricName': 'RecordExecutionDurationAverage',
-                'Dimensions': [
-                    {
-                        'Name': 'Pipeline',
-                        'Value': fn.__name__
-                    },
-                ],
-                'Unit': 'Milliseconds',
-                'Value': avg_duration
-            },
-            {
-                'MetricName': 'RecordsProcessedNumber',
-                'Dimensions': [
-                    {
-                        'Name': 'Pipeline',
-                        'Value': fn.__name__
-                    },
-                ],
-                'Unit': 'Count',
-                'Value':  len(event["Records"])
-            },
-        ],
-        Namespace = 'WIS2monitoring'
-    )
+    # written to the log as EMF, CloudWatch extracts the metrics without an API call
+    lambda_metrics.gauge('RecordExecutionDurationAverage', avg_duration, unit='Milliseconds')
+    lambda_metrics.count('RecordsProcessedNumber', len(event["Records"]))
+    lambda_metrics.count('RecordsRetried', retried)
+    lambda_metrics.count('RecordsDeadLettered', len(dead_letters))
+    content_cache_metrics()
+    lambda_metrics.flush(Pipeline=fn.__name__)
 
     logger.info('processed {} records in {:.2f} seconds, average duration {:.2f} seconds'.format(len(event["Records"]), (end_time-start_time).total_seconds() , (end_time-start_time).total_seconds() / len(event["Records"])   ))
     #logger.info("submitting {} records to firehose".format(len(output)))
         
-    if len(output)>0:
-        firehose_client = boto3.client('firehose')
-        try:
-            response = firehose_client.put_record_batch(
-                DeliveryStreamName=firehose_name,
-                Records=[
-                    { "Data" : json.dumps(d) + "\n" } for d in output 
-                ]
-            )
-
-            logger.debug("response {}".format(response))
-            logger.info('submitted {} records to firehose'.format(len(output)))
-        except Exception as e:
-            raise e
-        finally:
-            if firehose_client:
-                firehose_client.close()
-              
-    return True
\ No newline at end of file
+    if skipped:
+        logger.warning("{} records not processed or stopped, out of time".format(skipped))
+    if checkpoint is not None:
+        logger.info("{} records failed, retrying from {}".format(len(failed), checkpoint))
+        return {"batchItemFailures": [{"itemIdentifier": str(checkpoint)}]}
+    return {"batchItemFailures": []}
+
+
+@functools.wraps(_kinesis_lambda_handler)
+def kinesis_lambda_handler(event, context, fn, *args, **kwargs):
+    with profiling.lambda_profiler.profile(fn.__name__):
+        return _kinesis_lambda_handler(event, context, fn, *args, **kwargs)
@@ -34,6 +34,14 @@ class DBProcessor:
     def __init__(self,tablename,mapping):
         self.table=tablename
         self.mapping=mapping
+        # rows are delivered at least once, with DB_RECORD_KEY a unique meta_record_key column skips the copies
+        self.record_key = os.environ.get("DB_RECORD_KEY","False").lower() in ('true', '1', 't', 'yes')
+        if self.record_key:
+            self.mapping = {**mapping, "meta_record_key": {
+                "type": "stringValue",
+                "db_col": "meta_record_key",
+                "source_key": "meta_record_key"
+            }}
         self.sql = self.create_sql()
 
         
@@ -80,6 +88,9 @@ class DBProcessor:
             values = ",".join( [ f":{k}" for k,item in self.mapping.items() ] ),
             table = self.table
         )
+        if self.record_key:
+            # a row delivered twice is not inserted again
+            sql += " ON DUPLICATE KEY UPDATE id=id"
         
         logger.debug(f"created SQL: {sql}")
 
@@ -678,8 +689,25 @@ class NotificationsDBProcessor(DBProcessor):
             "source_key": "meta_remote_content_size"
         },   
     }
+
+    # loaded with DB_INTEGRITY_COLUMNS, needs the meta_integrity and meta_replica columns of rds-init-fn-code/script copy.sql
+    integrity_mapping = {
+        "meta_integrity": {
+            "type": "stringValue",
+            "db_col": "meta_integrity",
+            "source_key": "meta_integrity"
+        },
+        "meta_replica": {
+            "type": "stringValue",
+            "db_col": "meta_replica",
+            "source_key": "meta_replica"
+        },
+    }
         
 
     def __init__(self):
-        super().__init__(tablename='notifications',mapping=self.key_mapping)
+        mapping = self.key_mapping
+        if os.environ.get("DB_INTEGRITY_COLUMNS","False").lower() in ('true', '1', 't', 'yes'):
+            mapping = {**mapping, **self.integrity_mapping}
+        super().__init__(tablename='notifications',mapping=mapping)
 
@@ -209,7 +209,10 @@ export class Wis2MonitoringStack extends cdk.Stack {
       actions: ['iot:DescribeCertificate']
     }));
 
-    const image = ecs.ContainerImage.fromAsset("./docker/wis2bridge");
+    const image = ecs.ContainerImage.fromAsset("./docker", {
+      file: "Dockerfile-wis2bridge",
+      exclude: ["./lambda_notifications_new", "./lambda_surface-obs", "./lambda_swic", "./rds-init-fn-code"] // do not re-deploy for changes in these directories
+    });
 
     const my_environment = {
       "WIS_USERNAME": this.secrets["WIS_MF_USERNAME"], "WIS_PASSWORD": this.secrets["WIS_MF_PASSWORD"], "TOPICS": "$share/wmo/cache/a/wis2/#,$share/wmo/origin/a/wis2/#",
@@ -278,6 +281,8 @@ export class Wis2MonitoringStack extends cdk.Stack {
       ,
     });
 
+    const deadLetterStream = this.setupDeadLetterStream("Notification", "dead-letter/notifications/");
+
     const lambdaFunctionNew = new lambda.DockerImageFunction(this, "NotificationLambdaNew", {
       functionName: "NotificationLambdaNew",
       code: lambda.DockerImageCode.fromImageAsset(
@@ -285,7 +290,7 @@ export class Wis2MonitoringStack extends cdk.Stack {
         file: "Dockerfile-lambda_notifications_new",
         exclude: [   "./lambda_surface-obs", "./wis2bridge", "./rds-init-fn-code", "./lambda_swic"] // do not re-deploy for changes in these directories
       }),
-      environment: { "LAMBDA_LOG_LEVEL": "INFO", "LAMBDA_VALIDATE": "True", "FIREHOSE_NAME": firehoseStream.deliveryStreamName },
+      environment: { "LAMBDA_LOG_LEVEL": "INFO", "LAMBDA_VALIDATE": "True", "FIREHOSE_NAME": firehoseStream.deliveryStreamName, "DEAD_LETTER_FIREHOSE_NAME": deadLetterStream.deliveryStreamName },
       timeout: cdk.Duration.minutes(10),
       vpc: this.vpc,
       vpcSubnets: { subnetType: ec2.SubnetType.PRIVATE_WITH_EGRESS },
@@ -295,13 +300,16 @@ export class Wis2MonitoringStack extends cdk.Stack {
     lambdaFunctionNew.role?.attachInlinePolicy(this.metricPolicy);
 
     firehoseStream.grantPutRecords(lambdaFunctionNew);
+    deadLetterStream.grantPutRecords(lambdaFunctionNew);
 
     lambdaFunctionNew.addEventSource(new KinesisEventSource(sourceStreamNew, {
       batchSize: 300, // default
       maxBatchingWindow: cdk.Duration.seconds(45),
       startingPosition: lambda.StartingPosition.TRIM_HORIZON,
-      reportBatchItemFailures: false,
+      reportBatchItemFailures: true, // retry from the first failed record only
       bisectBatchOnError: true,
+      retryAttempts: 10, // a record which keeps failing is discarded instead of blocking the shard
+      maxRecordAge: cdk.Duration.hours(6),
       parallelizationFactor: 10
     }));
 
@@ -330,6 +338,8 @@ export class Wis2MonitoringStack extends cdk.Stack {
       ,
     });
 
+    const deadLetterStream = this.setupDeadLetterStream("SurfaceObs", "dead-letter/surface-observations/");
+
     const lambdaFunction = new lambda.DockerImageFunction(this, "SurfaceObsLambda", {
       functionName: "SurfaceObsLambda",
       code: lambda.DockerImageCode.fromImageAsset(
@@ -337,7 +347,7 @@ export class Wis2MonitoringStack extends cdk.Stack {
         file: "Dockerfile-lambda_surface-obs",
         exclude: ["./lambda_notifications_new","./wis2bridge", "./rds-init-fn-code", "./lambda_swic"] // do not re-deploy for changes in these directories
       }),
-      environment: { "LAMBDA_LOG_LEVEL": "INFO", "FIREHOSE_NAME": firehoseStream.deliveryStreamName },
+      environment: { "LAMBDA_LOG_LEVEL": "INFO", "FIREHOSE_NAME": firehoseStream.deliveryStreamName, "DEAD_LETTER_FIREHOSE_NAME": deadLetterStream.deliveryStreamName },
       timeout: cdk.Duration.minutes(10),
       vpc: this.vpc,
       vpcSubnets: { subnetType: ec2.SubnetType.PRIVATE_WITH_EGRESS },
@@ -348,13 +358,16 @@ export class Wis2MonitoringStack extends cdk.Stack {
 
 
     firehoseStream.grantPutRecords(lambdaFunction);
+    deadLetterStream.grantPutRecords(lambdaFunction);
 
     lambdaFunction.addEventSource(new KinesisEventSource(sourceStream, {
       batchSize: 50, // default
       maxBatchingWindow: cdk.Duration.seconds(60),
       startingPosition: lambda.StartingPosition.TRIM_HORIZON,
-      reportBatchItemFailures: false,
+      reportBatchItemFailures: true, // retry from the first failed record only
       bisectBatchOnError: true,
+      retryAttempts: 10, // a record which keeps failing is discarded instead of blocking the shard
+      maxRecordAge: cdk.Duration.hours(6),
     }));
 
 
@@ -385,6 +398,8 @@ export class Wis2MonitoringStack extends cdk.Stack {
       ,
     });
 
+    const deadLetterStream = this.setupDeadLetterStream("CAP", "dead-letter/swic/");
+
     const lambdaFunction = new lambda.DockerImageFunction(this, "CAPLambda", {
       functionName: "CAPLambda",
       code: lambda.DockerImageCode.fromImageAsset(
@@ -392,7 +407,7 @@ export class Wis2MonitoringStack extends cdk.Stack {
         file: "Dockerfile-lambda_swic",
         exclude: ["./lambda_notifications_new","./wis2bridge", "./rds-init-fn-code",  "./lambda_surface-obs"] // do not re-deploy for changes in these directories
       }),
-      environment: { "LAMBDA_LOG_LEVEL": "INFO", "FIREHOSE_NAME": firehoseStream.deliveryStreamName },
+      environment: { "LAMBDA_LOG_LEVEL": "INFO", "FIREHOSE_NAME": firehoseStream.deliveryStreamName, "DEAD_LETTER_FIREHOSE_NAME": deadLetterStream.deliveryStreamName },
       timeout: cdk.Duration.minutes(10),
       vpc: this.vpc,
       vpcSubnets: { subnetType: ec2.SubnetType.PRIVATE_WITH_EGRESS },
@@ -403,13 +418,16 @@ export class Wis2MonitoringStack extends cdk.Stack {
 
 
     firehoseStream.grantPutRecords(lambdaFunction);
+    deadLetterStream.grantPutRecords(lambdaFunction);
 
     lambdaFunction.addEventSource(new KinesisEventSource(sourceStream, {
       batchSize: 50, // default
       maxBatchingWindow: cdk.Duration.seconds(60),
       startingPosition: lambda.StartingPosition.TRIM_HORIZON,
-      reportBatchItemFailures: false,
+      reportBatchItemFailures: true, // retry from the first failed record only
       bisectBatchOnError: true,
+      retryAttempts: 10, // a record which keeps failing is discarded instead of blocking the shard
+      maxRecordAge: cdk.Duration.hours(6),
     }));
 
 
@@ -570,6 +588,10 @@ export class Wis2MonitoringStack extends cdk.Stack {
         "LAMBDA_LOG_LEVEL": "INFO",
         "PROCESSED_PREFIX": "processed",
         "DB_BATCH_SIZE": "1000",
+        // skip rows delivered twice, needs the meta_record_key columns of rds-init-fn-code/script copy.sql
+        "DB_RECORD_KEY": "false",
+        // load meta_integrity and meta_replica of the notifications, needs their columns of rds-init-fn-code/script copy.sql
+        "DB_INTEGRITY_COLUMNS": "false",
         "NOTIFCIATION_SOURCE_ARN": notificationSource.queue.queueArn,
         "SURFACEOBS_SOURCE_ARN": surfaceObsSource.queue.queueArn,
         "CAP_SOURCE_ARN": CAPSource.queue.queueArn
@@ -595,6 +617,19 @@ export class Wis2MonitoringStack extends cdk.Stack {
 
   }
 
+  setupDeadLetterStream(name: string, prefix: string): firehose.DeliveryStream {
+
+    // Kinesis records which a processing Lambda can never process, kept for inspection instead of blocking the shard
+    return new firehose.DeliveryStream(this, name + 'DeadLetterStream', {
+      destinations: [new destinations.S3Bucket(this.bucket, {
+        dataOutputPrefix: prefix,
+        bufferingInterval: cdk.Duration.seconds(60),
+      })]
+      ,
+    });
+
+  }
+
   setupImport(name: string, prefix: string): SqsEventSource {
 
     const deadLetterQueue = new sqs.Queue(this, "DLDqueue_" + name, {